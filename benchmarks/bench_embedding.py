@@ -0,0 +1,84 @@
+"""
+benchmarks/bench_embedding.py
+
+Times EmbeddingService.tsne on synthetic clustered data and reports the peak resident memory of each run.
+Every size runs in its own subprocess, so the peak memory of one run does not hide the next.
+
+Usage:
+    PYTHONPATH=brainstem_application python benchmarks/bench_embedding.py [--backend B] [--knn M] [--knn-only] [number of points ...]
+
+The backend and the kNN method default to "auto", and the sizes to 10,000, 50,000 and 160,000 points, roughly
+the number of voxels of the P56 reference space. --knn-only times the kNN graph alone.
+"""
+
+import os
+import sys
+import argparse
+import time
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+N_FEATURES = 50
+N_CLUSTERS = 20
+
+
+def make_data(n_points: int) -> np.ndarray:
+    """Build n_points float32 points around N_CLUSTERS gaussian clusters"""
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((N_CLUSTERS, N_FEATURES)).astype(np.float32) * 10
+    labels = rng.integers(0, N_CLUSTERS, n_points)
+    return centers[labels] + rng.standard_normal((n_points, N_FEATURES), dtype=np.float32)
+
+
+def run(backend: str, knn_method: str, knn_only: bool, n_points: int):
+    """Embed one data set and print the timings and the peak memory of this process"""
+    from services.analysis.embedding_service import EmbeddingService, KNNGraphCache
+
+    data = make_data(n_points)
+    knn_method = EmbeddingService.resolve_knn_method(n_points, knn_method)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = KNNGraphCache(directory)
+
+        start = time.perf_counter()
+        cache.get(data, 91, knn_method)
+        knn_seconds = time.perf_counter() - start
+
+        tsne_seconds = float("nan")
+        if not knn_only:
+            start = time.perf_counter()
+            EmbeddingService.tsne(data, perplexity=30, pca_components=None, backend=backend, cache=cache, seed=0, knn_method=knn_method)
+            tsne_seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{n_points:>10,} points  knn ({knn_method}) {knn_seconds:8.2f}s  t-SNE (cached knn) {tsne_seconds:8.2f}s  peak {peak_mb:8.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time t-SNE embeddings of synthetic data")
+    parser.add_argument("sizes", type=int, nargs="*", default=[10_000, 50_000, 160_000])
+    parser.add_argument("--backend", default="auto", help="t-SNE backend (default: auto)")
+    parser.add_argument("--knn", default="auto", choices=["auto", "exact", "approximate"], help="kNN method (default: auto)")
+    parser.add_argument("--knn-only", action="store_true", help="only time the kNN graph")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.backend, args.knn, args.knn_only, args.sizes[0])
+        return
+
+    print(f"backend: {args.backend}")
+    for n_points in args.sizes:
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run", "--backend", args.backend, "--knn", args.knn,
+             *(["--knn-only"] if args.knn_only else []), str(n_points)],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
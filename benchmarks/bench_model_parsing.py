@@ -0,0 +1,109 @@
+"""
+benchmarks/bench_model_parsing.py
+
+Compares the per-record SectionDataSet parsing path with the bulk TypeAdapter path on a synthetic RMA response.
+
+Usage:
+    PYTHONPATH=brainstem_application python benchmarks/bench_model_parsing.py [number of records]
+"""
+
+import sys
+import json
+import time
+
+from models import RMAResponse, SectionDataSet, SectionDataSetList
+
+
+def make_response(count: int) -> bytes:
+    """Build a synthetic SectionDataSet RMA response with one gene and a plane of section per record"""
+    records = [
+        {
+            "blue_channel": None,
+            "delegate": True,
+            "expression": True,
+            "failed": False,
+            "failed_facet": 734881840,
+            "green_channel": None,
+            "id": 69782969 + i,
+            "name": None,
+            "plane_of_section_id": 1,
+            "qc_date": "2009-05-02T22:48:46Z",
+            "red_channel": None,
+            "reference_space_id": 10,
+            "rnaseq_design_id": None,
+            "section_thickness": 25,
+            "specimen_id": 69370910,
+            "sphinx_id": 33103,
+            "storage_directory": f"/external/aibssan/production32/prod329/image_series_{69782969 + i}/",
+            "weight": 5470,
+            "genes": [
+                {
+                    "acronym": f"Gene{i}",
+                    "alias_tags": None,
+                    "chromosome_id": 1,
+                    "ensembl_id": None,
+                    "entrez_id": 10000 + i,
+                    "genomic_reference_update_id": 491928275,
+                    "homologene_id": 1000 + i,
+                    "id": i,
+                    "legacy_ensembl_gene_id": None,
+                    "name": f"gene {i}",
+                    "organism_id": 2,
+                    "original_name": f"gene {i}",
+                    "original_symbol": f"Gene{i}",
+                    "reference_genome_id": None,
+                    "sphinx_id": 100000 + i,
+                    "version_status": "no change",
+                }
+            ],
+            "plane_of_section": {"id": 1, "name": "coronal", "plane_of_section_name_facet": 1},
+        }
+        for i in range(count)
+    ]
+    return json.dumps({"success": True, "id": 0, "start_row": 0, "num_rows": count, "total_rows": count, "msg": records}).encode()
+
+
+def per_record(content: bytes) -> list:
+    return [SectionDataSet(**section) for section in json.loads(content)["msg"]]
+
+
+def bulk_list(content: bytes) -> list:
+    return SectionDataSetList.validate_python(json.loads(content)["msg"])
+
+
+def bulk_response(content: bytes) -> list:
+    return RMAResponse[SectionDataSet].model_validate_json(content).msg
+
+
+def best_of(func, content: bytes, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(content)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    content = make_response(count)
+
+    timings = [
+        (name, best_of(func, content))
+        for name, func in [
+            ("per-record SectionDataSet(**section)", per_record),
+            ("TypeAdapter(list[SectionDataSet]) on dicts", bulk_list),
+            ("RMAResponse[SectionDataSet] from JSON bytes", bulk_response),
+        ]
+    ]
+    baseline = timings[0][1]
+
+    print(f"{count} records, {len(content) / 1024 ** 2:.1f} MiB of JSON")
+    print(f"{'path':<45}{'time':>10}{'records/s':>14}{'speedup':>9}")
+
+    for name, elapsed in timings:
+        print(f"{name:<45}{elapsed * 1000:>8.1f}ms{count / elapsed:>14,.0f}{baseline / elapsed:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
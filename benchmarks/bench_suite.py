@@ -0,0 +1,332 @@
+"""
+benchmarks/bench_suite.py
+
+Benchmarks the data retrieval, export and analysis paths against a local stand-in of the Allen Brain Atlas API,
+which serves synthetic deflated grid expression zips and RMA JSON. Each benchmark reports its throughput and the
+peak resident memory of the process it ran in, and is compared with the baselines in benchmarks/baselines.json.
+Every benchmark runs in its own subprocess, so the peak memory of one does not hide the next.
+
+Usage:
+    PYTHONPATH=brainstem_application:. python benchmarks/bench_suite.py [--update-baselines] [--tolerance 0.3] [benchmark ...]
+
+Without benchmark names, every benchmark runs. The process exits with status 1 when a benchmark fails, or when its
+throughput drops, or its peak memory grows, by more than the tolerance relative to its baseline. Only the
+benchmarks of optional packages are skipped when the package is not installed. Baselines depend on the
+machine they were recorded on, so record them again with --update-baselines before checking a different machine.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import zipfile
+import platform
+import resource
+import tempfile
+import subprocess
+from unittest import mock
+
+import numpy as np
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# voxels of a volume of the 200 µm P56 grid, the reference space most grid expression data is in
+N_VOXELS = 67 * 41 * 58
+MEASUREMENTS = ["energy", "density"]
+N_ZIP_VARIANTS = 8
+REPEATS = 3
+
+
+class BenchmarkSkipped(Exception):
+    """Raised by a benchmark of an optional feature whose dependency is not installed"""
+
+
+def make_volume(rng: np.random.Generator) -> np.ndarray:
+    """Build a volume with no data (-1) outside a brain-shaped share of the voxels, like the Allen volumes"""
+    volume = np.full(N_VOXELS, -1, dtype=np.float32)
+    inside = rng.random(N_VOXELS) < 0.4
+    volume[inside] = np.round(rng.lognormal(0, 1, int(inside.sum())), 3)
+    return volume
+
+
+def make_zip(rng: np.random.Generator) -> bytes:
+    """Build a deflated grid_data zip file holding a .raw file per measurement"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        for measurement in MEASUREMENTS:
+            zip_ref.writestr(f"{measurement}.raw", make_volume(rng).tobytes())
+    return buffer.getvalue()
+
+
+def grid_data_routes(n_datasets: int) -> dict:
+    """Serve one of a few synthetic zips for each of n_datasets section datasets"""
+    rng = np.random.default_rng(0)
+    zips = [make_zip(rng) for _ in range(N_ZIP_VARIANTS)]
+    return {f"/grid_data/download/{i}": (200, zips[i % N_ZIP_VARIANTS]) for i in range(n_datasets)}
+
+
+def rendered_rma_route(records: list, page_size: int):
+    """Serve the pages of an RMA query, rendered once so that serializing them is not part of the benchmark"""
+    pages = {
+        start_row: json.dumps({
+            "success": True,
+            "start_row": start_row,
+            "num_rows": len(records[start_row:start_row + page_size]),
+            "total_rows": len(records),
+            "msg": records[start_row:start_row + page_size],
+        }).encode()
+        for start_row in range(0, len(records) + 1, page_size)
+    }
+    return lambda query: (200, pages[int(query.get("start_row", ["0"])[0])])
+
+
+def section_datasets(n_datasets: int) -> list:
+    from models import SectionDataSet
+    from tests.unit.services.stand_in_server import make_gene_record, make_section_dataset_record
+
+    return [SectionDataSet(**make_section_dataset_record(i, genes=[make_gene_record(i)])) for i in range(n_datasets)]
+
+
+def stand_in_api(routes: dict):
+    """Start a stand-in server for the routes, and point the data retrieval service at it"""
+    from contextlib import ExitStack
+    from services.data.data_retrieval_service import DataRetrievalService
+    from tests.unit.services.stand_in_server import StandInServer
+
+    stack = ExitStack()
+    server = stack.enter_context(StandInServer(routes))
+    stack.enter_context(mock.patch.object(DataRetrievalService, "api_url", server.url))
+    return stack
+
+
+def timed(func, repeats: int = REPEATS) -> float:
+    """Run func a few times, returning the fastest time in seconds"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_grid_download_single() -> tuple[float, str]:
+    from services.data.data_retrieval_service import DataRetrievalService
+
+    n_datasets = 40
+    with stand_in_api(grid_data_routes(n_datasets)):
+        seconds = timed(lambda: [DataRetrievalService.get_grid_expression_data(i, MEASUREMENTS) for i in range(n_datasets)])
+    return n_datasets / seconds, "datasets/s"
+
+
+def bench_grid_download_batch() -> tuple[float, str]:
+    from services.data.data_retrieval_service import DataRetrievalService
+
+    datasets = section_datasets(200)
+    with stand_in_api(grid_data_routes(len(datasets))):
+        seconds = timed(lambda: DataRetrievalService.get_grid_expression_data_batch(datasets, MEASUREMENTS))
+    return len(datasets) / seconds, "datasets/s"
+
+
+def bench_grid_download_pipeline() -> tuple[float, str]:
+    from services.data.grid_expression_pipeline import GridExpressionPipeline
+
+    datasets = section_datasets(200)
+    with stand_in_api(grid_data_routes(len(datasets))):
+        seconds = timed(lambda: [None for _ in GridExpressionPipeline().iter_grid_expression_data(datasets, MEASUREMENTS)])
+    return len(datasets) / seconds, "datasets/s"
+
+
+def bench_zip_decode() -> tuple[float, str]:
+    from services.data.data_retrieval_service import DataRetrievalService
+
+    zips = [content for _, content in grid_data_routes(N_ZIP_VARIANTS).values()] * 25
+    seconds = timed(lambda: [DataRetrievalService._decode_grid_expression_data(content, MEASUREMENTS) for content in zips])
+    return len(zips) * len(MEASUREMENTS) * N_VOXELS * 4 / 1024 ** 2 / seconds, "MB/s"
+
+
+def bench_section_dataset_parsing() -> tuple[float, str]:
+    from constants import RMA_PAGE_SIZE
+    from services.data.data_retrieval_service import DataRetrievalService
+    from tests.unit.services.stand_in_server import make_gene_record, make_section_dataset_record
+
+    records = [make_section_dataset_record(i, genes=[make_gene_record(i)]) for i in range(20_000)]
+    routes = {"/api/v2/data/SectionDataSet/query.json": rendered_rma_route(records, RMA_PAGE_SIZE)}
+
+    def parse():
+        # every repeat downloads and validates the pages again
+        DataRetrievalService.get_request_cache().clear()
+        DataRetrievalService.get_section_dataset_ids_with_reference_space_id(9)
+
+    with stand_in_api(routes):
+        seconds = timed(parse)
+    return len(records) / seconds, "records/s"
+
+
+def bench_geneset_dedup() -> tuple[float, str]:
+    from constants import RMA_PAGE_SIZE
+    from services.data.data_retrieval_service import DataRetrievalService
+    from tests.unit.services.stand_in_server import make_gene_record
+
+    # a quarter of the genes repeat an acronym, like genes listed once per probe
+    records = [make_gene_record(i, acronym=f"Gene{i % 15_000}") for i in range(20_000)]
+    routes = {"/api/v2/data/Gene/query.json": rendered_rma_route(records, RMA_PAGE_SIZE)}
+
+    def dedup():
+        DataRetrievalService.get_request_cache().clear()
+        genes = DataRetrievalService.get_geneset_from_product(1)
+        # the deduplication of retrieve_geneset_prompt
+        return list({gene.acronym: gene for gene in genes}.values())
+
+    with stand_in_api(routes):
+        seconds = timed(dedup)
+    return len(records) / seconds, "genes/s"
+
+
+def export_benchmark(export_format: str, optional: bool = False):
+    def bench() -> tuple[float, str]:
+        from services.data.expression_matrix_store import ExpressionMatrixStore
+        from services.file_save_service import FileSaveService
+
+        # only the exporters of optional packages may be missing; any other one failing the suite
+        if export_format not in FileSaveService.get_export_formats():
+            raise (BenchmarkSkipped if optional else RuntimeError)(f"the {export_format} exporter is not available")
+
+        n_rows = 100
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as directory:
+            store = ExpressionMatrixStore.create(f"{directory}/store", ["energy"], N_VOXELS, capacity=n_rows)
+            for i in range(n_rows):
+                store.append(i, f"Gene{i}", {"energy": make_volume(rng)})
+            store.close()
+            store = ExpressionMatrixStore(f"{directory}/store")
+
+            with mock.patch("builtins.print"):
+                seconds = timed(lambda: FileSaveService.save_expression_matrix(store, "energy", f"{directory}/export", export_format), repeats=1)
+        return n_rows * N_VOXELS * 4 / 1024 ** 2 / seconds, "MB/s"
+
+    return bench
+
+
+def pca_benchmark(mode: str):
+    def bench() -> tuple[float, str]:
+        from services.analysis.pca_service import PCAService
+
+        # a low-rank gene x voxel matrix with noise
+        rng = np.random.default_rng(0)
+        n_genes, n_voxels = 2000, 20_000
+        matrix = (rng.standard_normal((n_genes, 20), dtype=np.float32) @ rng.standard_normal((20, n_voxels), dtype=np.float32))
+        matrix += rng.standard_normal((n_genes, n_voxels), dtype=np.float32)
+
+        seconds = timed(lambda: PCAService.fit(matrix, 20, mode=mode, seed=0), repeats=1)
+        return n_genes / seconds, "genes/s"
+
+    return bench
+
+
+BENCHMARKS = {
+    "grid_download_single": bench_grid_download_single,
+    "grid_download_batch": bench_grid_download_batch,
+    "grid_download_pipeline": bench_grid_download_pipeline,
+    "zip_decode": bench_zip_decode,
+    "section_dataset_parsing": bench_section_dataset_parsing,
+    "geneset_dedup": bench_geneset_dedup,
+    "export_csv": export_benchmark("csv"),
+    "export_npy": export_benchmark("npy"),
+    "export_npz": export_benchmark("npz"),
+    "export_parquet": export_benchmark("parquet", optional=True),
+    "export_hdf5": export_benchmark("hdf5", optional=True),
+    "pca_exact": pca_benchmark("exact"),
+    "pca_randomized": pca_benchmark("randomized"),
+}
+
+
+def run(name: str):
+    """Run one benchmark and print its result as a JSON line"""
+    random.seed(0)
+    try:
+        throughput, unit = BENCHMARKS[name]()
+    except BenchmarkSkipped as e:
+        print(json.dumps({"skipped": str(e)}))
+        return
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"throughput": round(throughput, 2), "unit": unit, "peak_mb": round(peak_mb, 1)}))
+
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE) as file:
+        return json.load(file)["benchmarks"]
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """List how a result regressed from its baseline"""
+    regressions = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {result['throughput']:,.1f} < {baseline['throughput']:,.1f} {result['unit']}")
+    if result["peak_mb"] > baseline["peak_mb"] * (1 + tolerance):
+        regressions.append(f"peak memory {result['peak_mb']:,.0f} > {baseline['peak_mb']:,.0f} MB")
+    return regressions
+
+
+def main():
+    arguments = sys.argv[1:]
+    if len(arguments) == 2 and arguments[0] == "--run":
+        run(arguments[1])
+        return
+
+    update_baselines = "--update-baselines" in arguments
+    tolerance = 0.3
+    if "--tolerance" in arguments:
+        tolerance = float(arguments[arguments.index("--tolerance") + 1])
+    names = [argument for argument in arguments if argument in BENCHMARKS] or list(BENCHMARKS)
+
+    baselines = load_baselines()
+    results = {}
+    failed = False
+    errored = False
+
+    print(f"{'benchmark':<26}{'throughput':>22}{'peak':>10}{'baseline':>22}  status")
+    for name in names:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", name], capture_output=True, text=True)
+        if process.returncode != 0:
+            # a process killed by a signal, e.g. by the OOM killer, has no traceback on stderr
+            stderr = process.stderr.strip().splitlines()
+            print(f"{name:<26}{'':>54}  error: {stderr[-1] if stderr else f'exited with status {process.returncode}'}")
+            errored = True
+            continue
+
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        if "skipped" in result:
+            print(f"{name:<26}{'':>54}  skipped: {result['skipped']}")
+            continue
+        results[name] = result
+
+        baseline = baselines.get(name)
+        regressions = compare(result, baseline, tolerance) if baseline is not None else []
+        failed = failed or len(regressions) > 0
+        status = "; ".join(regressions) if regressions else ("ok" if baseline is not None else "no baseline")
+        baseline_str = f"{baseline['throughput']:,.1f} {baseline['unit']}" if baseline is not None else "-"
+
+        print(f"{name:<26}{result['throughput']:>12,.1f} {result['unit']:<9}{result['peak_mb']:>7,.0f} MB{baseline_str:>22}  {status}")
+
+    if update_baselines:
+        with open(BASELINES_FILE, "w") as file:
+            json.dump(
+                {"machine": f"{platform.machine()}, {os.cpu_count()} CPUs, Python {platform.python_version()}", "benchmarks": {**baselines, **results}},
+                file,
+                indent=2,
+            )
+            file.write("\n")
+        print(f"Baselines written to {BASELINES_FILE}")
+
+    # a regression is expected when the baselines are being updated, a benchmark failing never is
+    if errored or (failed and not update_baselines):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+"""cli.py
+Non-interactive command-line interface, for running pulls and analyses headless, e.g. from a job script on a
+compute node. It drives the same services as the menus of main.py.
+
+Example:
+
+```
+python brainstem_application/cli.py fetch-grid --reference-space 10 --plane coronal --measures energy,density --workers 16 --out store/
+python brainstem_application/cli.py fetch-grid --reference-space 10 --shard 0/4 --out store/
+python brainstem_application/cli.py merge-stores --store store/
+```
+"""
+
+import sys
+import sqlite3
+import argparse
+from typing import TYPE_CHECKING, Optional
+
+from utils.printer import Printer
+from utils.profiler import TRACER
+from utils.number_formatter import comma_separated_number
+from constants import (
+    DATABASE_FILE,
+    DATA_GENERATED_EXPRESSION_STORE_DIR,
+    DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR,
+    DATA_GENERATED_PCA_DIR,
+    GRID_DOWNLOAD_MAX_WORKERS,
+    GRID_MEASUREMENTS,
+    GRID_PIPELINE_PROCESSES,
+    TRACE_EVENTS_FILE,
+    TRACE_METRICS_FILE,
+    PlaneOfSection,
+)
+
+# the services pull in numpy, pandas and requests, so they are imported by the commands that use them
+if TYPE_CHECKING:
+    from models import SectionDataSet
+
+PLANES_OF_SECTION = {
+    "coronal": PlaneOfSection.CORONAL,
+    "sagittal": PlaneOfSection.SAGITTAL,
+}
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parse a shard given as "i/n", the i-th of n shards counting from 0
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must be given as "i/n", e.g. "0/4". Got "{value}"')
+
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}. Got {index}")
+
+    return index, count
+
+
+def parse_measures(value: str) -> list[str]:
+    """
+    Parse a comma separated list of grid expression measurements
+    """
+    measures = [measure.strip() for measure in value.split(",") if measure.strip()]
+    invalid = [measure for measure in measures if measure not in GRID_MEASUREMENTS]
+
+    if len(measures) == 0 or len(invalid) > 0:
+        raise argparse.ArgumentTypeError(f"measures must be a comma separated list of {', '.join(GRID_MEASUREMENTS)}. Got \"{value}\"")
+
+    return list(dict.fromkeys(measures))
+
+
+def get_metadata_source(database: Optional[str], is_synced: str, key: int):
+    """
+    Get the local metadata database if it has synced the reference space or product, or the Allen Brain Atlas API
+    """
+    from services.data.data_retrieval_service import DataRetrievalService
+    from services.data.metadata_database_service import MetadataDatabaseService
+
+    if database is not None:
+        metadata_database = MetadataDatabaseService(sqlite3.connect(database, check_same_thread=False))
+        if getattr(metadata_database, is_synced)(key):
+            return metadata_database
+
+    return DataRetrievalService
+
+
+def get_section_datasets(args: argparse.Namespace) -> Optional[list["SectionDataSet"]]:
+    """
+    Get the section datasets of the reference space and plane of section of a command, with genes and without
+    failed ones
+    """
+    source = get_metadata_source(args.database, "is_reference_space_synced", args.reference_space)
+
+    return source.get_section_dataset_ids_with_reference_space_id(
+        args.reference_space,
+        delegate=not args.non_delegate,
+        should_contain_genes=True,
+        plane_of_section_id=PLANES_OF_SECTION[args.plane],
+        exclude_failed=True,
+    )
+
+
+def fetch_grid(args: argparse.Namespace) -> int:
+    """
+    Pull the grid expression data of the section datasets of a reference space into an expression matrix store
+    """
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+    from services.data.grid_expression_cache import GridExpressionCache
+    from services.data.grid_expression_pipeline import GridExpressionPipeline, shard_section_datasets
+
+    # each shard writes its own fragment of the store, which merge-stores puts back together
+    directory = args.out
+    if args.shard is not None:
+        directory = ExpressionMatrixStore.fragment_directory(args.out, *args.shard)
+
+    if ExpressionMatrixStore.exists(directory) and not (args.resume or args.overwrite):
+        Printer.error(f"A store already exists in {directory}. Pass --resume to append to it or --overwrite to replace it")
+        return 1
+
+    section_datasets = get_section_datasets(args)
+    if section_datasets is None:
+        return 1
+
+    if args.shard is not None:
+        section_datasets = shard_section_datasets(section_datasets, *args.shard)
+        Printer.info(f"Shard {args.shard[0]}/{args.shard[1]}: {comma_separated_number(len(section_datasets))} section datasets")
+
+    store = None
+    if args.resume and ExpressionMatrixStore.exists(directory):
+        store = ExpressionMatrixStore(directory, mode="r+")
+        if sorted(store.measurements) != sorted(args.measures):
+            Printer.error(f"The store in {directory} holds {', '.join(store.measurements)}, not {', '.join(args.measures)}")
+            store.close()
+            return 1
+        if (store.reference_space_id, store.plane_of_section_id) != (args.reference_space, PLANES_OF_SECTION[args.plane]):
+            Printer.error(
+                f"The store in {directory} holds reference space {store.reference_space_id}, plane of section "
+                f"{store.plane_of_section_id}, not reference space {args.reference_space}, plane of section {PLANES_OF_SECTION[args.plane]}"
+            )
+            store.close()
+            return 1
+        Printer.info(f"Resuming the pull of {comma_separated_number(store.n_rows)} section datasets in {directory}")
+
+    failures = []
+
+    def print_result(section_dataset: "SectionDataSet", error: Optional[Exception], completed: int, total: int):
+        gene = section_dataset.genes[0]
+        if error is not None:
+            failures.append(section_dataset.id)
+            Printer.error(f"Failed to retrieve grid expression data for {gene.acronym} ({completed}/{total}): {error}")
+        elif not args.quiet:
+            Printer.info(f"Retrieved grid expression data for {gene.acronym} ({completed}/{total})")
+
+    pipeline = GridExpressionPipeline(max_workers=args.workers, processes=args.processes, normalization=args.normalization)
+    cache = None if args.no_cache else GridExpressionCache()
+    try:
+        store = pipeline.pull(section_datasets, args.measures, directory, store=store, cache=cache, on_result=print_result)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if store is not None:
+        Printer.success(f"{comma_separated_number(store.n_rows)} section datasets stored in {directory}")
+    if len(failures) > 0:
+        Printer.error(f"Failed to retrieve {comma_separated_number(len(failures))} section datasets: {failures}")
+        return 1
+
+    return 0
+
+
+def list_section_datasets(args: argparse.Namespace) -> int:
+    """
+    Print the ID and gene of the section datasets of a reference space, one per line
+    """
+    from services.data.grid_expression_pipeline import shard_section_datasets
+
+    section_datasets = get_section_datasets(args)
+    if section_datasets is None:
+        return 1
+
+    if args.shard is not None:
+        section_datasets = shard_section_datasets(section_datasets, *args.shard)
+
+    for section_dataset in section_datasets:
+        genes = ",".join(gene.acronym for gene in section_dataset.genes or [])
+        print(f"{section_dataset.id}\t{genes}")
+
+    return 0
+
+
+def list_genes(args: argparse.Namespace) -> int:
+    """
+    Print the acronyms of the genes of a product, one per line
+    """
+    source = get_metadata_source(args.database, "is_product_synced", args.product)
+
+    genes = source.get_geneset_from_product(args.product)
+    if genes is None:
+        return 1
+
+    # remove duplicates in genes
+    for acronym in dict.fromkeys(gene.acronym for gene in genes):
+        print(acronym)
+
+    return 0
+
+
+def sync_metadata(args: argparse.Namespace) -> int:
+    """
+    Sync reference spaces and products into the local metadata database
+    """
+    from services.data.metadata_database_service import MetadataDatabaseService
+    from utils.amba_product_loader import get_list_of_amba_brain_atlas_products, get_list_of_amba_reference_spaces
+
+    reference_space_ids = args.reference_space or []
+    product_ids = args.product or []
+    if args.all:
+        reference_space_ids = [reference_space_id for reference_space_id, _ in get_list_of_amba_reference_spaces()]
+        product_ids = [product_id for product_id, _ in get_list_of_amba_brain_atlas_products()]
+
+    metadata_database = MetadataDatabaseService(sqlite3.connect(args.database, check_same_thread=False))
+
+    status = 0
+    for sync_method, keys, name, records in [
+        ("sync_reference_space", reference_space_ids, "reference space", "section datasets"),
+        ("sync_product", product_ids, "product", "genes"),
+    ]:
+        for key in keys:
+            try:
+                count = getattr(metadata_database, sync_method)(key)
+                Printer.success(f"Synced {comma_separated_number(count)} {records} of {name} {key}")
+            except Exception as e:
+                Printer.error(f"An error occurred while syncing {name} {key}: {e}")
+                status = 1
+
+    return status
+
+
+def merge_stores(args: argparse.Namespace) -> int:
+    """
+    Merge the fragments that the shards of a pull wrote into one store
+    """
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+
+    fragments = ExpressionMatrixStore.find_fragments(args.store)
+    if len(fragments) == 0:
+        Printer.error(f"No fragments found in {args.store}")
+        return 1
+    if len(fragments) > 1:
+        Printer.error(f"Fragments of pulls sharded {sorted(fragments)} ways found in {args.store}. Please keep one of them")
+        return 1
+
+    count, fragment_directories = next(iter(fragments.items()))
+    missing = [
+        index for index in range(count)
+        if ExpressionMatrixStore.fragment_directory(args.store, index, count) not in fragment_directories
+    ]
+    if len(missing) > 0 and not args.allow_missing:
+        Printer.error(f"Shards {missing} of {count} have no fragment in {args.store}")
+        return 1
+
+    out = args.out or args.store
+    store = ExpressionMatrixStore.merge(fragment_directories, out)
+
+    Printer.success(f"Merged {len(fragment_directories)} fragments of {comma_separated_number(store.n_rows)} section datasets into {out}")
+    return 0
+
+
+def mask_store(args: argparse.Namespace) -> int:
+    """
+    Drop the voxels without data in any section dataset from a store
+    """
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+    from services.data.reference_space_geometry import ReferenceSpaceGeometryRegistry
+    from services.data.voxel_mask import VoxelMask
+
+    store = ExpressionMatrixStore(args.store)
+
+    shape = None
+    if args.reference_space is not None:
+        geometry = ReferenceSpaceGeometryRegistry.get(args.reference_space)
+        shape = geometry.shape if geometry is not None and geometry.n_voxels == store.n_voxels else None
+
+    mask = VoxelMask.from_store(store, min_valid_rows=args.min_valid_rows, shape=shape)
+    mask.compact(store, args.out)
+
+    Printer.success(f"Kept {comma_separated_number(mask.n_valid)} of {comma_separated_number(mask.n_voxels)} voxels with expression data in {args.out}")
+    return 0
+
+
+def export_store(args: argparse.Namespace) -> int:
+    """
+    Export measurements of a store in the given format
+    """
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+    from services.file_save_service import FileSaveService
+
+    store = ExpressionMatrixStore(args.store)
+
+    for measurement in args.measures or store.measurements:
+        if measurement not in store.measurements:
+            Printer.error(f"The store in {args.store} does not hold {measurement}")
+            return 1
+        FileSaveService.save_expression_matrix(store, measurement, f"{args.out}_{measurement}", args.format)
+
+    return 0
+
+
+def perform_pca(args: argparse.Namespace) -> int:
+    """
+    Perform a PCA on the gene x voxel matrix of a measurement of a store, and save the result
+    """
+    import numpy as np
+    from services.analysis.pca_service import PCAService
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+
+    store = ExpressionMatrixStore(args.store)
+    if args.measure not in store.measurements:
+        Printer.error(f"The store in {args.store} does not hold {args.measure}")
+        return 1
+
+    matrix = store.matrix(args.measure)
+    try:
+        result = PCAService.fit(matrix, args.components, mode=args.mode, seed=args.seed)
+    except ValueError as e:
+        Printer.error(str(e))
+        return 1
+
+    directory = args.out or f"{DATA_GENERATED_PCA_DIR}/{args.measure}"
+    result.save(directory)
+    np.save(f"{directory}/scores.npy", PCAService.transform(result, matrix))
+
+    for i, ratio in enumerate(result.explained_variance_ratio):
+        Printer.print(f"PC{i + 1}: {ratio:.2%} of the variance")
+    Printer.info(f"PCA saved to {directory}")
+    return 0
+
+
+def add_section_dataset_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the arguments that select the section datasets of a reference space
+    """
+    parser.add_argument("--reference-space", type=int, required=True, help="ID of the reference space")
+    parser.add_argument("--plane", choices=list(PLANES_OF_SECTION), default="coronal", help="plane of section (default: coronal)")
+    parser.add_argument("--non-delegate", action="store_true", help="select the non-delegate section datasets instead of the delegates")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N", help="only select the I-th of N shards of the section datasets, counting from 0, by a hash of their ID")
+    parser.add_argument("--database", default=DATABASE_FILE, help="local metadata database, used when the reference space is synced")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="brainstem", description="Retrieve and analyse Allen Brain Atlas grid expression data")
+    parser.add_argument("--profile", action="store_true", help="print where the time went when the command ends")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fetch = commands.add_parser("fetch-grid", help="pull grid expression data into an expression matrix store")
+    add_section_dataset_arguments(fetch)
+    fetch.add_argument("--measures", type=parse_measures, default=["energy"], help=f"comma separated measurements, of {', '.join(GRID_MEASUREMENTS)} (default: energy)")
+    fetch.add_argument("--workers", type=int, default=GRID_DOWNLOAD_MAX_WORKERS, help=f"concurrent downloads (default: {GRID_DOWNLOAD_MAX_WORKERS})")
+    fetch.add_argument("--processes", type=int, default=GRID_PIPELINE_PROCESSES, help=f"decoding processes (default: {GRID_PIPELINE_PROCESSES})")
+    fetch.add_argument("--normalization", choices=["none", "log1p", "max"], default="none", help="normalization of the volumes (default: none)")
+    fetch.add_argument("--out", default=DATA_GENERATED_EXPRESSION_STORE_DIR, help="directory of the expression matrix store")
+    existing = fetch.add_mutually_exclusive_group()
+    existing.add_argument("--resume", action="store_true", help="append to the store in --out, skipping the section datasets it holds")
+    existing.add_argument("--overwrite", action="store_true", help="replace the store in --out")
+    fetch.add_argument("--no-cache", action="store_true", help="do not read or fill the grid expression cache")
+    fetch.add_argument("--quiet", action="store_true", help="only print failures and the summary")
+    fetch.set_defaults(func=fetch_grid)
+
+    section_datasets = commands.add_parser("section-datasets", help="list the section datasets of a reference space")
+    add_section_dataset_arguments(section_datasets)
+    section_datasets.set_defaults(func=list_section_datasets)
+
+    genes = commands.add_parser("genes", help="list the genes of a product")
+    genes.add_argument("--product", type=int, required=True, help="ID of the product")
+    genes.add_argument("--database", default=DATABASE_FILE, help="local metadata database, used when the product is synced")
+    genes.set_defaults(func=list_genes)
+
+    sync = commands.add_parser("sync-metadata", help="sync reference spaces and products into the local metadata database")
+    sync.add_argument("--reference-space", type=int, action="append", help="ID of a reference space to sync, can be repeated")
+    sync.add_argument("--product", type=int, action="append", help="ID of a product to sync, can be repeated")
+    sync.add_argument("--all", action="store_true", help="sync every reference space and product")
+    sync.add_argument("--database", default=DATABASE_FILE, help="local metadata database")
+    sync.set_defaults(func=sync_metadata)
+
+    merge = commands.add_parser("merge-stores", help="merge the fragments of a sharded pull into one store")
+    merge.add_argument("--store", default=DATA_GENERATED_EXPRESSION_STORE_DIR, help="--out of the sharded pull, which holds its fragments")
+    merge.add_argument("--out", help="directory of the merged store (default: --store)")
+    merge.add_argument("--allow-missing", action="store_true", help="merge even if some shards have no fragment")
+    merge.set_defaults(func=merge_stores)
+
+    mask = commands.add_parser("mask", help="drop the voxels without expression data from a store")
+    mask.add_argument("--store", default=DATA_GENERATED_EXPRESSION_STORE_DIR, help="directory of the store to mask")
+    mask.add_argument("--out", default=DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR, help="directory of the masked store")
+    mask.add_argument("--min-valid-rows", type=int, default=1, help="section datasets a voxel needs data in to be kept (default: 1)")
+    mask.add_argument("--reference-space", type=int, help="ID of the reference space, to map the kept voxels to grid coordinates")
+    mask.set_defaults(func=mask_store)
+
+    export = commands.add_parser("export", help="export the measurements of a store")
+    export.add_argument("--store", default=DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR, help="directory of the store to export")
+    export.add_argument("--format", default="csv", help="export format, e.g. csv, npy, npz, parquet or hdf5 (default: csv)")
+    export.add_argument("--measures", type=parse_measures, help="comma separated measurements to export (default: all)")
+    export.add_argument("--out", required=True, help="path prefix of the exported files, suffixed with the measurement")
+    export.set_defaults(func=export_store)
+
+    pca = commands.add_parser("pca", help="perform a PCA on a measurement of a store")
+    pca.add_argument("--store", default=DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR, help="directory of the store to analyse")
+    pca.add_argument("--measure", choices=GRID_MEASUREMENTS, required=True, help="measurement to analyse")
+    pca.add_argument("--components", type=int, required=True, help="number of principal components")
+    pca.add_argument("--mode", choices=["auto", "exact", "randomized", "incremental"], default="auto", help="PCA mode (default: auto)")
+    pca.add_argument("--seed", type=int, help="seed of the randomized PCA")
+    pca.add_argument("--out", help="directory of the result")
+    pca.set_defaults(func=perform_pca)
+
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    """
+    Run a command, returning its exit status: 0 on success, 1 if it failed
+    """
+    args = build_parser().parse_args(argv)
+
+    # keep every span for the Chrome trace only when one is written
+    TRACER.record_events = TRACE_EVENTS_FILE is not None
+
+    try:
+        status = args.func(args)
+    except (FileNotFoundError, ValueError) as e:
+        Printer.error(str(e))
+        status = 1
+
+    if args.profile and TRACER.stats():
+        Printer.print(f"\n{TRACER.summary()}\n")
+    if TRACE_METRICS_FILE is not None:
+        TRACER.write_json(TRACE_METRICS_FILE)
+    if TRACE_EVENTS_FILE is not None:
+        TRACER.write_chrome_trace(TRACE_EVENTS_FILE)
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,9 +15,123 @@ DATA_DIR = f"{ROOT_DIR}/data"
 DATA_TEMP_DIR = f"{DATA_DIR}/temp"
 DATA_GENERATED_DIR = f"{DATA_DIR}/generated"
 DATA_GENERATED_GENESET_DIR = f"{DATA_GENERATED_DIR}/geneset"
+DATA_GENERATED_EXPRESSION_STORE_DIR = f"{DATA_GENERATED_DIR}/expression_store"
+DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR = f"{DATA_GENERATED_DIR}/masked_expression_store"
+DATA_GENERATED_PCA_DIR = f"{DATA_GENERATED_DIR}/pca"
+DATA_GENERATED_TSNE_DIR = f"{DATA_GENERATED_DIR}/tsne"
+DATA_GENERATED_SIMILARITY_DIR = f"{DATA_GENERATED_DIR}/similarity"
+DATA_CACHE_DIR = f"{DATA_DIR}/cache"
+DATA_CACHE_GRID_EXPRESSION_DIR = f"{DATA_CACHE_DIR}/grid_expression"
+DATA_CACHE_KNN_DIR = f"{DATA_CACHE_DIR}/knn"
 
 LOGS_DIR = f"{ROOT_DIR}/logs"
 
+DATABASE_FILE = f"{ROOT_DIR}/sqlite3.db"
+
+# The activity log is rotated past this size, keeping this many rotated files
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUP_COUNT = 3
+
+# When set, the statistics of the hot path spans are written at exit to this JSON file, and the spans themselves
+# to this Chrome trace file (viewable in chrome://tracing or Perfetto)
+TRACE_METRICS_FILE = os.environ.get("BRAINSTEM_METRICS_FILE")
+TRACE_EVENTS_FILE = os.environ.get("BRAINSTEM_TRACE_FILE")
+
+# Allen Brain Atlas API Constants
+
+ALLEN_API_URL = "http://api.brain-map.org"
+
+# Maximum number of pooled HTTP connections shared by the data services
+HTTP_POOL_SIZE = 32
+
+# Defaults for concurrent grid expression data downloads
+GRID_DOWNLOAD_MAX_WORKERS = 8
+GRID_DOWNLOAD_MAX_RETRIES = 3
+GRID_DOWNLOAD_BACKOFF_FACTOR = 0.5
+
+# Measurements a grid expression zip can include
+GRID_MEASUREMENTS = ["energy", "density", "intensity"]
+
+# Grid expression zips are streamed in chunks into a buffer that spills to disk past this size
+GRID_DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+GRID_DOWNLOAD_SPOOL_MAX_BYTES = 16 * 1024 ** 2
+
+# Requests the async data retrieval service keeps in flight, and the minimum delay between the start of two
+# requests, in seconds
+ASYNC_MAX_CONCURRENT_REQUESTS = 8
+ASYNC_MIN_REQUEST_INTERVAL = 0.02
+
+# Seconds a cached RMA response is used before it is revalidated, and the number and total size of the responses
+# kept in memory
+REQUEST_CACHE_TTL = 60 * 60
+REQUEST_CACHE_MAX_ENTRIES = 128
+REQUEST_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Number of rows requested per page of an RMA query
+RMA_PAGE_SIZE = 2000
+
+# Worker processes that decode grid expression zips in the pipelined pull, and the shared memory slots each
+# of them can decode into before the consumer catches up
+GRID_PIPELINE_PROCESSES = max(1, min(8, (os.cpu_count() or 2) - 1))
+GRID_PIPELINE_SLOTS_PER_PROCESS = 2
+
+# Number of rows appended to an expression matrix store between checkpoints of its index
+EXPRESSION_STORE_CHECKPOINT_INTERVAL = 32
+
+# Rows copied at a time when merging expression matrix store fragments. A P56 row is 159,326 float32 voxels,
+# so a block of 64 rows is about 40 MB per measurement
+EXPRESSION_STORE_MERGE_BLOCK_SIZE = 64
+
+# Size bound of the on-disk grid expression data cache, in bytes
+GRID_EXPRESSION_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+# Cache hits whose access times are kept in memory before they are written to the cache index in one transaction
+GRID_EXPRESSION_CACHE_ACCESS_FLUSH_INTERVAL = 64
+
+# Rows of an expression matrix processed at a time by the analysis services
+PCA_BLOCK_SIZE = 1024
+VOXEL_MASK_BLOCK_SIZE = 1024
+
+# Largest matrix, in elements, that the "auto" PCA mode decomposes with an exact SVD
+PCA_EXACT_MAX_ELEMENTS = 50_000_000
+
+# Rows whose neighbours are searched at a time when computing a k-nearest-neighbour graph
+EMBEDDING_KNN_BLOCK_SIZE = 128
+
+# Rows from which the "auto" kNN method switches from the exact, quadratic, graph to an approximate one. On one
+# CPU, 91 neighbours of 50-dimensional points take 17s exact and 29s with Annoy at 50,000 rows, but 176s and 112s
+# at 160,000 rows
+EMBEDDING_APPROXIMATE_KNN_MIN_ROWS = 100_000
+
+# Rows of a matrix copied at a time when transposing it into a contiguous array, e.g. to embed voxels
+EMBEDDING_TRANSPOSE_BLOCK_SIZE = 256
+
+# Seed of the randomized PCA that reduces the input of an embedding when no seed is given, so the same input is
+# reduced to the same matrix and finds its cached kNN graph
+EMBEDDING_PCA_SEED = 0
+
+# Rows scored at a time by gene similarity queries
+SIMILARITY_BLOCK_SIZE = 4096
+
+# Principal components kept by the approximate gene similarity index, and how many times k candidates it
+# hands to the exact re-ranking
+SIMILARITY_INDEX_COMPONENTS = 64
+SIMILARITY_INDEX_CANDIDATES = 10
+
+# Expression grid of each reference space, by ID: the number of voxels along x (anterior-posterior),
+# y (dorsal-ventral) and z (left-right), and the voxel size in micrometers
+REFERENCE_SPACE_GRIDS = {
+    1: ((70, 75, 40), (80, 80, 80)),  # E11.5
+    2: ((89, 109, 69), (100, 100, 100)),  # E13.5
+    3: ((94, 132, 65), (120, 120, 120)),  # E15.5
+    5: ((67, 43, 40), (140, 140, 140)),  # E18.5
+    6: ((77, 43, 50), (160, 160, 160)),  # P4
+    7: ((68, 40, 50), (200, 200, 200)),  # P14
+    8: ((73, 41, 53), (200, 200, 200)),  # P28
+    9: ((67, 41, 58), (200, 200, 200)),  # P56
+    10: ((67, 41, 58), (200, 200, 200)),  # P56 (L/R Flipped)
+}
+
 AMBA_ATLAS_IDS = {
     "Mouse, P56, Coronal": 1,
     "Mouse, P56, Sagittal": 2,
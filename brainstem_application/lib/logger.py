@@ -5,6 +5,10 @@ lib/logger.py
 """
 
 import os
+import time
+import queue
+import atexit
+import threading
 from datetime import datetime
 from enum import Enum
 
@@ -31,6 +35,14 @@ class LogLevel(Enum):
         return LogLevel[level].value
 
 
+# level values by name, so that a log call validates and compares its level with a single lookup
+_LEVEL_VALUES = {level.name: level.value for level in LogLevel}
+
+# sentinels put on the queue of a queued logger, after the messages, to flush or stop its writer thread
+_FLUSH = object()
+_STOP = object()
+
+
 class Logger:
     """A Logger class for managing and recording log messages with varying severity levels.
 
@@ -66,8 +78,19 @@ class Logger:
         _should_log(level: str) -> bool:
             Determines if a message should be logged based on the current log level.
 
+        flush():
+            Writes the queued messages of a queued logger to the log file.
+
+        close():
+            Flushes and stops the writer thread of a queued logger.
+
         _write_to_file(message: str):
             Writes the log message to the specified log file.
+
+    In queued mode, log calls only put the message on a queue. A background thread writes the queued messages
+    in batches through a persistent file handle, once flush_interval seconds have passed or flush_size bytes are
+    pending, and flushes them on close() or when the interpreter exits. Messages are still printed to the console
+    immediately. With max_bytes, the log file is rotated to log_file.1, log_file.2, ... once it grows past it.
     """
 
     def __init__(
@@ -76,6 +99,11 @@ class Logger:
         log_file: str = None,
         log_level: str = "INFO",
         create_log_directory: bool = False,
+        queued: bool = False,
+        flush_interval: float = 1.0,
+        flush_size: int = 64 * 1024,
+        max_bytes: int = None,
+        backup_count: int = 3,
     ):
         """Initializes the Logger with the specified log file and log level.
 
@@ -84,6 +112,11 @@ class Logger:
             print_to_console (bool): Whether to print log messages to the console.
             log_file (str): The file path where log messages will be written.
             log_level (str): The minimum log level for messages to be recorded. Options include 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'.
+            queued (bool): Whether to write log messages on a background thread instead of on every call.
+            flush_interval (float): The longest time, in seconds, a queued message waits before being written.
+            flush_size (int): The number of pending bytes after which queued messages are written.
+            max_bytes (int): The size after which the log file is rotated. None never rotates it.
+            backup_count (int): The number of rotated log files to keep.
         """
         logger_found = Logger._verify_log_file(log_file)
 
@@ -94,9 +127,31 @@ class Logger:
             # create the directory if it doesn't exist
             os.makedirs(os.path.dirname(log_file), exist_ok=True)
 
+        if log_level not in _LEVEL_VALUES:
+            raise ValueError(f'[Logger]: log level not valid. Got "{str(log_level)}"')
+        if flush_interval <= 0 or flush_size <= 0:
+            raise ValueError("[Logger]: flush_interval and flush_size must be positive")
+        if max_bytes is not None and (max_bytes <= 0 or backup_count < 1):
+            raise ValueError("[Logger]: max_bytes and backup_count must be positive")
+
         self.print_to_console = print_to_console
         self.log_file = log_file
         self.log_level = log_level
+        self._level_value = _LEVEL_VALUES[log_level]
+        self.queued = queued
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self._queue = None
+        self._writer = None
+        self._file = None
+        if queued:
+            self._queue = queue.SimpleQueue()
+            self._writer = threading.Thread(target=self._write_queued_messages, name="logger-writer", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
 
     def log(self, message: str, level: str = "INFO"):
         """Logs a message with the specified severity level.
@@ -105,18 +160,29 @@ class Logger:
             message (str): The message to log.
             level (str): The severity level of the message. Options include 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'.
         """
+        level_value = _LEVEL_VALUES.get(level)
+        if level_value is None:
+            raise ValueError(f'[Logger]: log level not valid. Got "{str(level)}"')
         if not isinstance(message, str):
             raise ValueError(
                 f'[Logger]: message must be a valid string. Got "{type(message)}"'
             )
-        if level not in LogLevel.__members__:
-            raise ValueError(f'[Logger]: log level not valid. Got "{str(level)}"')
 
-        if self._should_log(level):
-            message = f"{datetime.now().isoformat()} [{level}] {message}"
-            self._write_to_file(message)
+        if level_value < self._level_value:
+            return
+
+        if self._queue is not None:
+            # the message is formatted by the writer thread, only its time is taken here
+            created = time.time()
+            self._queue.put((created, level, message))
             if self.print_to_console:
-                print(message)
+                print(Logger._format(created, level, message))
+            return
+
+        message = f"{datetime.now().isoformat()} [{level}] {message}"
+        self._write_to_file(message)
+        if self.print_to_console:
+            print(message)
 
     def debug(self, message: str):
         """Logs a debug-level message.
@@ -164,7 +230,29 @@ class Logger:
         Args:
             level (str): The minimum log level for messages to be recorded. Options include 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'.
         """
+        if level not in _LEVEL_VALUES:
+            raise ValueError(f'[Logger]: log level not valid. Got "{str(level)}"')
+
         self.log_level = level
+        self._level_value = _LEVEL_VALUES[level]
+
+    def flush(self):
+        """Writes the queued messages of a queued logger to the log file, and waits until they are written."""
+        if self._writer is None or not self._writer.is_alive():
+            return
+
+        flushed = threading.Event()
+        self._queue.put((_FLUSH, flushed))
+        flushed.wait()
+
+    def close(self):
+        """Flushes and stops the writer thread of a queued logger. Messages logged afterwards are dropped."""
+        if self._writer is None or not self._writer.is_alive():
+            return
+
+        self._queue.put((_STOP, None))
+        self._writer.join()
+        atexit.unregister(self.close)
 
     def _should_log(self, level: str) -> bool:
         """Determines if a message should be logged based on the current log level.
@@ -175,7 +263,7 @@ class Logger:
         Returns:
             bool: True if the message should be logged, False otherwise.
         """
-        return LogLevel.get_level(level) >= LogLevel.get_level(self.log_level)
+        return _LEVEL_VALUES[level] >= self._level_value
 
     def _write_to_file(self, message: str):
         """Writes the log message to the specified log file.
@@ -183,9 +271,75 @@ class Logger:
         Args:
             message (str): The message to log.
         """
+        if self.max_bytes is not None and os.path.exists(self.log_file) and os.path.getsize(self.log_file) >= self.max_bytes:
+            self._rotate()
+
         with open(self.log_file, "a") as f:
             f.write(f"{message}\n")
 
+    def _write_queued_messages(self):
+        """Writes the queued messages in batches through a persistent file handle. Runs on the writer thread."""
+        self._file = open(self.log_file, "a")
+        size = self._file.tell()
+        pending = []
+        pending_bytes = 0
+        first_pending_at = None
+
+        try:
+            while True:
+                try:
+                    if pending:
+                        item = self._queue.get(timeout=max(0.0, first_pending_at + self.flush_interval - time.monotonic()))
+                    else:
+                        item = self._queue.get()
+                except queue.Empty:
+                    # the oldest pending message has waited flush_interval seconds
+                    item = None
+
+                command = None
+                if item is not None and (item[0] is _FLUSH or item[0] is _STOP):
+                    command, flushed = item
+                elif item is not None:
+                    line = f"{Logger._format(*item)}\n"
+                    if not pending:
+                        first_pending_at = time.monotonic()
+                    pending.append(line)
+                    pending_bytes += len(line)
+
+                if pending and (item is None or command is not None or pending_bytes >= self.flush_size):
+                    if self.max_bytes is not None and size >= self.max_bytes:
+                        self._file.close()
+                        self._rotate()
+                        self._file = open(self.log_file, "a")
+                        size = 0
+
+                    self._file.write("".join(pending))
+                    self._file.flush()
+                    size += pending_bytes
+                    pending = []
+                    pending_bytes = 0
+
+                if command is _FLUSH:
+                    flushed.set()
+                elif command is _STOP:
+                    return
+        finally:
+            self._file.close()
+
+    def _rotate(self):
+        """Renames the log file to log_file.1, shifting the older rotated files and dropping the oldest one."""
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.log_file}.{i}"):
+                os.replace(f"{self.log_file}.{i}", f"{self.log_file}.{i + 1}")
+
+        if os.path.exists(self.log_file):
+            os.replace(self.log_file, f"{self.log_file}.1")
+
+    @staticmethod
+    def _format(created: float, level: str, message: str) -> str:
+        """Formats a log message with the time it was logged at."""
+        return f"{datetime.fromtimestamp(created).isoformat()} [{level}] {message}"
+
     @staticmethod
     def _verify_log_file(log_file: str) -> bool:
         """Verifies that the log file is valid and can be written to."""
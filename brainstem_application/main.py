@@ -2,28 +2,56 @@
 
 import sys
 import sqlite3
+from typing import Optional
 from lib.logger import Logger, LogLevel
 
 from utils.menu import Menu
 from utils.printer import Printer
-from utils.menu_presets import DATA_RETRIEVAL_MENU
-from constants import ROOT_DIR
+from utils.profiler import TRACER
+from utils.menu_presets import DATA_RETRIEVAL_MENU, find_coexpressed_genes_prompt, perform_pca_prompt, perform_tsne_prompt, set_metadata_database_connection
+from constants import ROOT_DIR, DATABASE_FILE, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUP_COUNT, TRACE_METRICS_FILE, TRACE_EVENTS_FILE
 
 
-from services.data.data_retrieval_service import DataRetrievalService
+LOG_LEVEL_CONTEXT = LogLevel.DEBUG.name
 
+# the decoding processes of the grid expression pipeline are spawned, and re-import this script as __mp_main__,
+# so the logger and its writer thread are only created when it runs as the program
+logger: Optional[Logger] = None
 
-LOG_LEVEL_CONTEXT = LogLevel.DEBUG.name
-logger = Logger(
-    log_file=f"{ROOT_DIR}/logs/activity.log",
-    log_level=LOG_LEVEL_CONTEXT,
-    create_log_directory=True,
-)
+
+def create_logger() -> Logger:
+    """Creates the logger of the session, which writes from a background thread"""
+
+    return Logger(
+        log_file=f"{ROOT_DIR}/logs/activity.log",
+        log_level=LOG_LEVEL_CONTEXT,
+        create_log_directory=True,
+        queued=True,
+        max_bytes=LOG_FILE_MAX_BYTES,
+        backup_count=LOG_FILE_BACKUP_COUNT,
+    )
+
+
+def report_traces():
+    """Prints where the time of the session went, and writes the trace files that were asked for"""
+
+    if not TRACER.stats():
+        return
+
+    Printer.print(f"\n{TRACER.summary()}\n")
+
+    if TRACE_METRICS_FILE is not None:
+        TRACER.write_json(TRACE_METRICS_FILE)
+        Printer.info(f"Span statistics written to {TRACE_METRICS_FILE}")
+    if TRACE_EVENTS_FILE is not None:
+        TRACER.write_chrome_trace(TRACE_EVENTS_FILE)
+        Printer.info(f"Chrome trace written to {TRACE_EVENTS_FILE}")
 
 
 def exit_program():
     """Logs the ending of the program"""
 
+    report_traces()
     Printer.error("Exiting program...")
     logger.debug("Ending application...")
 
@@ -36,7 +64,8 @@ def main():
     logger.debug("Starting application...")
 
     # Create SQLite database connection
-    db_connection = sqlite3.connect("sqlite3.db")
+    db_connection = sqlite3.connect(DATABASE_FILE)
+    set_metadata_database_connection(db_connection)
 
     options = {
         "Data Services": lambda: Menu(
@@ -45,8 +74,9 @@ def main():
             },
             "Which data service would you like to access?",
         ).run(),
-        "Perform PCA": lambda: print("Performing PCA"),
-        "Perform t-SNE": lambda: print("Performing t-SNE"),
+        "Perform PCA": perform_pca_prompt,
+        "Perform t-SNE": perform_tsne_prompt,
+        "Find Co-expressed Genes": find_coexpressed_genes_prompt,
     }
 
     menu = Menu(options, include_exit=True, include_back=False)
@@ -59,4 +89,9 @@ def main():
 
 
 if __name__ == "__main__":
+    logger = create_logger()
+
+    # keep every span for the Chrome trace only when one is written
+    TRACER.record_events = TRACE_EVENTS_FILE is not None
+
     main()
@@ -1,5 +1,7 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, TypeAdapter
+from typing import Generic, Optional, TypeVar
+
+T = TypeVar("T")
 
 
 class PlaneOfSection(BaseModel):
@@ -93,3 +95,22 @@ class AMBAReferenceSpace(BaseModel):
     id: int
     organism_id: int
     storage_directory: str
+
+
+class RMAResponse(BaseModel, Generic[T]):
+    """
+    Represents the response of an RMA query. On success, msg holds the records of the page,
+    on failure it holds the error message
+    """
+
+    success: bool
+    id: Optional[int] = None
+    start_row: Optional[int] = None
+    num_rows: Optional[int] = None
+    total_rows: Optional[int] = None
+    msg: list[T] | str
+
+
+# Validate a whole list of records in a single call, straight from JSON bytes
+SectionDataSetList = TypeAdapter(list[SectionDataSet])
+GeneList = TypeAdapter(list[Gene])
@@ -0,0 +1,340 @@
+"""Embedding Service
+This module contains the EmbeddingService class, which computes t-SNE embeddings of genes or voxels.
+"""
+
+import os
+import hashlib
+import tempfile
+import importlib.util
+import numpy as np
+from typing import Optional
+
+from services.base import Service
+from services.analysis.pca_service import PCAService
+
+from constants import (
+    DATA_CACHE_DIR,
+    DATA_CACHE_KNN_DIR,
+    EMBEDDING_APPROXIMATE_KNN_MIN_ROWS,
+    EMBEDDING_KNN_BLOCK_SIZE,
+    EMBEDDING_PCA_SEED,
+    EMBEDDING_TRANSPOSE_BLOCK_SIZE,
+)
+
+EMBEDDING_BACKENDS = ["auto", "opentsne", "sklearn"]
+KNN_METHODS = ["auto", "exact", "approximate"]
+
+
+class KNNGraphCache:
+    """
+    Caches k-nearest-neighbour graphs on disk, keyed by a digest of the input data. A graph computed with
+    k neighbours also answers every query for fewer neighbours, so re-running t-SNE with a new perplexity
+    only recomputes the graph when the perplexity grows.
+    """
+
+    def __init__(self, directory: str = DATA_CACHE_KNN_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, data: np.ndarray, n_neighbors: int, method: str = "auto") -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the (indices, distances) of the n_neighbors nearest neighbours of every row, computing and
+        caching them if needed. Exact and approximate graphs are cached apart
+        """
+        method = EmbeddingService.resolve_knn_method(data.shape[0], method)
+        path = f"{self.directory}/{KNNGraphCache.digest(data)}-{method}.npz"
+
+        if os.path.exists(path):
+            with np.load(path) as graph:
+                if graph["indices"].shape[1] >= n_neighbors:
+                    return graph["indices"][:, :n_neighbors], graph["distances"][:, :n_neighbors]
+
+        indices, distances = EmbeddingService.compute_knn_graph(data, n_neighbors, method=method)
+        np.savez(path, indices=indices, distances=distances)
+        return indices, distances
+
+    @staticmethod
+    def digest(data: np.ndarray) -> str:
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        digest = hashlib.sha256(str(data.shape).encode())
+        digest.update(data.data)
+        return digest.hexdigest()
+
+
+class EmbeddingService(Service):
+    """
+    Computes t-SNE embeddings with approximate gradients, so they scale to every voxel of a reference space.
+
+    The input is optionally reduced with a randomized PCA first. Its k-nearest-neighbour graph, exact and
+    computed in blocks for small inputs, approximate with Annoy or NN-descent past
+    EMBEDDING_APPROXIMATE_KNN_MIN_ROWS rows, is cached on disk by KNNGraphCache, then handed to a t-SNE backend
+    as precomputed neighbours: openTSNE's FFT-accelerated interpolation if it is installed, or scikit-learn's Barnes-Hut
+    approximation otherwise. Both are optional dependencies.
+    """
+
+    def __init__(self):
+        super().__init__("Embedding Service")
+
+    @staticmethod
+    def available_backends() -> list[str]:
+        """
+        Get the t-SNE backends whose packages are installed
+        """
+        return [
+            backend
+            for backend, module in [("opentsne", "openTSNE"), ("sklearn", "sklearn")]
+            if importlib.util.find_spec(module) is not None
+        ]
+
+    @staticmethod
+    def tsne(
+        data: np.ndarray,
+        perplexity: float = 30.0,
+        n_components: int = 2,
+        pca_components: Optional[int] = 50,
+        backend: str = "auto",
+        cache: Optional[KNNGraphCache] = None,
+        seed: Optional[int] = None,
+        knn_method: str = "auto",
+    ) -> np.ndarray:
+        """
+        Embed the rows of a matrix with t-SNE. Returns an n_rows x n_components float32 array
+        """
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f'[EmbeddingService]: backend must be one of {EMBEDDING_BACKENDS}. Got "{backend}"')
+
+        available = EmbeddingService.available_backends()
+        if backend == "auto":
+            if len(available) == 0:
+                raise ImportError("[EmbeddingService]: t-SNE requires the optional 'openTSNE' or 'scikit-learn' package")
+            backend = available[0]
+        elif backend not in available:
+            raise ImportError(f"[EmbeddingService]: the {backend} backend is not installed")
+
+        n_samples = data.shape[0]
+        n_neighbors = min(n_samples - 1, int(3 * perplexity + 1))
+        if n_neighbors < 1:
+            raise ValueError("[EmbeddingService]: t-SNE needs at least two rows")
+        if backend == "sklearn":
+            # scikit-learn asks the graph for one extra neighbour, which it expects to be the row itself
+            n_neighbors = min(n_samples - 1, n_neighbors + 1)
+
+        data = EmbeddingService.reduce(data, pca_components, EMBEDDING_PCA_SEED if seed is None else seed)
+        indices, distances = (cache or KNNGraphCache()).get(data, n_neighbors, knn_method)
+
+        # a scaled PCA initialization, which preserves the global structure better than a random one
+        initialization = PCAService.transform(PCAService.fit(data, n_components, mode="randomized", seed=seed), data)
+        initialization = initialization / initialization[:, 0].std() * 1e-4
+
+        if backend == "opentsne":
+            return EmbeddingService._tsne_opentsne(indices, distances, perplexity, n_components, initialization, seed)
+        return EmbeddingService._tsne_sklearn(indices, distances, perplexity, n_components, initialization, seed)
+
+    @staticmethod
+    def reduce(data: np.ndarray, pca_components: Optional[int], seed: Optional[int] = EMBEDDING_PCA_SEED) -> np.ndarray:
+        """
+        Reduce a matrix to its first principal components, or return it as float32 if no reduction is needed
+        """
+        if pca_components is None or pca_components >= min(data.shape):
+            return np.asarray(data, dtype=np.float32)
+
+        result = PCAService.fit(data, pca_components, mode="randomized", seed=seed)
+        return PCAService.transform(result, data)
+
+    @staticmethod
+    def transpose(matrix: np.ndarray, block_size: int = EMBEDDING_TRANSPOSE_BLOCK_SIZE) -> np.ndarray:
+        """
+        Copy the transpose of a matrix into a C-contiguous float32 array, reading block_size rows at a time, so the
+        rows of the transpose, e.g. the voxels of a gene x voxel memmap, are not read as strided columns by every
+        pass over them. The copy is a memory-mapped temporary file, deleted once it is no longer referenced
+        """
+        os.makedirs(DATA_CACHE_DIR, exist_ok=True)
+        n_rows, n_columns = matrix.shape
+        # the memory map holds its own handle on the file, which is deleted once both are closed
+        with tempfile.TemporaryFile(dir=DATA_CACHE_DIR) as file:
+            transposed = np.memmap(file, dtype=np.float32, mode="w+", shape=(n_columns, n_rows))
+
+        for start in range(0, n_rows, block_size):
+            transposed[:, start:start + block_size] = np.asarray(matrix[start:start + block_size], dtype=np.float32).T
+
+        return transposed
+
+    @staticmethod
+    def approximate_knn_backend() -> Optional[str]:
+        """
+        Get the installed approximate nearest neighbour package: openTSNE, which bundles Annoy, or pynndescent
+        """
+        for module in ["openTSNE", "pynndescent"]:
+            if importlib.util.find_spec(module) is not None:
+                return module
+        return None
+
+    @staticmethod
+    def resolve_knn_method(n_rows: int, method: str = "auto") -> str:
+        """
+        Resolve the "auto" kNN method: approximate past EMBEDDING_APPROXIMATE_KNN_MIN_ROWS rows if a package for it
+        is installed, exact otherwise
+        """
+        if method not in KNN_METHODS:
+            raise ValueError(f'[EmbeddingService]: kNN method must be one of {KNN_METHODS}. Got "{method}"')
+        if method != "auto":
+            return method
+
+        if n_rows >= EMBEDDING_APPROXIMATE_KNN_MIN_ROWS and EmbeddingService.approximate_knn_backend() is not None:
+            return "approximate"
+        return "exact"
+
+    @staticmethod
+    def compute_knn_graph(
+        data: np.ndarray,
+        n_neighbors: int,
+        block_size: int = EMBEDDING_KNN_BLOCK_SIZE,
+        method: str = "auto",
+        seed: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the euclidean k-nearest-neighbour graph of the rows of a matrix, excluding each row itself.
+        The exact graph is computed a block of rows at a time, so memory is bounded by block_size x n_rows, but
+        time grows with n_rows squared. The approximate one is searched with Annoy or NN-descent
+        """
+        method = EmbeddingService.resolve_knn_method(data.shape[0], method)
+        data = np.ascontiguousarray(data, dtype=np.float32)
+
+        if method == "approximate":
+            return EmbeddingService._approximate_knn_graph(data, n_neighbors, seed)
+
+        n_samples = data.shape[0]
+        squared_norms = np.einsum("ij,ij->i", data, data)
+
+        indices = np.empty((n_samples, n_neighbors), dtype=np.int32)
+        distances = np.empty((n_samples, n_neighbors), dtype=np.float32)
+
+        for start in range(0, n_samples, block_size):
+            end = min(start + block_size, n_samples)
+            squared = squared_norms[start:end, None] + squared_norms[None, :] - 2 * data[start:end] @ data.T
+            squared[np.arange(end - start), np.arange(start, end)] = np.inf
+
+            nearest = np.argpartition(squared, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            nearest_squared = np.take_along_axis(squared, nearest, axis=1)
+            order = np.argsort(nearest_squared, axis=1)
+
+            indices[start:end] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:end] = np.sqrt(np.maximum(np.take_along_axis(nearest_squared, order, axis=1), 0))
+
+        return indices, distances
+
+    @staticmethod
+    def _approximate_knn_graph(data: np.ndarray, n_neighbors: int, seed: Optional[int]) -> tuple[np.ndarray, np.ndarray]:
+        backend = EmbeddingService.approximate_knn_backend()
+        if backend is None:
+            raise ImportError("[EmbeddingService]: the approximate kNN graph requires the optional 'openTSNE' or 'pynndescent' package")
+
+        if backend == "openTSNE":
+            from openTSNE.nearest_neighbors import Annoy
+
+            # Annoy leaves each row out of its own neighbours
+            indices, distances = Annoy(data, n_neighbors, random_state=seed, n_jobs=os.cpu_count() or 1).build()
+        else:
+            from pynndescent import NNDescent
+
+            # NN-descent returns each row as its own nearest neighbour, which is dropped
+            indices, distances = NNDescent(data, n_neighbors=n_neighbors + 1, random_state=seed).neighbor_graph
+            indices, distances = indices[:, 1:], distances[:, 1:]
+
+        return indices.astype(np.int32), distances.astype(np.float32)
+
+    @staticmethod
+    def conditional_probabilities(distances: np.ndarray, perplexity: float, n_steps: int = 100) -> np.ndarray:
+        """
+        Calibrate a Gaussian kernel on the neighbour distances of every row to the given perplexity, with a
+        vectorized binary search. Returns the n_rows x n_neighbors conditional probabilities of the neighbours
+        """
+        squared = distances.astype(np.float64) ** 2
+        # shifting by the nearest distance leaves the probabilities unchanged, and keeps the kernel from underflowing
+        squared = squared - squared[:, :1]
+        target_entropy = np.log(perplexity)
+
+        n_samples = distances.shape[0]
+        beta = np.ones(n_samples)
+        beta_min = np.full(n_samples, -np.inf)
+        beta_max = np.full(n_samples, np.inf)
+
+        for _ in range(n_steps):
+            weights = np.exp(-squared * beta[:, None])
+            weight_sum = weights.sum(axis=1)
+            entropy = np.log(weight_sum) + beta * ((weights * squared).sum(axis=1) / weight_sum)
+
+            if np.all(np.abs(entropy - target_entropy) < 1e-5):
+                break
+
+            too_flat = entropy > target_entropy
+            beta_min = np.where(too_flat, beta, beta_min)
+            beta_max = np.where(too_flat, beta_max, beta)
+            beta = np.where(
+                too_flat,
+                np.where(np.isinf(beta_max), beta * 2, (beta + beta_max) / 2),
+                np.where(np.isinf(beta_min), beta / 2, (beta + beta_min) / 2),
+            )
+
+        return weights / weight_sum[:, None]
+
+    @staticmethod
+    def joint_probabilities(indices: np.ndarray, distances: np.ndarray, perplexity: float, n_steps: int = 100):
+        """
+        Symmetrize the conditional probabilities of the neighbours into a sparse joint probability matrix.
+        Needs scipy, which the openTSNE backend that uses it depends on
+        """
+        from scipy.sparse import csr_matrix
+
+        n_samples, n_neighbors = indices.shape
+        conditional = EmbeddingService.conditional_probabilities(distances, perplexity, n_steps)
+
+        rows = np.repeat(np.arange(n_samples), n_neighbors)
+        probabilities = csr_matrix((conditional.ravel(), (rows, indices.ravel())), shape=(n_samples, n_samples))
+        probabilities = probabilities + probabilities.T
+
+        return probabilities / probabilities.sum()
+
+    @staticmethod
+    def _tsne_opentsne(indices, distances, perplexity, n_components, initialization, seed) -> np.ndarray:
+        import openTSNE
+
+        affinities = openTSNE.affinity.PrecomputedAffinities(
+            EmbeddingService.joint_probabilities(indices, distances, perplexity)
+        )
+        embedding = openTSNE.TSNE(n_components=n_components, random_state=seed, negative_gradient_method="fft" if n_components <= 2 else "bh").fit(
+            affinities=affinities, initialization=initialization.astype(np.float64)
+        )
+        return np.asarray(embedding, dtype=np.float32)
+
+    @staticmethod
+    def _tsne_sklearn(indices, distances, perplexity, n_components, initialization, seed) -> np.ndarray:
+        from scipy.sparse import csr_matrix
+        from sklearn.manifold import TSNE
+
+        n_samples, n_neighbors = indices.shape
+        # rows are already sorted by distance, which is the layout scikit-learn expects. It treats explicit
+        # zeros as missing neighbours, so duplicate rows get a tiny distance
+        graph = csr_matrix(
+            (np.maximum(distances.ravel(), 1e-12), indices.ravel(), np.arange(n_samples + 1) * n_neighbors),
+            shape=(n_samples, n_samples),
+        )
+
+        embedding = TSNE(
+            n_components=n_components,
+            perplexity=perplexity,
+            metric="precomputed",
+            method="barnes_hut",
+            init=initialization.astype(np.float32),
+            random_state=seed,
+        ).fit_transform(graph)
+        return np.asarray(embedding, dtype=np.float32)
+
+    def docs(self):
+        return "This service computes t-SNE embeddings of genes or voxels."
+
+    def startup(self):
+        pass
+
+    def cleanup(self):
+        pass
@@ -0,0 +1,222 @@
+"""Gene Similarity Service
+This module contains the GeneSimilarityService class, which finds the genes co-expressed with a gene in an expression matrix store.
+"""
+
+import os
+import json
+import numpy as np
+from typing import Optional
+
+from services.base import Service
+from services.analysis.pca_service import PCAService
+from services.data.expression_matrix_store import ExpressionMatrixStore
+
+from constants import (
+    DATA_GENERATED_SIMILARITY_DIR,
+    SIMILARITY_BLOCK_SIZE,
+    SIMILARITY_INDEX_COMPONENTS,
+    SIMILARITY_INDEX_CANDIDATES,
+)
+
+SIMILARITY_METRICS = ["pearson", "cosine"]
+
+
+class GeneSimilarityService(Service):
+    """
+    Answers top-k Pearson or cosine similarity queries between the rows of a measurement of a store.
+
+    Every row is normalized once into a float32 memmap: z-scored and divided by the square root of the number of
+    voxels for Pearson, scaled to unit length for cosine. Both similarities are then a plain dot product, so a query
+    is a blocked matrix multiply over the normalized rows followed by an argpartition. Voxels without data (-1)
+    are counted as no expression. The normalized rows are reused as long as the rows of the store are unchanged.
+
+    For interactive queries over tens of thousands of genes, build_index() projects the normalized rows onto
+    their first principal components. Indexed queries score every row in that small space, then re-rank only
+    the best candidates exactly.
+
+    Example:
+
+    ```python
+    similarity = GeneSimilarityService(store, "energy")
+    similarity.build_index()
+    similarity.query_gene("Pvalb", k=10)  # [(gene, section_dataset_id, similarity), ...]
+    ```
+    """
+
+    def __init__(
+        self,
+        store: ExpressionMatrixStore,
+        measurement: str,
+        metric: str = "pearson",
+        directory: str = DATA_GENERATED_SIMILARITY_DIR,
+        block_size: int = SIMILARITY_BLOCK_SIZE,
+    ):
+        super().__init__("Gene Similarity Service")
+
+        if metric not in SIMILARITY_METRICS:
+            raise ValueError(f'[GeneSimilarityService]: metric must be one of {SIMILARITY_METRICS}. Got "{metric}"')
+
+        self.store = store
+        self.measurement = measurement
+        self.metric = metric
+        self.directory = directory
+        self.block_size = block_size
+        self.index: Optional[np.ndarray] = None
+        self.index_components: Optional[np.ndarray] = None
+        self.index_mean: Optional[np.ndarray] = None
+        self.index_offsets: Optional[np.ndarray] = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.normalized = self._load_or_normalize()
+
+    @property
+    def n_rows(self) -> int:
+        return self.normalized.shape[0]
+
+    def query_gene(self, gene: str, k: int = 10, approximate: Optional[bool] = None) -> list[tuple[str, int, float]]:
+        """
+        Get the k rows most similar to the first row of a gene, excluding the rows of the gene itself
+        """
+        rows = self.store.rows_for_gene(gene)
+        if len(rows) == 0:
+            raise KeyError(f"[GeneSimilarityService]: gene {gene} is not in the store")
+
+        return self.query_row(rows[0], k, approximate, exclude=rows)
+
+    def query_row(
+        self, row: int, k: int = 10, approximate: Optional[bool] = None, exclude: Optional[list[int]] = None
+    ) -> list[tuple[str, int, float]]:
+        """
+        Get the k rows most similar to a row, as (gene, section dataset ID, similarity) tuples sorted by
+        decreasing similarity. The index is used if it was built, unless approximate is False
+        """
+        return self.query_rows([row], k, approximate, exclude)[0]
+
+    def query_rows(
+        self, rows: list[int], k: int = 10, approximate: Optional[bool] = None, exclude: Optional[list[int]] = None
+    ) -> list[list[tuple[str, int, float]]]:
+        """
+        Answer several row queries with one pass over the normalized rows
+        """
+        if approximate is None:
+            approximate = self.index is not None
+        if approximate and self.index is None:
+            raise ValueError("[GeneSimilarityService]: build_index() must be called before approximate queries")
+
+        queries = np.asarray(self.normalized[rows])
+        excluded = set(exclude or []) | set(rows)
+        # over-fetch by the excluded rows, so excluding them still leaves k results
+        n_results = min(k + len(excluded), self.n_rows)
+
+        if approximate:
+            # re-rank the candidates of the index exactly, reading them from the memmap in row order
+            candidates = np.sort(self._approximate_candidates(queries, n_results * SIMILARITY_INDEX_CANDIDATES), axis=1)
+            scores = np.stack(
+                [np.asarray(self.normalized[query_candidates]) @ query for query, query_candidates in zip(queries, candidates)]
+            )
+        else:
+            scores = self._scores(queries)
+            candidates = np.broadcast_to(np.arange(self.n_rows), scores.shape)
+
+        results = []
+        for query_scores, query_candidates in zip(scores, candidates):
+            matches = []
+            for i in GeneSimilarityService._top_k(query_scores, n_results):
+                row = int(query_candidates[i])
+                if row not in excluded:
+                    matches.append((self.store.genes[row], self.store.section_dataset_ids[row], float(query_scores[i])))
+            results.append(matches[:k])
+
+        return results
+
+    def build_index(self, n_components: int = SIMILARITY_INDEX_COMPONENTS, seed: Optional[int] = None):
+        """
+        Build the approximate index: the normalized rows projected onto their first principal components
+        """
+        n_components = min(n_components, *self.normalized.shape)
+        result = PCAService.fit(self.normalized, n_components, mode="randomized", block_size=self.block_size, seed=seed)
+
+        self.index_components = result.components.astype(np.float32)
+        self.index_mean = result.mean.astype(np.float32)
+        self.index = PCAService.transform(result, self.normalized, self.block_size)
+        # with x = mean + u, x . y = u . v + mean . y + (terms that are the same for every y), where u . v is
+        # approximated by the dot product of the projections
+        self.index_offsets = np.concatenate(
+            [
+                np.asarray(self.normalized[start:start + self.block_size]) @ self.index_mean
+                for start in range(0, self.n_rows, self.block_size)
+            ]
+        )
+
+    def _scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Compute the similarities of the queries to every row, a block of rows at a time
+        """
+        scores = np.empty((queries.shape[0], self.n_rows), dtype=np.float32)
+        for start in range(0, self.n_rows, self.block_size):
+            scores[:, start:start + self.block_size] = queries @ np.asarray(self.normalized[start:start + self.block_size]).T
+        return scores
+
+    def _approximate_candidates(self, queries: np.ndarray, n_candidates: int) -> np.ndarray:
+        """
+        Get the rows whose index projections are the most similar to each query
+        """
+        n_candidates = min(n_candidates, self.n_rows)
+        approximate_scores = ((queries - self.index_mean) @ self.index_components.T) @ self.index.T + self.index_offsets
+        return np.stack([GeneSimilarityService._top_k(scores, n_candidates) for scores in approximate_scores])
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Get the indices of the k highest scores, sorted by decreasing score
+        """
+        if k < scores.size:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(scores.size)
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def _load_or_normalize(self) -> np.ndarray:
+        """
+        Open the normalized rows of the measurement, normalizing them again if the store has changed
+        """
+        path = f"{self.directory}/{self.measurement}.{self.metric}.f32"
+        metadata_path = f"{self.directory}/{self.measurement}.{self.metric}.json"
+        shape = (self.store.n_rows, self.store.n_voxels)
+        metadata = {"store": os.path.abspath(self.store.directory), "shape": list(shape), "section_dataset_ids": self.store.section_dataset_ids}
+
+        # an empty file cannot be memory-mapped, and an empty store has nothing to normalize
+        if self.store.n_rows == 0:
+            return np.zeros(shape, dtype=np.float32)
+
+        if os.path.exists(path) and os.path.exists(metadata_path):
+            with open(metadata_path, "r") as file:
+                if json.load(file) == metadata:
+                    return np.memmap(path, dtype=np.float32, mode="r", shape=shape)
+
+        normalized = np.memmap(path, dtype=np.float32, mode="w+", shape=shape)
+        matrix = self.store.matrix(self.measurement)
+
+        for start in range(0, self.store.n_rows, self.block_size):
+            block = np.maximum(np.asarray(matrix[start:start + self.block_size], dtype=np.float32), 0)
+            if self.metric == "pearson":
+                block = block - block.mean(axis=1, keepdims=True)
+
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            # constant rows have no direction, so they are similar to nothing
+            normalized[start:start + self.block_size] = np.divide(block, norms, out=np.zeros_like(block), where=norms > 0)
+
+        normalized.flush()
+        with open(metadata_path, "w") as file:
+            json.dump(metadata, file)
+
+        return np.memmap(path, dtype=np.float32, mode="r", shape=shape)
+
+    def docs(self):
+        return "This service finds the genes co-expressed with a gene in an expression matrix store."
+
+    def startup(self):
+        pass
+
+    def cleanup(self):
+        pass
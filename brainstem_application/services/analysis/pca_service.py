@@ -0,0 +1,278 @@
+"""PCA Service
+This module contains the PCAService class, which performs principal component analysis on gene x voxel expression matrices.
+"""
+
+import os
+import numpy as np
+from typing import Optional
+
+from services.base import Service
+
+from constants import PCA_BLOCK_SIZE, PCA_EXACT_MAX_ELEMENTS
+
+PCA_MODES = ["auto", "exact", "randomized", "incremental"]
+
+
+class PCAResult:
+    """
+    The result of a PCA. Rows of the input are samples and columns are features, so for a gene x voxel
+    matrix the components are voxel loadings and the scores are gene coordinates.
+
+    Attributes:
+        components (np.ndarray): n_components x n_features principal axes.
+        explained_variance (np.ndarray): Variance explained by each component.
+        explained_variance_ratio (np.ndarray): Fraction of the total variance explained by each component.
+        mean (np.ndarray): Per-feature mean subtracted before projecting.
+        n_samples (int): Number of rows the PCA was fitted on.
+        mode (str): The mode the PCA was computed with.
+    """
+
+    def __init__(
+        self,
+        components: np.ndarray,
+        explained_variance: np.ndarray,
+        explained_variance_ratio: np.ndarray,
+        mean: np.ndarray,
+        n_samples: int,
+        mode: str,
+    ):
+        self.components = components
+        self.explained_variance = explained_variance
+        self.explained_variance_ratio = explained_variance_ratio
+        self.mean = mean
+        self.n_samples = n_samples
+        self.mode = mode
+
+    @property
+    def n_components(self) -> int:
+        return self.components.shape[0]
+
+    def save(self, directory: str):
+        """
+        Save the result as .npy files in a directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(f"{directory}/components.npy", self.components)
+        np.save(f"{directory}/explained_variance.npy", self.explained_variance)
+        np.save(f"{directory}/explained_variance_ratio.npy", self.explained_variance_ratio)
+        np.save(f"{directory}/mean.npy", self.mean)
+
+    def __repr__(self):
+        return f"PCAResult(mode={self.mode}, n_components={self.n_components}, n_samples={self.n_samples})"
+
+
+class PCAService(Service):
+    """
+    Fits a PCA on a float32 matrix, which can be an np.memmap of an ExpressionMatrixStore.
+
+    Modes:
+        exact: a full SVD of the centered matrix, for matrices that fit in memory.
+        randomized: a randomized truncated SVD (Halko et al.), which only needs a few passes of row blocks
+            over the matrix and never centers or copies it as a whole.
+        incremental: an incremental PCA (Ross et al.) that streams row blocks from disk and merges them into
+            a running SVD, so its memory is bounded by the block size.
+        auto: exact for small matrices, randomized otherwise.
+
+    Every computation stays in float32; only per-feature statistics are accumulated in float64.
+    """
+
+    def __init__(self):
+        super().__init__("PCA Service")
+
+    @staticmethod
+    def fit(
+        matrix: np.ndarray,
+        n_components: int,
+        mode: str = "auto",
+        block_size: int = PCA_BLOCK_SIZE,
+        n_oversamples: int = 10,
+        n_power_iterations: int = 4,
+        seed: Optional[int] = None,
+    ) -> PCAResult:
+        """
+        Fit a PCA with the given number of components
+        """
+        if mode not in PCA_MODES:
+            raise ValueError(f'[PCAService]: mode must be one of {PCA_MODES}. Got "{mode}"')
+
+        n_samples, n_features = matrix.shape
+        if n_components < 1 or n_components > min(n_samples, n_features):
+            raise ValueError(
+                f"[PCAService]: n_components must be between 1 and {min(n_samples, n_features)}. Got {n_components}"
+            )
+        if block_size < 1:
+            raise ValueError("[PCAService]: block_size must be at least 1")
+
+        if mode == "auto":
+            mode = "exact" if n_samples * n_features <= PCA_EXACT_MAX_ELEMENTS else "randomized"
+
+        if mode == "exact":
+            return PCAService._fit_exact(matrix, n_components)
+        if mode == "randomized":
+            return PCAService._fit_randomized(matrix, n_components, block_size, n_oversamples, n_power_iterations, seed)
+        return PCAService._fit_incremental(matrix, n_components, max(block_size, n_components))
+
+    @staticmethod
+    def transform(result: PCAResult, matrix: np.ndarray, block_size: int = PCA_BLOCK_SIZE) -> np.ndarray:
+        """
+        Project the rows of a matrix onto the principal components, a block of rows at a time
+        """
+        scores = np.empty((matrix.shape[0], result.n_components), dtype=np.float32)
+        mean = result.mean.astype(np.float32)
+
+        for start in range(0, matrix.shape[0], block_size):
+            block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+            scores[start:start + block_size] = (block - mean) @ result.components.T
+
+        return scores
+
+    @staticmethod
+    def _fit_exact(matrix: np.ndarray, n_components: int) -> PCAResult:
+        n_samples = matrix.shape[0]
+        data = np.asarray(matrix, dtype=np.float32)
+        mean = data.mean(axis=0, dtype=np.float64)
+
+        centered = data - mean.astype(np.float32)
+        _, singular_values, components = np.linalg.svd(centered, full_matrices=False)
+
+        explained_variance = singular_values ** 2 / max(n_samples - 1, 1)
+        total_variance = explained_variance.sum()
+
+        return PCAResult(
+            components[:n_components],
+            explained_variance[:n_components],
+            explained_variance[:n_components] / total_variance if total_variance > 0 else explained_variance[:n_components],
+            mean,
+            n_samples,
+            "exact",
+        )
+
+    @staticmethod
+    def _fit_randomized(
+        matrix: np.ndarray,
+        n_components: int,
+        block_size: int,
+        n_oversamples: int,
+        n_power_iterations: int,
+        seed: Optional[int],
+    ) -> PCAResult:
+        n_samples, n_features = matrix.shape
+        rng = np.random.default_rng(seed)
+        n_random = min(n_components + n_oversamples, n_samples, n_features)
+
+        mean, total_variance = PCAService._column_statistics(matrix, block_size)
+        mean32 = mean.astype(np.float32)
+
+        # the matrix is centered implicitly, block by block, by every product below
+        def multiply(right: np.ndarray) -> np.ndarray:
+            """(X - mean) @ right"""
+            result = np.empty((n_samples, right.shape[1]), dtype=np.float32)
+            offset = mean32 @ right
+            for start in range(0, n_samples, block_size):
+                result[start:start + block_size] = np.asarray(matrix[start:start + block_size]) @ right - offset
+            return result
+
+        def multiply_transposed(left: np.ndarray) -> np.ndarray:
+            """(X - mean).T @ left"""
+            result = np.zeros((n_features, left.shape[1]), dtype=np.float32)
+            for start in range(0, n_samples, block_size):
+                result += np.asarray(matrix[start:start + block_size]).T @ left[start:start + block_size]
+            return result - np.outer(mean32, left.sum(axis=0))
+
+        sample = multiply(rng.standard_normal((n_features, n_random), dtype=np.float32))
+        basis, _ = np.linalg.qr(sample)
+
+        for _ in range(n_power_iterations):
+            basis, _ = np.linalg.qr(multiply_transposed(basis))
+            basis, _ = np.linalg.qr(multiply(basis))
+
+        # project onto the basis: B = Q.T @ (X - mean), computed as ((X - mean).T @ Q).T
+        projected = multiply_transposed(basis).T
+        _, singular_values, components = np.linalg.svd(projected, full_matrices=False)
+
+        explained_variance = singular_values[:n_components] ** 2 / max(n_samples - 1, 1)
+
+        return PCAResult(
+            components[:n_components],
+            explained_variance,
+            explained_variance / total_variance if total_variance > 0 else explained_variance,
+            mean,
+            n_samples,
+            "randomized",
+        )
+
+    @staticmethod
+    def _fit_incremental(matrix: np.ndarray, n_components: int, block_size: int) -> PCAResult:
+        n_samples, n_features = matrix.shape
+
+        components = None
+        singular_values = None
+        mean = np.zeros(n_features, dtype=np.float64)
+        variance_sum = np.zeros(n_features, dtype=np.float64)
+        n_seen = 0
+
+        for start in range(0, n_samples, block_size):
+            block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+            n_block = block.shape[0]
+            n_total = n_seen + n_block
+
+            block_mean = block.mean(axis=0, dtype=np.float64)
+            block_variance_sum = ((block - block_mean.astype(np.float32)) ** 2).sum(axis=0, dtype=np.float64)
+
+            # merge the running mean and sum of squares (Chan et al.)
+            delta = block_mean - mean
+            variance_sum += block_variance_sum + delta ** 2 * n_seen * n_block / n_total
+            new_mean = mean + delta * n_block / n_total
+
+            centered = block - block_mean.astype(np.float32)
+            if components is not None:
+                # stack the previous components with the new block and a correction for the shifted mean
+                correction = (np.sqrt(n_seen * n_block / n_total) * (mean - block_mean)).astype(np.float32)
+                centered = np.vstack([singular_values[:, None] * components, centered, correction[None, :]])
+
+            _, singular_values, components = np.linalg.svd(centered, full_matrices=False)
+            components = components[:n_components]
+            singular_values = singular_values[:n_components]
+
+            mean = new_mean
+            n_seen = n_total
+
+        explained_variance = singular_values ** 2 / max(n_samples - 1, 1)
+        total_variance = variance_sum.sum() / max(n_samples - 1, 1)
+
+        return PCAResult(
+            components,
+            explained_variance,
+            explained_variance / total_variance if total_variance > 0 else explained_variance,
+            mean,
+            n_samples,
+            "incremental",
+        )
+
+    @staticmethod
+    def _column_statistics(matrix: np.ndarray, block_size: int) -> tuple[np.ndarray, float]:
+        """
+        Compute the per-feature mean and the total variance of a matrix, a block of rows at a time
+        """
+        n_samples = matrix.shape[0]
+        column_sum = np.zeros(matrix.shape[1], dtype=np.float64)
+        column_square_sum = np.zeros(matrix.shape[1], dtype=np.float64)
+
+        for start in range(0, n_samples, block_size):
+            block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+            column_sum += block.sum(axis=0, dtype=np.float64)
+            column_square_sum += np.square(block, dtype=np.float32).sum(axis=0, dtype=np.float64)
+
+        mean = column_sum / n_samples
+        total_variance = (column_square_sum - n_samples * mean ** 2).sum() / max(n_samples - 1, 1)
+
+        return mean, float(total_variance)
+
+    def docs(self):
+        return "This service performs principal component analysis on expression matrices."
+
+    def startup(self):
+        pass
+
+    def cleanup(self):
+        pass
@@ -0,0 +1,389 @@
+"""Async Data Retrieval Service
+This module contains the AsyncDataRetrievalService class, an asyncio variant of DataRetrievalService built on aiohttp.
+"""
+
+import time
+import asyncio
+import importlib.util
+import numpy as np
+from typing import AsyncIterator, Optional
+from pydantic import BaseModel
+
+from services.base import Service
+from services.data.data_retrieval_service import (
+    RETRYABLE_STATUS_CODES,
+    SECTION_DATASET_ONLY,
+    DataRetrievalService,
+    GridExpressionDownloadError,
+    RMAQueryError,
+)
+from services.data.grid_expression_cache import GridExpressionCache
+from services.data.reference_space_geometry import ReferenceSpaceGeometryRegistry
+from utils.profiler import TRACER
+
+from models import Gene, SectionDataSet, RMAResponse
+
+from constants import (
+    ALLEN_API_URL,
+    HTTP_POOL_SIZE,
+    ASYNC_MAX_CONCURRENT_REQUESTS,
+    ASYNC_MIN_REQUEST_INTERVAL,
+    GRID_DOWNLOAD_MAX_RETRIES,
+    GRID_DOWNLOAD_BACKOFF_FACTOR,
+    RMA_PAGE_SIZE,
+)
+
+
+class AsyncRateLimiter:
+    """
+    Bounds the requests in flight with a semaphore, and spaces the start of consecutive requests by at least
+    min_interval seconds, so bursts of coroutines do not hammer the API
+    """
+
+    def __init__(self, max_concurrent: int = ASYNC_MAX_CONCURRENT_REQUESTS, min_interval: float = ASYNC_MIN_REQUEST_INTERVAL):
+        if max_concurrent < 1:
+            raise ValueError("[AsyncRateLimiter]: max_concurrent must be at least 1")
+
+        self.min_interval = min_interval
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._interval_lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+
+        try:
+            async with self._interval_lock:
+                now = time.monotonic()
+                if self._next_start > now:
+                    await asyncio.sleep(self._next_start - now)
+                self._next_start = max(now, self._next_start) + self.min_interval
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+
+
+class AsyncDataRetrievalService(Service):
+    """
+    Retrieves data from the Allen Brain Atlas API with asyncio, with the same methods as DataRetrievalService.
+
+    Every request goes through one aiohttp session, whose connector keeps a pool of keep-alive connections,
+    and through one AsyncRateLimiter. Query building, response validation and zip decoding are shared with
+    DataRetrievalService; zips are decoded in a worker thread so the event loop is never blocked.
+    aiohttp is an optional dependency.
+
+    Example:
+
+    ```python
+    async with AsyncDataRetrievalService() as service:
+        genes = await service.get_geneset_from_product(1)
+        data = await service.get_grid_expression_data(69782969, ["energy"])
+    ```
+    """
+
+    api_url = ALLEN_API_URL
+
+    def __init__(self, max_concurrent: int = ASYNC_MAX_CONCURRENT_REQUESTS, min_interval: float = ASYNC_MIN_REQUEST_INTERVAL):
+        super().__init__("Async Data Retrieval Service")
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self._session = None
+        self._rate_limiter = None
+
+    @staticmethod
+    def available() -> bool:
+        """
+        Whether aiohttp is installed
+        """
+        return importlib.util.find_spec("aiohttp") is not None
+
+    async def __aenter__(self) -> "AsyncDataRetrievalService":
+        self.get_session()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def get_session(self):
+        """
+        Get the aiohttp session shared by every request of the service, creating it on first use.
+        Must be called from a running event loop
+        """
+        if self._session is None:
+            if not AsyncDataRetrievalService.available():
+                raise ImportError("[AsyncDataRetrievalService]: async retrieval requires the optional 'aiohttp' package")
+
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE))
+            self._rate_limiter = AsyncRateLimiter(self.max_concurrent, self.min_interval)
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_grid_expression_data(self, section_dataset_id: int, include: list[str], cache: Optional[GridExpressionCache] = None):
+        """
+        Get grid expression data from a section dataset ID
+        """
+        try:
+            return await self._download_grid_expression_data(section_dataset_id, include, max_retries=0, cache=cache)
+        except Exception as e:
+            print(
+                f"An error occurred while retrieving the grid expression data: {e}"
+            )
+            return None
+
+    async def get_grid_expression_data_batch(
+        self,
+        section_datasets: list[SectionDataSet],
+        include: list[str],
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+        cache: Optional[GridExpressionCache] = None,
+    ) -> tuple[dict[int, dict[str, np.ndarray]], dict[int, Exception]]:
+        """
+        Get grid expression data for many section datasets concurrently.
+        Returns the data keyed by section dataset ID, and the errors of the section datasets that failed
+        """
+        results = {}
+        failures = {}
+
+        async for section_dataset, data, error in self.iter_grid_expression_data_batch(
+            section_datasets, include, max_retries, backoff_factor, cache
+        ):
+            if error is None:
+                results[section_dataset.id] = data
+            else:
+                failures[section_dataset.id] = error
+
+        return results, failures
+
+    async def iter_grid_expression_data_batch(
+        self,
+        section_datasets: list[SectionDataSet],
+        include: list[str],
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+        cache: Optional[GridExpressionCache] = None,
+    ) -> AsyncIterator[tuple[SectionDataSet, Optional[dict], Optional[Exception]]]:
+        """
+        Download grid expression data for many section datasets, yielding (section dataset, data, error) tuples
+        in completion order. At most twice the concurrency limit of downloads are scheduled at once
+        """
+        pending_datasets = iter(section_datasets)
+        in_flight = {}
+
+        def schedule_next() -> bool:
+            section_dataset = next(pending_datasets, None)
+            if section_dataset is None:
+                return False
+
+            task = asyncio.ensure_future(
+                self._download_grid_expression_data(
+                    section_dataset.id, include, max_retries, backoff_factor, cache, section_dataset.reference_space_id
+                )
+            )
+            in_flight[task] = section_dataset
+            return True
+
+        while len(in_flight) < self.max_concurrent * 2 and schedule_next():
+            pass
+
+        try:
+            while in_flight:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    section_dataset = in_flight.pop(task)
+                    error = task.exception()
+
+                    if error is None:
+                        yield section_dataset, task.result(), None
+                    else:
+                        yield section_dataset, None, error
+
+                    schedule_next()
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def _download_grid_expression_data(
+        self,
+        section_dataset_id: int,
+        include: list[str],
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+        cache: Optional[GridExpressionCache] = None,
+        reference_space_id: Optional[int] = None,
+    ) -> dict[str, np.ndarray]:
+        """
+        Download and decode the grid expression data of a section dataset, retrying transient failures with
+        exponential backoff, or the delay of a Retry-After header. Raises GridExpressionDownloadError once the
+        retries are exhausted
+        """
+        import aiohttp
+
+        if cache is not None:
+            data = await asyncio.to_thread(cache.get_many, section_dataset_id, include)
+            if data is not None:
+                return data
+
+        url = f"{self.api_url}/grid_data/download/{section_dataset_id}?include={','.join(include)}"
+
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                async with self._rate_limiter_context():
+                    with TRACER.span("grid_data.wait"):
+                        response = await self.get_session().get(url)
+
+                    async with response:
+                        if response.status == 200:
+                            with TRACER.span("grid_data.transfer") as span:
+                                content = await response.read()
+                                span.add_bytes(len(content))
+                            data = await asyncio.to_thread(DataRetrievalService._decode_grid_expression_data, content, include)
+
+                            if reference_space_id is not None:
+                                await asyncio.to_thread(ReferenceSpaceGeometryRegistry.register_from_zip, reference_space_id, content)
+                            if cache is not None:
+                                await asyncio.to_thread(cache.put_many, section_dataset_id, data)
+
+                            return data
+
+                        retry_after = response.headers.get("Retry-After")
+
+                error = GridExpressionDownloadError(section_dataset_id, f"HTTP {response.status}")
+                retryable = response.status in RETRYABLE_STATUS_CODES
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = GridExpressionDownloadError(section_dataset_id, str(e) or type(e).__name__)
+                retryable = True
+
+            if not retryable or attempt >= max_retries:
+                raise error
+
+            delay = backoff_factor * (2 ** attempt)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get_section_dataset_ids_with_reference_space_id(self, reference_space_id: int, delegate: bool = True, should_contain_genes: bool = True, plane_of_section_id: int = 1, exclude_failed: bool = False):
+        """
+        Get a section dataset ID with a reference space ID
+        """
+        try:
+            return [
+                section
+                async for section in self.iter_section_datasets_with_reference_space_id(
+                    reference_space_id, delegate, should_contain_genes, plane_of_section_id, exclude_failed
+                )
+            ]
+        except Exception as e:
+            print(
+                f"An error occurred while retrieving the section dataset ID with the reference space: {e}"
+            )
+            return None
+
+    async def iter_section_datasets_with_reference_space_id(
+        self,
+        reference_space_id: int,
+        delegate: bool = True,
+        should_contain_genes: bool = True,
+        plane_of_section_id: int = 1,
+        exclude_failed: bool = False,
+        page_size: int = RMA_PAGE_SIZE,
+    ) -> AsyncIterator[SectionDataSet]:
+        """
+        Stream the section datasets of a reference space page by page, with the same server-side filters as
+        DataRetrievalService
+        """
+        criteria = DataRetrievalService._build_section_dataset_criteria(
+            reference_space_id, delegate, plane_of_section_id, exclude_failed
+        )
+
+        async for page in self._iter_rma_query(
+            SectionDataSet,
+            f"criteria={criteria}&include=genes,plane_of_section&only={SECTION_DATASET_ONLY}&order=data_sets.id",
+            page_size,
+        ):
+            for section in page:
+                if should_contain_genes and (section.genes is None or len(section.genes) == 0):
+                    continue
+
+                yield section
+
+    async def get_geneset_from_product(self, product_id: int):
+        """
+        Get a gene set from a product
+        """
+        try:
+            return [gene async for gene in self.iter_geneset_from_product(product_id)]
+        except Exception as e:
+            print(
+                f"An error occurred while retrieving the gene set from the product: {e}"
+            )
+            return None
+
+    async def iter_geneset_from_product(self, product_id: int, page_size: int = RMA_PAGE_SIZE) -> AsyncIterator[Gene]:
+        """
+        Stream the genes of a product page by page
+        """
+        async for page in self._iter_rma_query(Gene, f"criteria=products[id$eq{product_id}]&order=genes.id", page_size):
+            for gene in page:
+                yield gene
+
+    async def _iter_rma_query(self, model: type[BaseModel], query: str, page_size: int = RMA_PAGE_SIZE) -> AsyncIterator[list]:
+        """
+        Page through an RMA query with start_row/num_rows, yielding the validated records of one page at a time
+        """
+        if page_size < 1:
+            raise ValueError("[AsyncDataRetrievalService]: page_size must be at least 1")
+
+        start_row = 0
+        while True:
+            async with self._rate_limiter_context():
+                with TRACER.span("rma.request") as span:
+                    async with self.get_session().get(
+                        f"{self.api_url}/api/v2/data/{model.__name__}/query.json?{query}&start_row={start_row}&num_rows={page_size}"
+                    ) as response:
+                        content = await response.read()
+                    span.add_bytes(len(content))
+
+            with TRACER.span("rma.validate"):
+                data = RMAResponse[model].model_validate_json(content)
+
+            if not data.success or isinstance(data.msg, str):
+                raise RMAQueryError(f"[AsyncDataRetrievalService]: {model.__name__} query failed: {data.msg}")
+
+            page = data.msg
+            if len(page) > 0:
+                yield page
+
+            start_row += len(page)
+            if len(page) < page_size or (data.total_rows is not None and start_row >= data.total_rows):
+                return
+
+    def _rate_limiter_context(self) -> AsyncRateLimiter:
+        self.get_session()
+        return self._rate_limiter
+
+    def docs(self):
+        return "This service retrieves data from a data source with asyncio."
+
+    def startup(self):
+        pass
+
+    def cleanup(self):
+        pass
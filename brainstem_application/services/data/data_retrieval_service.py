@@ -4,114 +4,462 @@ This module contains the DataRetrievalService class, which is a service that ret
 
 import io
 import os
+import time
 import zipfile
+import tempfile
+import threading
 import requests
 import numpy as np
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import BinaryIO, Callable, Iterator, Optional, TypeVar
 from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
 
 from services.base import Service
+from services.data.grid_expression_cache import GridExpressionCache
+from services.data.reference_space_geometry import ReferenceSpaceGeometryRegistry
+from services.data.request_cache import RequestCache
+from utils.profiler import TRACER
 
 
-from models import Gene, SectionDataSet, PlaneOfSection
+from models import Gene, SectionDataSet, PlaneOfSection, RMAResponse
+
+from constants import (
+    ALLEN_API_URL,
+    HTTP_POOL_SIZE,
+    GRID_DOWNLOAD_MAX_WORKERS,
+    GRID_DOWNLOAD_MAX_RETRIES,
+    GRID_DOWNLOAD_BACKOFF_FACTOR,
+    GRID_DOWNLOAD_CHUNK_SIZE,
+    GRID_DOWNLOAD_SPOOL_MAX_BYTES,
+    RMA_PAGE_SIZE,
+)
+
+T = TypeVar("T")
+
+# HTTP status codes that are worth retrying, as the server may recover
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# fields requested by section dataset queries, qualified by table name, which are exactly the fields of the models
+SECTION_DATASET_ONLY = ",".join(
+    [f"data_sets.{field}" for field in SectionDataSet.model_fields if field not in ("genes", "plane_of_section")]
+    + [f"genes.{field}" for field in Gene.model_fields]
+    + [f"plane_of_sections.{field}" for field in PlaneOfSection.model_fields]
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class RMAQueryError(Exception):
+    """
+    Raised when an RMA query of the Allen Brain Atlas API does not succeed
+    """
+
+
+class GridExpressionDownloadError(Exception):
+    """
+    Raised when the grid expression data of a section dataset could not be downloaded
+    """
+
+    def __init__(self, section_dataset_id: int, message: str):
+        super().__init__(f"[DataRetrievalService]: section dataset {section_dataset_id}: {message}")
+        self.section_dataset_id = section_dataset_id
 
-from constants import DATA_TEMP_DIR
 
 class DataRetrievalService(Service):
     def __init__(self):
         super().__init__("Data Retrieval Service")
 
+    api_url = ALLEN_API_URL
+    # memoizes the RMA queries, which menus repeat whenever they are revisited
+    request_cache = None
+
+    @staticmethod
+    def get_session() -> requests.Session:
+        """
+        Get the HTTP session shared by every request of the service, so connections are pooled and kept alive
+        """
+        global _session
+
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                _session = requests.Session()
+                _session.mount("http://", adapter)
+                _session.mount("https://", adapter)
+
+            return _session
+
+    @staticmethod
+    def get_request_cache() -> RequestCache:
+        """
+        Get the cache of the RMA queries, creating it on first use
+        """
+        with _session_lock:
+            if DataRetrievalService.request_cache is None:
+                DataRetrievalService.request_cache = RequestCache(DataRetrievalService.get_session)
+
+            return DataRetrievalService.request_cache
+
     @staticmethod
-    def get_grid_expression_data(section_dataset_id: int, include: list[str]):
+    def get_grid_expression_data(section_dataset_id: int, include: list[str], cache: Optional[GridExpressionCache] = None):
         """
         Get grid expression data from a section dataset ID
         """
         try:
-            include_str = ",".join(include)
-            # API example: http://api.brain-map.org/grid_data/download/100054927?include=intensity,density
-            response = requests.get(
-                f"http://api.brain-map.org/grid_data/download/{section_dataset_id}?include={include_str}"
-            )
-            
-            # this api returns a zip file
-            # we need to unzip it and read the files with name in include
-            if response.status_code == 200:
-                
-                with zipfile.ZipFile(io.BytesIO(response.content), 'r') as zip_ref:
-                    zip_ref.extractall(DATA_TEMP_DIR)
-                    files = zip_ref.namelist()
-                    data = {}
-                    for expression_type in include:
-                        # it it a .raw file, so we can use numpy to read it
-                        data[expression_type] = np.fromfile(f"{DATA_TEMP_DIR}/{expression_type}.raw", dtype=np.float32)
-
-                    return data
-        
+            return DataRetrievalService._download_grid_expression_data(section_dataset_id, include, max_retries=0, cache=cache)
         except Exception as e:
             print(
                 f"An error occurred while retrieving the grid expression data: {e}"
             )
             return None
-        
+
     @staticmethod
-    def get_section_dataset_ids_with_reference_space_id(reference_space_id: int, delegate: bool = True, should_contain_genes: bool = True, plane_of_section_id: int = 1):
+    def get_grid_expression_volumes(section_dataset: SectionDataSet, include: list[str], cache: Optional[GridExpressionCache] = None):
         """
-        Get a section dataset ID with a reference space ID
+        Get the grid expression data of a section dataset as 3-D (z, y, x) views, shaped by the geometry of its
+        reference space
         """
         try:
-            response = requests.get(
-                f"http://api.brain-map.org/api/v2/data/SectionDataSet/query.json?criteria=reference_space[id$eq{reference_space_id}]&num_rows=all&include=genes,plane_of_section"
+            data = DataRetrievalService._download_grid_expression_data(
+                section_dataset.id, include, max_retries=0, cache=cache, reference_space_id=section_dataset.reference_space_id
             )
-            data = response.json()
+        except Exception as e:
+            print(
+                f"An error occurred while retrieving the grid expression data: {e}"
+            )
+            return None
 
-            if not "msg" in data:
-                print(
-                    f"An error occurred while retrieving the section dataset ID with the reference space: {data['msg']}"
+        geometry = ReferenceSpaceGeometryRegistry.get(section_dataset.reference_space_id)
+        if geometry is None:
+            print(f"[DataRetrievalService]: the grid of reference space {section_dataset.reference_space_id} is unknown")
+            return None
+
+        return {expression_type: geometry.reshape(volume) for expression_type, volume in data.items()}
+
+    @staticmethod
+    def get_grid_expression_data_batch(
+        section_datasets: list[SectionDataSet],
+        include: list[str],
+        max_workers: int = GRID_DOWNLOAD_MAX_WORKERS,
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+        on_progress: Optional[Callable[[SectionDataSet, Optional[dict], Optional[Exception]], None]] = None,
+        cache: Optional[GridExpressionCache] = None,
+    ) -> tuple[dict[int, dict[str, np.ndarray]], dict[int, Exception]]:
+        """
+        Get grid expression data for many section datasets concurrently.
+        Returns the data keyed by section dataset ID, and the errors of the section datasets that failed
+        """
+        results = {}
+        failures = {}
+
+        for section_dataset, data, error in DataRetrievalService.iter_grid_expression_data_batch(
+            section_datasets, include, max_workers, max_retries, backoff_factor, cache
+        ):
+            if error is None:
+                results[section_dataset.id] = data
+            else:
+                failures[section_dataset.id] = error
+
+            if on_progress is not None:
+                on_progress(section_dataset, data, error)
+
+        return results, failures
+
+    @staticmethod
+    def iter_grid_expression_data_batch(
+        section_datasets: list[SectionDataSet],
+        include: list[str],
+        max_workers: int = GRID_DOWNLOAD_MAX_WORKERS,
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+        cache: Optional[GridExpressionCache] = None,
+    ) -> Iterator[tuple[SectionDataSet, Optional[dict], Optional[Exception]]]:
+        """
+        Download grid expression data for many section datasets on a bounded thread pool.
+        Yields (section dataset, data, error) tuples in completion order. At most twice the number of workers
+        are in flight at once, so downloaded volumes do not pile up faster than the caller consumes them
+        """
+        if max_workers < 1:
+            raise ValueError("[DataRetrievalService]: max_workers must be at least 1")
+
+        pending_datasets = iter(section_datasets)
+        max_in_flight = max_workers * 2
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = {}
+
+            def submit_next() -> bool:
+                section_dataset = next(pending_datasets, None)
+                if section_dataset is None:
+                    return False
+
+                future = executor.submit(
+                    DataRetrievalService._download_grid_expression_data,
+                    section_dataset.id,
+                    include,
+                    max_retries,
+                    backoff_factor,
+                    cache,
+                    section_dataset.reference_space_id,
                 )
-                return None
-                
-            data = [SectionDataSet(**section) for section in data["msg"]]
+                in_flight[future] = section_dataset
+                return True
+
+            while len(in_flight) < max_in_flight and submit_next():
+                pass
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    section_dataset = in_flight.pop(future)
+                    error = future.exception()
+
+                    if error is None:
+                        yield section_dataset, future.result(), None
+                    else:
+                        yield section_dataset, None, error
+
+                    submit_next()
 
-            if delegate:
-                data = [section for section in data if section.delegate]
+    @staticmethod
+    def _download_grid_expression_data(
+        section_dataset_id: int,
+        include: list[str],
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+        cache: Optional[GridExpressionCache] = None,
+        reference_space_id: Optional[int] = None,
+    ) -> dict[str, np.ndarray]:
+        """
+        Download and decode the grid expression data of a section dataset, retrying transient failures
+        with exponential backoff. Raises GridExpressionDownloadError once the retries are exhausted.
+        When a cache is given, cached volumes are returned without any network I/O. When the reference space
+        is given, the grid of the downloaded zip's header is registered for it
+        """
+        if cache is not None:
+            data = cache.get_many(section_dataset_id, include)
+            if data is not None:
+                return data
+
+        data = DataRetrievalService._request_grid_expression_zip(
+            section_dataset_id,
+            include,
+            lambda response: DataRetrievalService._stream_grid_expression_data(response, include, reference_space_id),
+            max_retries,
+            backoff_factor,
+        )
 
-            if should_contain_genes:
-                data = [section for section in data if section.genes is not None and len(section.genes) > 0]
+        if cache is not None:
+            cache.put_many(section_dataset_id, data)
 
-            if plane_of_section_id is not None:
-                data = [section for section in data if section.plane_of_section_id == plane_of_section_id]
+        return data
+
+    @staticmethod
+    def _request_grid_expression_zip(
+        section_dataset_id: int,
+        include: list[str],
+        handle_response: Callable[[requests.Response], T],
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+    ) -> T:
+        """
+        Request the grid expression data zip of a section dataset, retrying transient failures with exponential
+        backoff, and hand the streamed 200 response to handle_response. Raises GridExpressionDownloadError once
+        the retries are exhausted
+        """
+        include_str = ",".join(include)
+        # API example: http://api.brain-map.org/grid_data/download/100054927?include=intensity,density
+        url = f"{DataRetrievalService.api_url}/grid_data/download/{section_dataset_id}?include={include_str}"
+
+        attempt = 0
+        while True:
+            try:
+                with TRACER.span("grid_data.wait"):
+                    response = DataRetrievalService.get_session().get(url, stream=True)
+
+                with response:
+                    if response.status_code == 200:
+                        return handle_response(response)
+
+                error = GridExpressionDownloadError(section_dataset_id, f"HTTP {response.status_code}")
+                retryable = response.status_code in RETRYABLE_STATUS_CODES
+            except requests.RequestException as e:
+                error = GridExpressionDownloadError(section_dataset_id, str(e))
+                retryable = True
+
+            if not retryable or attempt >= max_retries:
+                raise error
+
+            time.sleep(backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    @staticmethod
+    def _stream_grid_expression_data(response: requests.Response, include: list[str], reference_space_id: Optional[int] = None) -> dict[str, np.ndarray]:
+        """
+        Stream a grid expression data zip file in chunks into a spooled buffer, then decode it.
+        Small zips stay in memory, while large ones spill to a temporary file instead of growing the heap
+        """
+        with tempfile.SpooledTemporaryFile(max_size=GRID_DOWNLOAD_SPOOL_MAX_BYTES) as buffer:
+            with TRACER.span("grid_data.transfer") as span:
+                for chunk in response.iter_content(chunk_size=GRID_DOWNLOAD_CHUNK_SIZE):
+                    buffer.write(chunk)
+                    span.add_bytes(len(chunk))
+
+            buffer.seek(0)
+            data = DataRetrievalService._decode_grid_expression_data(buffer, include)
+
+            if reference_space_id is not None:
+                buffer.seek(0)
+                ReferenceSpaceGeometryRegistry.register_from_zip(reference_space_id, buffer)
 
             return data
+
+    @staticmethod
+    def _decode_grid_expression_data(content: bytes | BinaryIO, include: list[str]) -> dict[str, np.ndarray]:
+        """
+        Decode the .raw volumes of a grid expression data zip file in memory, without extracting it to disk
+        """
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+
+        # this api returns a zip file holding a {expression_type}.raw float32 volume per measurement
+        with TRACER.span("grid_data.decode") as span, zipfile.ZipFile(content, 'r') as zip_ref:
+            data = {}
+            for expression_type in include:
+                data[expression_type] = np.frombuffer(zip_ref.read(f"{expression_type}.raw"), dtype=np.float32)
+                span.add_bytes(data[expression_type].nbytes)
+
+            return data
+
+    @staticmethod
+    def get_section_dataset_ids_with_reference_space_id(reference_space_id: int, delegate: bool = True, should_contain_genes: bool = True, plane_of_section_id: int = 1, exclude_failed: bool = False):
+        """
+        Get a section dataset ID with a reference space ID
+        """
+        try:
+            return list(
+                DataRetrievalService.iter_section_datasets_with_reference_space_id(
+                    reference_space_id, delegate, should_contain_genes, plane_of_section_id, exclude_failed
+                )
+            )
         except Exception as e:
             print(
                 f"An error occurred while retrieving the section dataset ID with the reference space: {e}"
             )
             return None
-        
+
+    @staticmethod
+    def iter_section_datasets_with_reference_space_id(
+        reference_space_id: int,
+        delegate: bool = True,
+        should_contain_genes: bool = True,
+        plane_of_section_id: int = 1,
+        exclude_failed: bool = False,
+        page_size: int = RMA_PAGE_SIZE,
+        use_cache: bool = True,
+    ) -> Iterator[SectionDataSet]:
+        """
+        Stream the section datasets of a reference space page by page, so only one page is held in memory at a time.
+        The delegate, plane of section and failed filters are applied by the server, and only the fields of the
+        models are requested, so filtered out records and unused fields are never downloaded
+        """
+        criteria = DataRetrievalService._build_section_dataset_criteria(
+            reference_space_id, delegate, plane_of_section_id, exclude_failed
+        )
+
+        for page in DataRetrievalService._iter_rma_query(
+            SectionDataSet,
+            f"criteria={criteria}&include=genes,plane_of_section&only={SECTION_DATASET_ONLY}&order=data_sets.id",
+            page_size,
+            use_cache,
+        ):
+            for section in page:
+                # a criteria on genes would only filter the included genes, so datasets without genes are dropped here
+                if should_contain_genes and (section.genes is None or len(section.genes) == 0):
+                    continue
+
+                yield section
+
+    @staticmethod
+    def _build_section_dataset_criteria(reference_space_id: int, delegate: bool, plane_of_section_id: Optional[int], exclude_failed: bool) -> str:
+        """
+        Build the RMA criteria of a section dataset query
+        """
+        filters = ""
+
+        if delegate:
+            filters += "[delegate$eqtrue]"
+
+        if plane_of_section_id is not None:
+            filters += f"[plane_of_section_id$eq{plane_of_section_id}]"
+
+        if exclude_failed:
+            filters += "[failed$eqfalse]"
+
+        criteria = f"reference_space[id$eq{reference_space_id}]"
+        return f"{filters},{criteria}" if filters else criteria
+
     @staticmethod
     def get_geneset_from_product(product_id: int):
         """
         Get a gene set from a product
         """
         try:
-            response = requests.get(
-                f"http://api.brain-map.org/api/v2/data/Gene/query.json?criteria=products[id$eq{product_id}]&num_rows=all"
-            )
-            data = response.json()
-
-            if not "msg" in data:
-                print(
-                    f"An error occurred while retrieving the gene set from the product: {data['msg']}"
-                )
-                return None
-            
-            return [Gene(**gene) for gene in data["msg"]]
+            return list(DataRetrievalService.iter_geneset_from_product(product_id))
         except Exception as e:
             print(
                 f"An error occurred while retrieving the gene set from the product: {e}"
             )
             return None
 
+    @staticmethod
+    def iter_geneset_from_product(product_id: int, page_size: int = RMA_PAGE_SIZE, use_cache: bool = True) -> Iterator[Gene]:
+        """
+        Stream the genes of a product page by page, so only one page is held in memory at a time
+        """
+        for page in DataRetrievalService._iter_rma_query(
+            Gene, f"criteria=products[id$eq{product_id}]&order=genes.id", page_size, use_cache
+        ):
+            yield from page
+
+    @staticmethod
+    def _iter_rma_query(model: type[BaseModel], query: str, page_size: int = RMA_PAGE_SIZE, use_cache: bool = True) -> Iterator[list]:
+        """
+        Page through an RMA query with start_row/num_rows, yielding the records of one page at a time.
+        Each page is validated in bulk straight from the response bytes, instead of one model per record.
+        Unless use_cache is False, pages go through the request cache, so repeating a query does not download it again
+        """
+        if page_size < 1:
+            raise ValueError("[DataRetrievalService]: page_size must be at least 1")
+
+        start_row = 0
+        while True:
+            with TRACER.span("rma.request") as span:
+                url = f"{DataRetrievalService.api_url}/api/v2/data/{model.__name__}/query.json?{query}&start_row={start_row}&num_rows={page_size}"
+                if use_cache:
+                    content = DataRetrievalService.get_request_cache().get(url)
+                else:
+                    content = DataRetrievalService.get_session().get(url).content
+                span.add_bytes(len(content))
+
+            with TRACER.span("rma.validate"):
+                data = RMAResponse[model].model_validate_json(content)
+
+            if not data.success or isinstance(data.msg, str):
+                raise RMAQueryError(f"[DataRetrievalService]: {model.__name__} query failed: {data.msg}")
+
+            page = data.msg
+            if len(page) > 0:
+                yield page
+
+            start_row += len(page)
+            if len(page) < page_size or (data.total_rows is not None and start_row >= data.total_rows):
+                return
+
     def docs(self):
         return "This service retrieves data from a data source."
 
@@ -0,0 +1,350 @@
+"""Expression Matrix Store
+This module contains the ExpressionMatrixStore class, an on-disk gene x voxel expression matrix backed by memory-mapped arrays.
+"""
+
+import os
+import re
+import json
+import numpy as np
+from typing import Optional
+
+from constants import EXPRESSION_STORE_CHECKPOINT_INTERVAL, EXPRESSION_STORE_MERGE_BLOCK_SIZE
+
+INDEX_FILE_NAME = "index.json"
+FRAGMENT_DIRECTORY_PATTERN = re.compile(r"shard-(\d+)-of-(\d+)")
+STORE_VERSION = 1
+
+
+class ExpressionMatrixStore:
+    """
+    Stores one float32 gene x voxel matrix per measurement in a directory.
+
+    Each matrix is a preallocated np.memmap file with one row per section dataset, so downloaded volumes are
+    written straight to disk instead of being held in memory. A JSON sidecar, index.json, records the shape of
+    the matrices and the gene and section dataset ID of every row. Rows can be appended, read at random and
+    sliced by column without loading the whole matrix.
+
+    When opened for appending, the index is checkpointed every checkpoint_interval rows. The index doubles as
+    the manifest of a pull: a pull that dies can be resumed by reopening the store and skipping the section
+    datasets in completed_section_dataset_ids(). Rows written after the last checkpoint are not in the index,
+    so they are simply overwritten when the pull resumes.
+
+    Example:
+
+    ```python
+    store = ExpressionMatrixStore.create("store", ["density"], n_voxels=159326)
+    store.append(section_dataset.id, section_dataset.genes[0].acronym, {"density": volume})
+    store.close()
+
+    store = ExpressionMatrixStore("store")
+    store.columns("density", slice(0, 100))
+    ```
+    """
+
+    def __init__(self, directory: str, mode: str = "r", checkpoint_interval: int = EXPRESSION_STORE_CHECKPOINT_INTERVAL):
+        """
+        Open an existing store. Use mode "r" to read, or "r+" to also append rows
+        """
+        if mode not in ("r", "r+"):
+            raise ValueError(f'[ExpressionMatrixStore]: mode must be "r" or "r+". Got "{mode}"')
+
+        index_path = f"{directory}/{INDEX_FILE_NAME}"
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"[ExpressionMatrixStore]: no store found in {directory}")
+
+        with open(index_path, "r") as file:
+            index = json.load(file)
+
+        self.directory = directory
+        self.mode = mode
+        self.measurements = index["measurements"]
+        self.n_voxels = index["n_voxels"]
+        self.capacity = index["capacity"]
+        self.genes = index["genes"]
+        self.section_dataset_ids = index["section_dataset_ids"]
+        # stores written before these were recorded hold None
+        self.reference_space_id = index.get("reference_space_id")
+        self.plane_of_section_id = index.get("plane_of_section_id")
+        self.checkpoint_interval = checkpoint_interval
+        self._rows_since_checkpoint = 0
+        self._matrices = {measurement: self._map(measurement) for measurement in self.measurements}
+
+    @staticmethod
+    def create(
+        directory: str,
+        measurements: list[str],
+        n_voxels: int,
+        capacity: int = 1024,
+        checkpoint_interval: int = EXPRESSION_STORE_CHECKPOINT_INTERVAL,
+        reference_space_id: Optional[int] = None,
+        plane_of_section_id: Optional[int] = None,
+    ) -> "ExpressionMatrixStore":
+        """
+        Create an empty store, replacing any store already in the directory, and open it for appending. The
+        reference space and plane of section of the pull are recorded, so a resumed pull can check it matches
+        """
+        if len(measurements) == 0:
+            raise ValueError("[ExpressionMatrixStore]: at least one measurement is required")
+        if n_voxels < 1 or capacity < 1:
+            raise ValueError("[ExpressionMatrixStore]: n_voxels and capacity must be positive")
+
+        os.makedirs(directory, exist_ok=True)
+
+        for measurement in measurements:
+            with open(ExpressionMatrixStore._matrix_path(directory, measurement), "wb") as file:
+                file.truncate(capacity * n_voxels * np.dtype(np.float32).itemsize)
+
+        ExpressionMatrixStore._write_index(
+            directory,
+            {
+                "version": STORE_VERSION,
+                "measurements": list(measurements),
+                "n_voxels": n_voxels,
+                "capacity": capacity,
+                "n_rows": 0,
+                "genes": [],
+                "section_dataset_ids": [],
+                "reference_space_id": reference_space_id,
+                "plane_of_section_id": plane_of_section_id,
+            },
+        )
+
+        return ExpressionMatrixStore(directory, mode="r+", checkpoint_interval=checkpoint_interval)
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(f"{directory}/{INDEX_FILE_NAME}")
+
+    @staticmethod
+    def fragment_directory(directory: str, index: int, count: int) -> str:
+        """
+        Get the directory of the fragment of a store that the index-th of count shards of a pull writes
+        """
+        return f"{directory}/shard-{index}-of-{count}"
+
+    @staticmethod
+    def find_fragments(directory: str) -> dict[int, list[str]]:
+        """
+        Find the fragments in the directory of a store. Returns the fragment directories, ordered by shard index,
+        keyed by shard count
+        """
+        fragments = {}
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            match = FRAGMENT_DIRECTORY_PATTERN.fullmatch(name)
+            if match is not None and ExpressionMatrixStore.exists(f"{directory}/{name}"):
+                fragments.setdefault(int(match.group(2)), []).append((int(match.group(1)), f"{directory}/{name}"))
+
+        return {count: [fragment for _, fragment in sorted(shards)] for count, shards in fragments.items()}
+
+    @staticmethod
+    def merge(
+        fragment_directories: list[str], directory: str, block_size: int = EXPRESSION_STORE_MERGE_BLOCK_SIZE
+    ) -> "ExpressionMatrixStore":
+        """
+        Merge store fragments, e.g. the shards of a pull, into one store in directory, replacing any store already
+        there. The rows of the merged store are ordered by gene, then section dataset ID, whatever the sharding,
+        and a section dataset held by several fragments is kept once.
+
+        Rows are copied from the memory-mapped fragments block_size rows at a time, so neither the fragments nor
+        the merged matrices are ever loaded whole. Returns the merged store, open for reading
+        """
+        if len(fragment_directories) == 0:
+            raise ValueError("[ExpressionMatrixStore]: at least one fragment is required")
+        if block_size < 1:
+            raise ValueError("[ExpressionMatrixStore]: block_size must be at least 1")
+        if os.path.abspath(directory) in {os.path.abspath(fragment) for fragment in fragment_directories}:
+            raise ValueError("[ExpressionMatrixStore]: a store cannot be merged into one of its fragments")
+
+        fragments = [ExpressionMatrixStore(fragment) for fragment in fragment_directories]
+        measurements = fragments[0].measurements
+        n_voxels = fragments[0].n_voxels
+        for fragment in fragments[1:]:
+            if (
+                sorted(fragment.measurements) != sorted(measurements)
+                or fragment.n_voxels != n_voxels
+                or fragment.reference_space_id != fragments[0].reference_space_id
+                or fragment.plane_of_section_id != fragments[0].plane_of_section_id
+            ):
+                raise ValueError(
+                    f"[ExpressionMatrixStore]: fragment {fragment.directory} holds {fragment.measurements} of "
+                    f"{fragment.n_voxels} voxels of reference space {fragment.reference_space_id}, plane "
+                    f"{fragment.plane_of_section_id}, which does not match fragment {fragments[0].directory}"
+                )
+
+        # the source of every row of the merged store, as (gene, section dataset ID, fragment, row)
+        sources = {}
+        for i, fragment in enumerate(fragments):
+            for row, (gene, section_dataset_id) in enumerate(zip(fragment.genes, fragment.section_dataset_ids)):
+                sources.setdefault(section_dataset_id, (gene, section_dataset_id, i, row))
+        sources = sorted(sources.values(), key=lambda source: (source[0], source[1]))
+
+        merged = ExpressionMatrixStore.create(
+            directory,
+            measurements,
+            n_voxels,
+            capacity=max(len(sources), 1),
+            reference_space_id=fragments[0].reference_space_id,
+            plane_of_section_id=fragments[0].plane_of_section_id,
+        )
+
+        for start in range(0, len(sources), block_size):
+            block = sources[start:start + block_size]
+
+            for i, fragment in enumerate(fragments):
+                positions = [position for position, source in enumerate(block) if source[2] == i]
+                if len(positions) == 0:
+                    continue
+
+                rows = [block[position][3] for position in positions]
+                for measurement in measurements:
+                    merged._matrices[measurement][start + np.asarray(positions)] = fragment._matrices[measurement][rows]
+
+            merged.genes.extend(source[0] for source in block)
+            merged.section_dataset_ids.extend(source[1] for source in block)
+            merged.flush()
+
+        merged.close()
+
+        return ExpressionMatrixStore(directory)
+
+    def __len__(self) -> int:
+        return len(self.genes)
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.genes)
+
+    def append(self, section_dataset_id: int, gene: str, volumes: dict[str, np.ndarray]) -> int:
+        """
+        Append the volumes of a section dataset as a new row, growing the matrices if they are full.
+        Returns the index of the new row
+        """
+        if self.mode != "r+":
+            raise PermissionError("[ExpressionMatrixStore]: store was opened read-only")
+        if set(volumes) != set(self.measurements):
+            raise ValueError(
+                f"[ExpressionMatrixStore]: expected volumes for {self.measurements}. Got {list(volumes)}"
+            )
+
+        for measurement, volume in volumes.items():
+            if volume.shape != (self.n_voxels,):
+                raise ValueError(
+                    f"[ExpressionMatrixStore]: {measurement} volume must have {self.n_voxels} voxels. Got {volume.shape}"
+                )
+
+        row = self.n_rows
+        if row >= self.capacity:
+            self._grow(self.capacity * 2)
+
+        for measurement, volume in volumes.items():
+            self._matrices[measurement][row] = volume
+
+        self.genes.append(gene)
+        self.section_dataset_ids.append(section_dataset_id)
+
+        self._rows_since_checkpoint += 1
+        if self.checkpoint_interval > 0 and self._rows_since_checkpoint >= self.checkpoint_interval:
+            self.flush()
+
+        return row
+
+    def matrix(self, measurement: str) -> np.ndarray:
+        """
+        Get the memory-mapped matrix of a measurement, restricted to the rows written so far
+        """
+        return self._matrices[measurement][: self.n_rows]
+
+    def row(self, measurement: str, index: int) -> np.ndarray:
+        """
+        Get a single row of a measurement's matrix
+        """
+        if index < 0 or index >= self.n_rows:
+            raise IndexError(f"[ExpressionMatrixStore]: row {index} out of range")
+        return self._matrices[measurement][index]
+
+    def rows(self, measurement: str, indices) -> np.ndarray:
+        """
+        Get several rows of a measurement's matrix
+        """
+        return self.matrix(measurement)[indices]
+
+    def columns(self, measurement: str, columns) -> np.ndarray:
+        """
+        Get a slice of voxel columns of a measurement's matrix, across every row
+        """
+        return self.matrix(measurement)[:, columns]
+
+    def rows_for_gene(self, gene: str) -> list[int]:
+        """
+        Get the indices of the rows of a gene, as a gene can have several section datasets
+        """
+        return [index for index, row_gene in enumerate(self.genes) if row_gene == gene]
+
+    def completed_section_dataset_ids(self) -> set[int]:
+        """
+        Get the IDs of the section datasets already stored, which a resumed pull can skip
+        """
+        return set(self.section_dataset_ids)
+
+    def flush(self):
+        """
+        Write the matrices and the index to disk. Matrices are flushed first, so the index never lists a row
+        whose data has not been written
+        """
+        if self.mode != "r+":
+            return
+
+        for matrix in self._matrices.values():
+            matrix.flush()
+
+        ExpressionMatrixStore._write_index(
+            self.directory,
+            {
+                "version": STORE_VERSION,
+                "measurements": self.measurements,
+                "n_voxels": self.n_voxels,
+                "capacity": self.capacity,
+                "n_rows": self.n_rows,
+                "genes": self.genes,
+                "section_dataset_ids": self.section_dataset_ids,
+                "reference_space_id": self.reference_space_id,
+                "plane_of_section_id": self.plane_of_section_id,
+            },
+        )
+        self._rows_since_checkpoint = 0
+
+    def close(self):
+        self.flush()
+        self._matrices = {}
+
+    def _grow(self, capacity: int):
+        for matrix in self._matrices.values():
+            matrix.flush()
+        self._matrices = {}
+
+        for measurement in self.measurements:
+            with open(ExpressionMatrixStore._matrix_path(self.directory, measurement), "r+b") as file:
+                file.truncate(capacity * self.n_voxels * np.dtype(np.float32).itemsize)
+
+        self.capacity = capacity
+        self._matrices = {measurement: self._map(measurement) for measurement in self.measurements}
+
+    def _map(self, measurement: str) -> np.memmap:
+        return np.memmap(
+            ExpressionMatrixStore._matrix_path(self.directory, measurement),
+            dtype=np.float32,
+            mode=self.mode,
+            shape=(self.capacity, self.n_voxels),
+        )
+
+    @staticmethod
+    def _matrix_path(directory: str, measurement: str) -> str:
+        return f"{directory}/{measurement}.f32"
+
+    @staticmethod
+    def _write_index(directory: str, index: dict):
+        # write to a temporary file first, so a crash never leaves a truncated index behind
+        temp_path = f"{directory}/{INDEX_FILE_NAME}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(index, file)
+        os.replace(temp_path, f"{directory}/{INDEX_FILE_NAME}")
@@ -0,0 +1,271 @@
+"""Grid Expression Cache
+This module contains the GridExpressionCache class, a persistent on-disk cache of decoded grid expression volumes.
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from typing import Optional
+
+from constants import (
+    DATA_CACHE_GRID_EXPRESSION_DIR,
+    GRID_EXPRESSION_CACHE_ACCESS_FLUSH_INTERVAL,
+    GRID_EXPRESSION_CACHE_MAX_BYTES,
+)
+
+
+class GridExpressionCache:
+    """
+    Caches decoded float32 grid expression volumes on disk, keyed by (section dataset ID, measurement).
+
+    Volumes are stored content-addressed under the SHA-256 digest of their bytes, so identical volumes are
+    stored once and every read can be checked against its digest. An SQLite index maps keys to digests and
+    records the last access time of every entry, which is used to evict the least recently used entries
+    once the cache grows past max_bytes.
+
+    Reads and integrity checks run outside the lock, so concurrent readers do not queue behind each other.
+    Access times are kept in memory and written to the index in one transaction every access_flush_interval
+    hits, and before every eviction, rather than committed on every hit.
+    """
+
+    def __init__(
+        self,
+        directory: str = DATA_CACHE_GRID_EXPRESSION_DIR,
+        max_bytes: int = GRID_EXPRESSION_CACHE_MAX_BYTES,
+        verify: bool = True,
+        access_flush_interval: int = GRID_EXPRESSION_CACHE_ACCESS_FLUSH_INTERVAL,
+    ):
+        if max_bytes <= 0:
+            raise ValueError("[GridExpressionCache]: max_bytes must be positive")
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.access_flush_interval = access_flush_interval
+        self.hits = 0
+        self.misses = 0
+        self._accesses: dict[tuple[int, str], float] = {}
+
+        os.makedirs(f"{directory}/objects", exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(f"{directory}/index.sqlite3", check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                section_dataset_id INTEGER NOT NULL,
+                measurement TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (section_dataset_id, measurement)
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        self._connection.commit()
+
+    def get(self, section_dataset_id: int, measurement: str) -> Optional[np.ndarray]:
+        """
+        Get a cached volume, or None if it is not cached or failed its integrity check
+        """
+        data = self.get_many(section_dataset_id, [measurement])
+        return data[measurement] if data is not None else None
+
+    def get_many(self, section_dataset_id: int, measurements: list[str]) -> Optional[dict[str, np.ndarray]]:
+        """
+        Get the cached volumes of several measurements of a section dataset.
+        Returns None unless every measurement is cached, as a partial hit still needs a download
+        """
+        with self._lock:
+            digests = {measurement: self._lookup(section_dataset_id, measurement) for measurement in measurements}
+            if None in digests.values():
+                self.misses += 1
+                return None
+
+        # objects are content-addressed and replaced atomically, so they can be read without the lock
+        data = {measurement: self._read(digest) for measurement, digest in digests.items()}
+
+        with self._lock:
+            corrupt = [measurement for measurement, volume in data.items() if volume is None]
+            for measurement in corrupt:
+                # the stored volume is missing or corrupt, drop the entry so it is downloaded again
+                if self._lookup(section_dataset_id, measurement) == digests[measurement]:
+                    self._delete(section_dataset_id, measurement, digests[measurement])
+                # the object goes even if other entries share it, or the next put of the volume would keep it
+                self._remove_object(digests[measurement])
+            if len(corrupt) > 0:
+                self._connection.commit()
+                self.misses += 1
+                return None
+
+            now = time.time()
+            for measurement in measurements:
+                self._accesses[(section_dataset_id, measurement)] = now
+            if len(self._accesses) >= self.access_flush_interval:
+                self._flush_accesses()
+                self._connection.commit()
+
+            self.hits += 1
+            return data
+
+    def put(self, section_dataset_id: int, measurement: str, volume: np.ndarray):
+        """
+        Store a volume in the cache, evicting the least recently used entries if needed
+        """
+        with self._lock:
+            self._write(section_dataset_id, measurement, volume)
+            self._flush_accesses()
+            self._evict()
+            self._connection.commit()
+
+    def put_many(self, section_dataset_id: int, data: dict[str, np.ndarray]):
+        """
+        Store the volumes of several measurements of a section dataset
+        """
+        with self._lock:
+            for measurement, volume in data.items():
+                self._write(section_dataset_id, measurement, volume)
+            self._flush_accesses()
+            self._evict()
+            self._connection.commit()
+
+    def size(self) -> int:
+        """
+        Get the total size in bytes of the volumes stored in the cache
+        """
+        with self._lock:
+            return self._size()
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counters and the size of the cache
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "size": self._size(),
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """
+        Remove every entry from the cache
+        """
+        with self._lock:
+            digests = [row[0] for row in self._connection.execute("SELECT DISTINCT digest FROM entries")]
+            self._connection.execute("DELETE FROM entries")
+            self._connection.commit()
+            self._accesses.clear()
+            for digest in digests:
+                self._remove_object(digest)
+
+    def flush(self):
+        """
+        Write the access times of the hits since the last flush to the index
+        """
+        with self._lock:
+            self._flush_accesses()
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._flush_accesses()
+            self._connection.commit()
+            self._connection.close()
+
+    def _lookup(self, section_dataset_id: int, measurement: str) -> Optional[str]:
+        row = self._connection.execute(
+            "SELECT digest FROM entries WHERE section_dataset_id = ? AND measurement = ?",
+            (section_dataset_id, measurement),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def _read(self, digest: str) -> Optional[np.ndarray]:
+        try:
+            volume = np.fromfile(self._object_path(digest), dtype=np.float32)
+        except FileNotFoundError:
+            return None
+
+        if self.verify and hashlib.sha256(volume.data).hexdigest() != digest:
+            return None
+        return volume
+
+    def _flush_accesses(self):
+        if len(self._accesses) == 0:
+            return
+
+        self._connection.executemany(
+            "UPDATE entries SET last_access = ? WHERE section_dataset_id = ? AND measurement = ?",
+            [(last_access, section_dataset_id, measurement) for (section_dataset_id, measurement), last_access in self._accesses.items()],
+        )
+        self._accesses.clear()
+
+    def _write(self, section_dataset_id: int, measurement: str, volume: np.ndarray):
+        volume = np.ascontiguousarray(volume, dtype=np.float32)
+        digest = hashlib.sha256(volume.data).hexdigest()
+        path = self._object_path(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first, so a crash never leaves a truncated object behind
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            volume.tofile(temp_path)
+            os.replace(temp_path, path)
+
+        previous = self._connection.execute(
+            "SELECT digest FROM entries WHERE section_dataset_id = ? AND measurement = ?",
+            (section_dataset_id, measurement),
+        ).fetchone()
+
+        self._connection.execute(
+            "INSERT OR REPLACE INTO entries (section_dataset_id, measurement, digest, size, last_access) VALUES (?, ?, ?, ?, ?)",
+            (section_dataset_id, measurement, digest, volume.nbytes, time.time()),
+        )
+
+        if previous is not None and previous[0] != digest:
+            self._remove_object_if_unused(previous[0])
+
+    def _evict(self):
+        while self._size() > self.max_bytes:
+            row = self._connection.execute(
+                "SELECT section_dataset_id, measurement, digest FROM entries ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return
+            self._delete(*row)
+
+    def _delete(self, section_dataset_id: int, measurement: str, digest: str):
+        self._connection.execute(
+            "DELETE FROM entries WHERE section_dataset_id = ? AND measurement = ?",
+            (section_dataset_id, measurement),
+        )
+        self._remove_object_if_unused(digest)
+
+    def _remove_object_if_unused(self, digest: str):
+        in_use = self._connection.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone()
+        if in_use is None:
+            self._remove_object(digest)
+
+    def _remove_object(self, digest: str):
+        try:
+            os.remove(self._object_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _size(self) -> int:
+        # identical volumes share one object, so each digest is only counted once
+        row = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT digest, MAX(size) AS size FROM entries GROUP BY digest)"
+        ).fetchone()
+        return row[0]
+
+    def _object_path(self, digest: str) -> str:
+        return f"{self.directory}/objects/{digest[:2]}/{digest}.raw"
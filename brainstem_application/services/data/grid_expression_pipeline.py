@@ -0,0 +1,346 @@
+"""Grid Expression Pipeline
+This module contains the GridExpressionPipeline class, which downloads grid expression data on threads and decodes
+it on a process pool into shared memory.
+"""
+
+import io
+import time
+import hashlib
+import zipfile
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+from typing import Callable, Iterator, Optional
+
+from services.data.data_retrieval_service import DataRetrievalService
+from services.data.expression_matrix_store import ExpressionMatrixStore
+from services.data.grid_expression_cache import GridExpressionCache
+from services.data.reference_space_geometry import ReferenceSpaceGeometryRegistry
+from utils.profiler import TRACER
+
+from models import SectionDataSet
+
+from constants import (
+    GRID_DOWNLOAD_MAX_WORKERS,
+    GRID_DOWNLOAD_MAX_RETRIES,
+    GRID_DOWNLOAD_BACKOFF_FACTOR,
+    GRID_PIPELINE_PROCESSES,
+    GRID_PIPELINE_SLOTS_PER_PROCESS,
+)
+
+GRID_NORMALIZATIONS = ["none", "log1p", "max"]
+
+
+def normalize_volume(volume: np.ndarray, normalization: str) -> np.ndarray:
+    """
+    Normalize a volume in place, leaving the voxels without data (-1) untouched
+    """
+    valid = volume >= 0
+
+    if normalization == "log1p":
+        np.log1p(volume, out=volume, where=valid)
+    elif normalization == "max" and valid.any():
+        maximum = volume[valid].max()
+        if maximum > 0:
+            np.divide(volume, maximum, out=volume, where=valid)
+
+    return volume
+
+
+def shard_of(section_dataset_id: int, count: int) -> int:
+    """
+    Get which of count shards a section dataset belongs to, from a hash of its ID. The shard does not depend on
+    the order of the section datasets, or on which others are pulled, so every job of a sharded pull agrees on it
+    """
+    digest = hashlib.blake2b(str(section_dataset_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def shard_section_datasets(section_datasets: list[SectionDataSet], index: int, count: int) -> list[SectionDataSet]:
+    """
+    Get the section datasets of the index-th of count shards, counting from 0
+    """
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"[GridExpressionPipeline]: shard index must be between 0 and {count - 1}. Got {index}")
+
+    return [section_dataset for section_dataset in section_datasets if shard_of(section_dataset.id, count) == index]
+
+
+def decode_into_shared_memory(
+    content: bytes, include: list[str], shared_memory_name: str, shape: tuple[int, int, int], slot: int, normalization: str
+) -> int:
+    """
+    Decode the volumes of a grid expression data zip straight into a slot of a shared memory block, and normalize
+    them in place. Runs in a worker process, and returns how long decoding took in nanoseconds, for the tracer
+    of the parent process
+    """
+    start_ns = time.perf_counter_ns()
+    block = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        volumes = np.ndarray(shape, dtype=np.float32, buffer=block.buf)[slot]
+
+        with zipfile.ZipFile(io.BytesIO(content), "r") as zip_ref:
+            for i, expression_type in enumerate(include):
+                raw = zip_ref.read(f"{expression_type}.raw")
+                if len(raw) != volumes.shape[1] * np.dtype(np.float32).itemsize:
+                    raise ValueError(
+                        f"[GridExpressionPipeline]: expected {volumes.shape[1]} voxels of {expression_type}. Got {len(raw) // 4}"
+                    )
+
+                volumes[i] = np.frombuffer(raw, dtype=np.float32)
+                normalize_volume(volumes[i], normalization)
+
+        del volumes
+        return time.perf_counter_ns() - start_ns
+    finally:
+        try:
+            block.close()
+        except BufferError:
+            # a failed decode can leave a view of the block alive in its traceback; the mapping is released with it
+            pass
+
+
+class GridExpressionPipeline:
+    """
+    A pipelined grid expression data pull.
+
+    Downloading is I/O-bound, while unzipping, converting the .raw buffers and normalizing are CPU-bound and
+    serialize on the GIL when run on the download threads. The pipeline splits the two:
+
+    1. fetch threads download the zips (or read cached volumes), at most twice the number of threads ahead;
+    2. a process pool decodes and normalizes each zip straight into a slot of a shared memory block, so the
+       volumes are never pickled back, only the zip bytes are sent to the workers;
+    3. the consumer gets the volumes as views of their slot, which is recycled once it asks for the next result.
+
+    Example:
+
+    ```python
+    for section_dataset, volumes, error in GridExpressionPipeline().iter_grid_expression_data(section_datasets, ["energy"]):
+        if error is None:
+            store.append(section_dataset.id, section_dataset.genes[0].acronym, volumes)  # copies out of the slot
+    ```
+    """
+
+    def __init__(
+        self,
+        max_workers: int = GRID_DOWNLOAD_MAX_WORKERS,
+        processes: int = GRID_PIPELINE_PROCESSES,
+        slots_per_process: int = GRID_PIPELINE_SLOTS_PER_PROCESS,
+        normalization: str = "none",
+        max_retries: int = GRID_DOWNLOAD_MAX_RETRIES,
+        backoff_factor: float = GRID_DOWNLOAD_BACKOFF_FACTOR,
+    ):
+        if max_workers < 1 or processes < 1 or slots_per_process < 1:
+            raise ValueError("[GridExpressionPipeline]: max_workers, processes and slots_per_process must be at least 1")
+        if normalization not in GRID_NORMALIZATIONS:
+            raise ValueError(f'[GridExpressionPipeline]: normalization must be one of {GRID_NORMALIZATIONS}. Got "{normalization}"')
+
+        self.max_workers = max_workers
+        self.processes = processes
+        self.n_slots = processes * slots_per_process
+        self.normalization = normalization
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+    def iter_grid_expression_data(
+        self,
+        section_datasets: list[SectionDataSet],
+        include: list[str],
+        cache: Optional[GridExpressionCache] = None,
+    ) -> Iterator[tuple[SectionDataSet, Optional[dict[str, np.ndarray]], Optional[Exception]]]:
+        """
+        Download and decode the grid expression data of many section datasets, yielding (section dataset, volumes,
+        error) tuples in completion order. Decoded volumes are views of shared memory that are only valid until
+        the next tuple is requested, so they must be copied, e.g. by ExpressionMatrixStore.append, to be kept.
+        The cache holds raw volumes: cached volumes are normalized on the fetch threads, and decoded volumes are
+        only cached when no normalization is applied
+        """
+        pending_datasets = iter(section_datasets)
+        max_in_flight = self.max_workers * 2
+
+        # the block is allocated once the first zip tells how many voxels a volume has
+        block: Optional[shared_memory.SharedMemory] = None
+        slots: Optional[np.ndarray] = None
+        free_slots = list(range(self.n_slots))
+        fetched = deque()
+
+        fetch_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # worker processes are spawned rather than forked, as forking a process with running threads is unsafe
+        decode_executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+        fetching = {}
+        decoding = {}
+
+        def fetch_next() -> bool:
+            section_dataset = next(pending_datasets, None)
+            if section_dataset is None:
+                return False
+
+            fetching[fetch_executor.submit(self._fetch, section_dataset, include, cache)] = section_dataset
+            return True
+
+        try:
+            while len(fetching) < max_in_flight and fetch_next():
+                pass
+
+            while fetching or fetched or decoding:
+                # hand the fetched zips to the free slots
+                while fetched and free_slots:
+                    section_dataset, content = fetched.popleft()
+                    slot = free_slots.pop()
+                    future = decode_executor.submit(
+                        decode_into_shared_memory, content, include, block.name, slots.shape, slot, self.normalization
+                    )
+                    decoding[future] = (section_dataset, slot)
+
+                done, _ = wait(list(fetching) + list(decoding), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future in fetching:
+                        section_dataset = fetching.pop(future)
+                        error = future.exception()
+
+                        if error is not None:
+                            yield section_dataset, None, error
+                        elif isinstance(future.result(), dict):
+                            yield section_dataset, future.result(), None
+                        else:
+                            content = future.result()
+                            if block is None:
+                                # a zip that cannot be sized fails its own section dataset, and the block is
+                                # sized by the next good one
+                                try:
+                                    n_voxels = GridExpressionPipeline._count_voxels(content, include[0])
+                                except (KeyError, ValueError, zipfile.BadZipFile) as e:
+                                    yield section_dataset, None, e
+                                    content = None
+                                else:
+                                    slots_shape = (self.n_slots, len(include), n_voxels)
+                                    block = shared_memory.SharedMemory(create=True, size=int(np.prod(slots_shape)) * 4)
+                                    slots = np.ndarray(slots_shape, dtype=np.float32, buffer=block.buf)
+                            if content is not None:
+                                fetched.append((section_dataset, content))
+
+                        # keep fetching while the zips waiting for a slot stay bounded
+                        if len(fetching) + len(fetched) < max_in_flight:
+                            fetch_next()
+                    else:
+                        section_dataset, slot = decoding.pop(future)
+                        error = future.exception()
+
+                        if error is not None:
+                            yield section_dataset, None, error
+                        else:
+                            TRACER.record("grid_data.decode", future.result(), len(include) * slots.shape[2] * slots.itemsize)
+                            volumes = {expression_type: slots[slot, i] for i, expression_type in enumerate(include)}
+                            if cache is not None and self.normalization == "none":
+                                cache.put_many(section_dataset.id, volumes)
+                            yield section_dataset, volumes, None
+
+                        free_slots.append(slot)
+                        while len(fetching) + len(fetched) < max_in_flight and fetch_next():
+                            pass
+        finally:
+            fetch_executor.shutdown(wait=True, cancel_futures=True)
+            decode_executor.shutdown(wait=True, cancel_futures=True)
+
+            if block is not None:
+                slots = None
+                block.close()
+                block.unlink()
+
+    def pull(
+        self,
+        section_datasets: list[SectionDataSet],
+        include: list[str],
+        directory: str,
+        store: Optional[ExpressionMatrixStore] = None,
+        cache: Optional[GridExpressionCache] = None,
+        on_result: Optional[Callable[[SectionDataSet, Optional[Exception], int, int], None]] = None,
+    ) -> Optional[ExpressionMatrixStore]:
+        """
+        Pull the grid expression data of section datasets into the expression matrix store in directory. Pass the
+        store of an interrupted pull, opened for appending, to resume it: the section datasets it holds are skipped.
+        Section datasets without exactly one gene are skipped too, as their rows could not be labelled.
+        on_result is called with (section dataset, error, completed, total) as each section dataset completes.
+        Returns the closed store, or None if nothing was stored
+        """
+        completed_section_dataset_ids = store.completed_section_dataset_ids() if store is not None else set()
+        pending = [
+            section_dataset
+            for section_dataset in section_datasets
+            if section_dataset.genes is not None and len(section_dataset.genes) == 1
+            and section_dataset.id not in completed_section_dataset_ids
+        ]
+
+        completed = 0
+        try:
+            for section_dataset, volumes, error in self.iter_grid_expression_data(pending, include, cache):
+                completed += 1
+
+                if error is None:
+                    # a new store is created once the first volume arrives, as that is when the number of voxels is known
+                    if store is None:
+                        n_voxels = len(next(iter(volumes.values())))
+                        store = ExpressionMatrixStore.create(
+                            directory,
+                            include,
+                            n_voxels,
+                            capacity=max(len(pending), 1),
+                            reference_space_id=section_dataset.reference_space_id,
+                            plane_of_section_id=section_dataset.plane_of_section_id,
+                        )
+
+                    # the volumes are views of shared memory, which append copies out of. A volume of another grid
+                    # than the store's is reported as the section dataset's error
+                    try:
+                        store.append(section_dataset.id, section_dataset.genes[0].acronym, volumes)
+                    except ValueError as e:
+                        error = e
+
+                if on_result is not None:
+                    on_result(section_dataset, error, completed, len(pending))
+        finally:
+            # checkpoint whatever was retrieved, so an interrupted pull can be resumed
+            if store is not None:
+                store.close()
+
+        return store
+
+    def _fetch(self, section_dataset: SectionDataSet, include: list[str], cache: Optional[GridExpressionCache]):
+        """
+        Get the cached volumes of a section dataset, or download its zip. Runs on a fetch thread
+        """
+        if cache is not None:
+            data = cache.get_many(section_dataset.id, include)
+            if data is not None:
+                return {expression_type: normalize_volume(volume, self.normalization) for expression_type, volume in data.items()}
+
+        content = DataRetrievalService._request_grid_expression_zip(
+            section_dataset.id, include, GridExpressionPipeline._read_content, self.max_retries, self.backoff_factor
+        )
+        ReferenceSpaceGeometryRegistry.register_from_zip(section_dataset.reference_space_id, content)
+        return content
+
+    @staticmethod
+    def _read_content(response) -> bytes:
+        """
+        Read the body of a grid expression data response. Runs on a fetch thread
+        """
+        with TRACER.span("grid_data.transfer") as span:
+            content = response.content
+            span.add_bytes(len(content))
+        return content
+
+    @staticmethod
+    def _count_voxels(content: bytes, expression_type: str) -> int:
+        """
+        Get the number of voxels of a volume from the uncompressed size of its .raw file, without decoding it
+        """
+        with zipfile.ZipFile(io.BytesIO(content), "r") as zip_ref:
+            n_voxels = zip_ref.getinfo(f"{expression_type}.raw").file_size // np.dtype(np.float32).itemsize
+
+        if n_voxels < 1:
+            raise ValueError(f"[GridExpressionPipeline]: the {expression_type} volume is empty")
+        return n_voxels
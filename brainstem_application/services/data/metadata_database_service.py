@@ -0,0 +1,225 @@
+"""Metadata Database Service
+This module contains the MetadataDatabaseService class, which mirrors Allen Brain Atlas metadata into a local SQLite database.
+"""
+
+import time
+import sqlite3
+from typing import Optional
+from pydantic import TypeAdapter
+
+from services.base import Service
+from services.data.data_retrieval_service import DataRetrievalService
+
+from models import Gene, GeneList, SectionDataSet, SectionDataSetList
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS planes_of_section (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    plane_of_section_name_facet INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS section_data_sets (
+    id INTEGER PRIMARY KEY,
+    reference_space_id INTEGER NOT NULL,
+    plane_of_section_id INTEGER NOT NULL,
+    delegate INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    expression INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS section_data_sets_filters
+    ON section_data_sets (reference_space_id, plane_of_section_id, delegate);
+
+CREATE TABLE IF NOT EXISTS genes (
+    id INTEGER PRIMARY KEY,
+    acronym TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS genes_acronym ON genes (acronym);
+
+CREATE TABLE IF NOT EXISTS section_data_set_genes (
+    section_data_set_id INTEGER NOT NULL,
+    gene_id INTEGER NOT NULL,
+    PRIMARY KEY (section_data_set_id, gene_id)
+);
+CREATE INDEX IF NOT EXISTS section_data_set_genes_gene ON section_data_set_genes (gene_id);
+
+CREATE TABLE IF NOT EXISTS product_genes (
+    product_id INTEGER NOT NULL,
+    gene_id INTEGER NOT NULL,
+    PRIMARY KEY (product_id, gene_id)
+);
+
+CREATE TABLE IF NOT EXISTS syncs (
+    kind TEXT NOT NULL,
+    key INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+
+class MetadataDatabaseService(Service):
+    """
+    Mirrors SectionDataSet, Gene, PlaneOfSection and the links between genes, section datasets and products
+    into indexed SQLite tables. Once a reference space or product has been synced, its queries are answered
+    offline with indexed SQL instead of a full RMA download.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        super().__init__("Metadata Database Service")
+        self.connection = connection
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def sync_reference_space(self, reference_space_id: int) -> int:
+        """
+        Download every section dataset of a reference space, replacing the ones already stored.
+        The pages bypass the request cache, so a sync stores what the server holds now.
+        Returns the number of section datasets stored
+        """
+        section_datasets = DataRetrievalService.iter_section_datasets_with_reference_space_id(
+            reference_space_id, delegate=False, should_contain_genes=False, plane_of_section_id=None, use_cache=False
+        )
+
+        count = 0
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM section_data_set_genes WHERE section_data_set_id IN (SELECT id FROM section_data_sets WHERE reference_space_id = ?)",
+                (reference_space_id,),
+            )
+            self.connection.execute("DELETE FROM section_data_sets WHERE reference_space_id = ?", (reference_space_id,))
+
+            for section_dataset in section_datasets:
+                self._insert_section_dataset(section_dataset)
+                count += 1
+
+            self._record_sync("reference_space", reference_space_id)
+
+        return count
+
+    def sync_product(self, product_id: int) -> int:
+        """
+        Download the gene set of a product, replacing the one already stored.
+        The pages bypass the request cache, so a sync stores what the server holds now.
+        Returns the number of genes stored
+        """
+        genes = DataRetrievalService.iter_geneset_from_product(product_id, use_cache=False)
+
+        count = 0
+        with self.connection:
+            self.connection.execute("DELETE FROM product_genes WHERE product_id = ?", (product_id,))
+
+            for gene in genes:
+                self._insert_gene(gene)
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO product_genes (product_id, gene_id) VALUES (?, ?)", (product_id, gene.id)
+                )
+                count += 1
+
+            self._record_sync("product", product_id)
+
+        return count
+
+    def is_reference_space_synced(self, reference_space_id: int) -> bool:
+        return self.get_sync_time("reference_space", reference_space_id) is not None
+
+    def is_product_synced(self, product_id: int) -> bool:
+        return self.get_sync_time("product", product_id) is not None
+
+    def get_sync_time(self, kind: str, key: int) -> Optional[float]:
+        """
+        Get the time a reference space or product was last synced, or None if it never was
+        """
+        row = self.connection.execute("SELECT synced_at FROM syncs WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_section_dataset_ids_with_reference_space_id(self, reference_space_id: int, delegate: bool = True, should_contain_genes: bool = True, plane_of_section_id: int = 1, exclude_failed: bool = False) -> list[SectionDataSet]:
+        """
+        Get the section datasets of a reference space, with the same filters as DataRetrievalService
+        """
+        query = "SELECT data FROM section_data_sets WHERE reference_space_id = ?"
+        parameters = [reference_space_id]
+
+        if plane_of_section_id is not None:
+            query += " AND plane_of_section_id = ?"
+            parameters.append(plane_of_section_id)
+
+        if delegate:
+            query += " AND delegate = 1"
+
+        if exclude_failed:
+            query += " AND failed = 0"
+
+        if should_contain_genes:
+            query += " AND EXISTS (SELECT 1 FROM section_data_set_genes WHERE section_data_set_id = section_data_sets.id)"
+
+        query += " ORDER BY id"
+
+        return MetadataDatabaseService._validate_rows(SectionDataSetList, self.connection.execute(query, parameters))
+
+    def get_geneset_from_product(self, product_id: int) -> list[Gene]:
+        """
+        Get the gene set of a product
+        """
+        rows = self.connection.execute(
+            "SELECT genes.data FROM product_genes JOIN genes ON genes.id = product_genes.gene_id WHERE product_genes.product_id = ? ORDER BY genes.id",
+            (product_id,),
+        )
+        return MetadataDatabaseService._validate_rows(GeneList, rows)
+
+    @staticmethod
+    def _validate_rows(adapter: TypeAdapter, rows) -> list:
+        """
+        Validate the JSON records of a query in a single call, by joining them into one JSON array
+        """
+        return adapter.validate_json(f"[{','.join(row[0] for row in rows)}]")
+
+    def _insert_section_dataset(self, section_dataset: SectionDataSet):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO section_data_sets (id, reference_space_id, plane_of_section_id, delegate, failed, expression, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                section_dataset.id,
+                section_dataset.reference_space_id,
+                section_dataset.plane_of_section_id,
+                section_dataset.delegate,
+                section_dataset.failed,
+                section_dataset.expression,
+                section_dataset.model_dump_json(),
+            ),
+        )
+
+        if section_dataset.plane_of_section is not None:
+            plane_of_section = section_dataset.plane_of_section
+            self.connection.execute(
+                "INSERT OR REPLACE INTO planes_of_section (id, name, plane_of_section_name_facet) VALUES (?, ?, ?)",
+                (plane_of_section.id, plane_of_section.name, plane_of_section.plane_of_section_name_facet),
+            )
+
+        for gene in section_dataset.genes or []:
+            self._insert_gene(gene)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO section_data_set_genes (section_data_set_id, gene_id) VALUES (?, ?)",
+                (section_dataset.id, gene.id),
+            )
+
+    def _insert_gene(self, gene: Gene):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO genes (id, acronym, data) VALUES (?, ?, ?)",
+            (gene.id, gene.acronym, gene.model_dump_json()),
+        )
+
+    def _record_sync(self, kind: str, key: int):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO syncs (kind, key, synced_at) VALUES (?, ?, ?)", (kind, key, time.time())
+        )
+
+    def docs(self):
+        return "This service mirrors Allen Brain Atlas metadata into a local SQLite database."
+
+    def startup(self):
+        pass
+
+    def cleanup(self):
+        pass
@@ -0,0 +1,170 @@
+"""Reference Space Geometry
+This module contains the ReferenceSpaceGeometry class, which shapes flat grid expression volumes into 3-D views,
+and the ReferenceSpaceGeometryRegistry, which knows the grid of every AMBA reference space.
+"""
+
+import io
+import zipfile
+import threading
+import numpy as np
+from typing import BinaryIO, Optional
+
+from utils.amba_product_loader import load_amba_reference_spaces
+
+from constants import REFERENCE_SPACE_GRIDS, PlaneOfSection
+
+# the axis of a (z, y, x) volume that each plane of section indexes
+PLANE_AXES = {
+    PlaneOfSection.CORONAL: 2,
+    PlaneOfSection.SAGITTAL: 0,
+}
+
+
+class ReferenceSpaceGeometry:
+    """
+    The expression grid of a reference space.
+
+    Grid volumes are .raw float32 files whose first axis (x, anterior-posterior) varies fastest, followed by y
+    (dorsal-ventral) and z (left-right). Their C-order shape is therefore the reversed grid size, (z, y, x), and
+    a flat volume reshapes into it without copying. Coronal planes are the x indices, sagittal planes the z ones.
+
+    Attributes:
+        reference_space_id (int): ID of the reference space.
+        name (str): Name of the reference space.
+        size (tuple[int, int, int]): Number of voxels along x, y and z, as in the DimSize of a .mhd header.
+        spacing (tuple[float, float, float]): Voxel size along x, y and z, in micrometers.
+    """
+
+    def __init__(self, reference_space_id: int, name: str, size: tuple[int, int, int], spacing: tuple[float, float, float]):
+        if len(size) != 3 or len(spacing) != 3:
+            raise ValueError(f"[ReferenceSpaceGeometry]: expected a 3-D grid. Got size {size} and spacing {spacing}")
+
+        self.reference_space_id = reference_space_id
+        self.name = name
+        self.size = tuple(int(n) for n in size)
+        self.spacing = tuple(float(s) for s in spacing)
+
+    @staticmethod
+    def from_mhd(reference_space_id: int, name: str, header: str) -> "ReferenceSpaceGeometry":
+        """
+        Build a geometry from the text of a MetaImage (.mhd) header
+        """
+        fields = {}
+        for line in header.splitlines():
+            key, separator, value = line.partition("=")
+            if separator:
+                fields[key.strip()] = value.strip()
+
+        if "DimSize" not in fields:
+            raise ValueError("[ReferenceSpaceGeometry]: the header has no DimSize")
+
+        size = tuple(int(n) for n in fields["DimSize"].split())
+        spacing = tuple(float(s) for s in fields.get("ElementSpacing", " ".join(["1"] * len(size))).split())
+        return ReferenceSpaceGeometry(reference_space_id, name, size, spacing)
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        """
+        The C-order (z, y, x) shape of a volume
+        """
+        return self.size[::-1]
+
+    @property
+    def n_voxels(self) -> int:
+        return self.size[0] * self.size[1] * self.size[2]
+
+    def reshape(self, volume: np.ndarray) -> np.ndarray:
+        """
+        Get a flat volume as a C-contiguous (z, y, x) view. Raises ValueError if that would need a copy
+        """
+        if volume.size != self.n_voxels:
+            raise ValueError(f"[ReferenceSpaceGeometry]: {self.name} volumes have {self.n_voxels} voxels. Got {volume.size}")
+
+        if not volume.flags.c_contiguous:
+            raise ValueError("[ReferenceSpaceGeometry]: the volume is not contiguous, so it cannot be reshaped without a copy")
+
+        return volume.reshape(self.shape)
+
+    def n_planes(self, plane_of_section_id: int) -> int:
+        """
+        Get the number of planes of a volume along a plane of section
+        """
+        return self.shape[ReferenceSpaceGeometry._plane_axis(plane_of_section_id)]
+
+    def plane(self, volume: np.ndarray, plane_of_section_id: int, index: int) -> np.ndarray:
+        """
+        Get one coronal or sagittal plane of a flat or 3-D volume, as a view
+        """
+        if volume.ndim == 1:
+            volume = self.reshape(volume)
+
+        axis = ReferenceSpaceGeometry._plane_axis(plane_of_section_id)
+        return volume[(slice(None),) * axis + (index,)]
+
+    @staticmethod
+    def _plane_axis(plane_of_section_id: int) -> int:
+        if plane_of_section_id not in PLANE_AXES:
+            raise ValueError(f"[ReferenceSpaceGeometry]: unknown plane of section {plane_of_section_id}")
+        return PLANE_AXES[plane_of_section_id]
+
+    def __repr__(self):
+        return f"ReferenceSpaceGeometry(id={self.reference_space_id}, name={self.name}, size={self.size}, spacing={self.spacing})"
+
+
+class ReferenceSpaceGeometryRegistry:
+    """
+    Knows the expression grid of the AMBA reference spaces, by ID.
+
+    The registry is loaded on first use from amba_reference_spaces.json and the grid sizes in constants.py.
+    The .mhd headers of downloaded grid expression zips are authoritative, so a geometry read from a header
+    replaces the built-in one.
+    """
+
+    _geometries: Optional[dict[int, ReferenceSpaceGeometry]] = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(reference_space_id: int) -> Optional[ReferenceSpaceGeometry]:
+        """
+        Get the geometry of a reference space, or None if its grid is unknown
+        """
+        return ReferenceSpaceGeometryRegistry._load().get(reference_space_id)
+
+    @staticmethod
+    def register(geometry: ReferenceSpaceGeometry):
+        ReferenceSpaceGeometryRegistry._load()[geometry.reference_space_id] = geometry
+
+    @staticmethod
+    def register_from_zip(reference_space_id: int, content: bytes | BinaryIO) -> Optional[ReferenceSpaceGeometry]:
+        """
+        Register the geometry of the first .mhd header of a grid expression zip.
+        Returns the geometry, or None if the zip has no header
+        """
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+
+        with zipfile.ZipFile(content, "r") as zip_ref:
+            header_names = [name for name in zip_ref.namelist() if name.endswith(".mhd")]
+            if len(header_names) == 0:
+                return None
+            header = zip_ref.read(header_names[0]).decode()
+
+        geometries = ReferenceSpaceGeometryRegistry._load()
+        known = geometries.get(reference_space_id)
+        geometry = ReferenceSpaceGeometry.from_mhd(
+            reference_space_id, known.name if known is not None else str(reference_space_id), header
+        )
+        geometries[reference_space_id] = geometry
+        return geometry
+
+    @staticmethod
+    def _load() -> dict[int, ReferenceSpaceGeometry]:
+        with ReferenceSpaceGeometryRegistry._lock:
+            if ReferenceSpaceGeometryRegistry._geometries is None:
+                names = {reference_space.id: reference_space.name for reference_space in load_amba_reference_spaces() or []}
+                ReferenceSpaceGeometryRegistry._geometries = {
+                    reference_space_id: ReferenceSpaceGeometry(reference_space_id, names.get(reference_space_id, str(reference_space_id)), size, spacing)
+                    for reference_space_id, (size, spacing) in REFERENCE_SPACE_GRIDS.items()
+                }
+
+            return ReferenceSpaceGeometryRegistry._geometries
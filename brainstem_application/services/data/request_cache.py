@@ -0,0 +1,166 @@
+"""Request Cache
+This module contains the RequestCache class, an in-memory memoizing layer for the JSON queries of the Allen Brain Atlas API.
+"""
+
+import time
+import threading
+import requests
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from constants import REQUEST_CACHE_TTL, REQUEST_CACHE_MAX_ENTRIES, REQUEST_CACHE_MAX_BYTES
+
+
+class _CachedResponse:
+    def __init__(self, content: bytes, etag: Optional[str], last_modified: Optional[str]):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+
+class _InFlightRequest:
+    def __init__(self):
+        self.done = threading.Event()
+        self.content: Optional[bytes] = None
+        self.error: Optional[BaseException] = None
+
+
+class RequestCache:
+    """
+    Memoizes GET requests by URL.
+
+    - Fresh: a response younger than ttl seconds is returned without any network I/O.
+    - Stale: a stale response is revalidated with If-None-Match / If-Modified-Since when the server sent an
+      ETag or Last-Modified header. A 304 refreshes it without downloading the body again.
+    - Coalesced: threads asking for a URL that is already being fetched wait for that request instead of
+      sending their own.
+
+    Only 200 responses are cached, and at most max_entries of them totalling max_bytes, evicting the least recently
+    used. A response larger than max_bytes is not cached.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], requests.Session],
+        ttl: float = REQUEST_CACHE_TTL,
+        max_entries: int = REQUEST_CACHE_MAX_ENTRIES,
+        max_bytes: int = REQUEST_CACHE_MAX_BYTES,
+    ):
+        if max_entries < 1:
+            raise ValueError("[RequestCache]: max_entries must be at least 1")
+        if max_bytes < 1:
+            raise ValueError("[RequestCache]: max_bytes must be at least 1")
+
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, _CachedResponse] = OrderedDict()
+        self._size = 0
+        self._in_flight: dict[str, _InFlightRequest] = {}
+
+    def get(self, url: str) -> bytes:
+        """
+        Get the body of a URL, from the cache when possible
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and time.monotonic() - entry.fetched_at < self.ttl:
+                self._entries.move_to_end(url)
+                self.hits += 1
+                return entry.content
+
+            in_flight = self._in_flight.get(url)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = _InFlightRequest()
+                self._in_flight[url] = in_flight
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.content
+
+        try:
+            in_flight.content = self._fetch(url, entry)
+            return in_flight.content
+        except BaseException as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[url]
+            in_flight.done.set()
+
+    def _fetch(self, url: str, stale: Optional[_CachedResponse]) -> bytes:
+        headers = {}
+        if stale is not None:
+            if stale.etag is not None:
+                headers["If-None-Match"] = stale.etag
+            if stale.last_modified is not None:
+                headers["If-Modified-Since"] = stale.last_modified
+
+        response = self.session_factory().get(url, headers=headers)
+
+        with self._lock:
+            if response.status_code == 304 and stale is not None:
+                stale.fetched_at = time.monotonic()
+                self._store(url, stale)
+                self.revalidations += 1
+                return stale.content
+
+            self.misses += 1
+            if response.status_code == 200:
+                entry = _CachedResponse(response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                self._store(url, entry)
+
+            return response.content
+
+    def _store(self, url: str, entry: _CachedResponse):
+        # called with the lock held
+        previous = self._entries.pop(url, None)
+        if previous is not None:
+            self._size -= len(previous.content)
+        if len(entry.content) > self.max_bytes:
+            return
+
+        self._entries[url] = entry
+        self._size += len(entry.content)
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted.content)
+
+    def stats(self) -> dict:
+        """
+        Get the hit, miss, revalidation and coalescing counters and the number of cached responses
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "coalesced": self.coalesced,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """
+        Drop every cached response
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
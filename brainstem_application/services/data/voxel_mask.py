@@ -0,0 +1,246 @@
+"""Voxel Mask
+This module contains the VoxelMask class, which drops invalid voxels from grid expression volumes, and the
+RegionAggregator class, which reduces voxels to one value per brain structure.
+"""
+
+import os
+import numpy as np
+from typing import Optional
+
+from services.data.expression_matrix_store import ExpressionMatrixStore
+
+from constants import VOXEL_MASK_BLOCK_SIZE
+
+MASK_FILE_NAME = "voxel_mask.npz"
+REGION_REDUCTIONS = ["mean", "max"]
+
+
+class VoxelMask:
+    """
+    A boolean mask over the flattened voxels of a grid volume, shared by every row of an expression matrix.
+
+    Grid expression volumes mark voxels without data with -1, and voxels outside the brain have no data in any
+    section dataset. The mask is computed once, then applied to every volume with a single fancy index, so the
+    invalid voxels are never carried into an export or an analysis. The kept voxel indices map every masked
+    column back to its position, and to its 3-D coordinates when the shape of the volume is known.
+
+    Example:
+
+    ```python
+    mask = VoxelMask.from_store(store, shape=(58, 41, 67))
+    masked_store = mask.compact(store, "masked_store")
+    mask.coordinates()  # n_valid x 3 (z, y, x) coordinates of the masked columns
+    ```
+    """
+
+    def __init__(self, mask: np.ndarray, shape: Optional[tuple[int, ...]] = None):
+        mask = np.asarray(mask, dtype=bool).ravel()
+        if shape is not None and int(np.prod(shape)) != mask.size:
+            raise ValueError(f"[VoxelMask]: shape {tuple(shape)} does not match {mask.size} voxels")
+
+        self.mask = mask
+        self.shape = tuple(shape) if shape is not None else None
+        self.indices = np.flatnonzero(mask)
+
+    @staticmethod
+    def from_volume(volume: np.ndarray, shape: Optional[tuple[int, ...]] = None) -> "VoxelMask":
+        """
+        Build a mask of the voxels of a single volume that have data
+        """
+        return VoxelMask(np.asarray(volume).ravel() >= 0, shape)
+
+    @staticmethod
+    def from_annotation(labels: np.ndarray, shape: Optional[tuple[int, ...]] = None) -> "VoxelMask":
+        """
+        Build a mask of the voxels of an annotation volume that belong to a brain structure
+        """
+        return VoxelMask(np.asarray(labels).ravel() > 0, shape)
+
+    @staticmethod
+    def from_store(
+        store: ExpressionMatrixStore,
+        min_valid_rows: int = 1,
+        shape: Optional[tuple[int, ...]] = None,
+        block_size: int = VOXEL_MASK_BLOCK_SIZE,
+    ) -> "VoxelMask":
+        """
+        Build a mask of the voxels that have data in at least min_valid_rows rows of every measurement of a store.
+        The matrices are read a block of rows at a time
+        """
+        mask = np.ones(store.n_voxels, dtype=bool)
+
+        for measurement in store.measurements:
+            matrix = store.matrix(measurement)
+            counts = np.zeros(store.n_voxels, dtype=np.int64)
+            for start in range(0, store.n_rows, block_size):
+                counts += (np.asarray(matrix[start:start + block_size]) >= 0).sum(axis=0)
+            mask &= counts >= min_valid_rows
+
+        return VoxelMask(mask, shape)
+
+    @property
+    def n_voxels(self) -> int:
+        return self.mask.size
+
+    @property
+    def n_valid(self) -> int:
+        return self.indices.size
+
+    def intersect(self, other: "VoxelMask") -> "VoxelMask":
+        """
+        Get the voxels kept by both masks
+        """
+        if other.n_voxels != self.n_voxels:
+            raise ValueError(f"[VoxelMask]: cannot intersect masks of {self.n_voxels} and {other.n_voxels} voxels")
+        return VoxelMask(self.mask & other.mask, self.shape or other.shape)
+
+    def apply(self, data: np.ndarray, fill_value: Optional[float] = None) -> np.ndarray:
+        """
+        Keep the masked voxels of a volume, or of every row of a matrix. If fill_value is given, the voxels
+        kept by the mask that still have no data in a row are replaced with it
+        """
+        data = np.asarray(data)
+        if data.shape[-1] != self.n_voxels:
+            raise ValueError(f"[VoxelMask]: expected {self.n_voxels} voxels. Got {data.shape[-1]}")
+
+        masked = data[..., self.indices]
+        if fill_value is not None:
+            masked[masked < 0] = fill_value
+        return masked
+
+    def expand(self, values: np.ndarray, fill_value: float = -1) -> np.ndarray:
+        """
+        Scatter masked values back into full volumes, with fill_value in the voxels that were dropped
+        """
+        values = np.asarray(values)
+        if values.shape[-1] != self.n_valid:
+            raise ValueError(f"[VoxelMask]: expected {self.n_valid} masked voxels. Got {values.shape[-1]}")
+
+        full = np.full(values.shape[:-1] + (self.n_voxels,), fill_value, dtype=values.dtype)
+        full[..., self.indices] = values
+        return full
+
+    def coordinates(self) -> np.ndarray:
+        """
+        Get the n_valid x n_dimensions grid coordinates of the masked voxels, in the axis order of the shape
+        """
+        if self.shape is None:
+            raise ValueError("[VoxelMask]: the shape of the volume is needed to compute coordinates")
+        return np.column_stack(np.unravel_index(self.indices, self.shape))
+
+    def compact(
+        self, store: ExpressionMatrixStore, directory: str, block_size: int = VOXEL_MASK_BLOCK_SIZE
+    ) -> ExpressionMatrixStore:
+        """
+        Write a copy of a store with only the masked voxels to a directory, along with the mask itself.
+        Rows are copied a block at a time. Returns the new store, open for reading
+        """
+        if store.n_voxels != self.n_voxels:
+            raise ValueError(f"[VoxelMask]: expected a store of {self.n_voxels} voxels. Got {store.n_voxels}")
+
+        masked_store = ExpressionMatrixStore.create(
+            directory,
+            store.measurements,
+            max(self.n_valid, 1),
+            capacity=max(store.n_rows, 1),
+            reference_space_id=store.reference_space_id,
+            plane_of_section_id=store.plane_of_section_id,
+        )
+
+        for start in range(0, store.n_rows, block_size):
+            blocks = {
+                measurement: self.apply(store.matrix(measurement)[start:start + block_size])
+                for measurement in store.measurements
+            }
+            for offset in range(len(next(iter(blocks.values())))):
+                masked_store.append(
+                    store.section_dataset_ids[start + offset],
+                    store.genes[start + offset],
+                    {measurement: block[offset] for measurement, block in blocks.items()},
+                )
+
+        masked_store.close()
+        self.save(directory)
+
+        return ExpressionMatrixStore(directory)
+
+    def save(self, directory: str):
+        """
+        Save the mask to a directory, usually the one of the store it was applied to
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.savez(
+            f"{directory}/{MASK_FILE_NAME}",
+            mask=self.mask,
+            shape=np.array(self.shape if self.shape is not None else [], dtype=np.int64),
+        )
+
+    @staticmethod
+    def load(directory: str) -> "VoxelMask":
+        with np.load(f"{directory}/{MASK_FILE_NAME}") as file:
+            shape = tuple(int(size) for size in file["shape"])
+            return VoxelMask(file["mask"], shape or None)
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(f"{directory}/{MASK_FILE_NAME}")
+
+    def __repr__(self):
+        return f"VoxelMask(n_valid={self.n_valid}, n_voxels={self.n_voxels}, shape={self.shape})"
+
+
+class RegionAggregator:
+    """
+    Reduces the voxels of a matrix to one value per brain structure of an annotation volume.
+
+    The voxels are sorted by structure once, when the aggregator is built. Every reduction is then a single
+    np.add.reduceat or np.maximum.reduceat over the contiguous voxels of each structure, for a block of rows at
+    a time. Voxels without data (-1) are ignored, and structures without any data in a row reduce to NaN.
+    Labels of 0 or less are outside the brain and are ignored too.
+    """
+
+    def __init__(self, labels: np.ndarray):
+        labels = np.asarray(labels).ravel()
+        in_structure = np.flatnonzero(labels > 0)
+
+        self.n_voxels = labels.size
+        self.order = in_structure[np.argsort(labels[in_structure], kind="stable")]
+        self.structure_ids, self.starts = np.unique(labels[self.order], return_index=True)
+
+    @property
+    def n_structures(self) -> int:
+        return self.structure_ids.size
+
+    def aggregate(self, matrix: np.ndarray, reduction: str = "mean", block_size: int = VOXEL_MASK_BLOCK_SIZE) -> np.ndarray:
+        """
+        Reduce every row of a matrix, or a single volume, to an n_rows x n_structures float32 array whose
+        columns follow structure_ids
+        """
+        if reduction not in REGION_REDUCTIONS:
+            raise ValueError(f'[RegionAggregator]: reduction must be one of {REGION_REDUCTIONS}. Got "{reduction}"')
+
+        is_volume = np.ndim(matrix) == 1
+        matrix = np.atleast_2d(matrix)
+        if matrix.shape[1] != self.n_voxels:
+            raise ValueError(f"[RegionAggregator]: expected {self.n_voxels} voxels. Got {matrix.shape[1]}")
+
+        result = np.full((matrix.shape[0], self.n_structures), np.nan, dtype=np.float32)
+        if self.n_structures == 0:
+            return result[0] if is_volume else result
+
+        for start in range(0, matrix.shape[0], block_size):
+            block = np.asarray(matrix[start:start + block_size], dtype=np.float32)[:, self.order]
+            valid = block >= 0
+
+            if reduction == "mean":
+                sums = np.add.reduceat(np.where(valid, block, 0), self.starts, axis=1, dtype=np.float64)
+                counts = np.add.reduceat(valid, self.starts, axis=1, dtype=np.int64)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    values = sums / counts
+            else:
+                values = np.maximum.reduceat(np.where(valid, block, -np.inf), self.starts, axis=1)
+                values[np.isneginf(values)] = np.nan
+
+            result[start:start + block_size] = values
+
+        return result[0] if is_volume else result
@@ -0,0 +1,203 @@
+"""Exporters
+This module contains the exporters that FileSaveService uses to save expression matrices in different file formats.
+"""
+
+import os
+import importlib.util
+import numpy as np
+
+from services.data.expression_matrix_store import ExpressionMatrixStore
+
+# Number of matrix rows copied at a time, which bounds the memory an export needs
+EXPORT_ROW_BLOCK_SIZE = 256
+
+
+class Exporter:
+    """
+    Base class of the expression matrix exporters. An exporter saves one measurement of an ExpressionMatrixStore,
+    with the gene and section dataset ID of every row, and can load it back
+    """
+
+    name = "Unnamed Exporter"
+    extension = ""
+    # the module an exporter needs that is not part of the requirements, if any
+    optional_dependency = None
+
+    def available(self) -> bool:
+        """
+        Whether the optional dependency of the exporter is installed
+        """
+        return self.optional_dependency is None or importlib.util.find_spec(self.optional_dependency) is not None
+
+    def export(self, store: ExpressionMatrixStore, measurement: str, path: str):
+        raise NotImplementedError(f"[{type(self).__name__}(export)]: export not implemented")
+
+    def load(self, path: str):
+        raise NotImplementedError(f"[{type(self).__name__}(load)]: load not implemented")
+
+    def _require_dependency(self):
+        if not self.available():
+            raise ImportError(
+                f"[{type(self).__name__}]: the {self.name} format requires the optional '{self.optional_dependency}' package"
+            )
+
+
+class CSVExporter(Exporter):
+    """
+    Writes a CSV file where each column is a gene and each row is a voxel
+    """
+
+    name = "CSV"
+    extension = ".csv"
+
+    def __init__(self, chunk_size: int = 4096):
+        self.chunk_size = chunk_size
+
+    def export(self, store: ExpressionMatrixStore, measurement: str, path: str):
+        import pandas as pd
+
+        matrix = store.matrix(measurement)
+
+        with open(path, "w") as file:
+            for start in range(0, store.n_voxels, self.chunk_size):
+                block = pd.DataFrame(matrix[:, start:start + self.chunk_size].T, columns=store.genes)
+                block.to_csv(file, header=start == 0, index=False, lineterminator="\n")
+
+    def load(self, path: str):
+        import pandas as pd
+
+        return pd.read_csv(path)
+
+
+class NpyExporter(Exporter):
+    """
+    Writes the gene x voxel matrix as a float32 .npy file, with the row labels in a .genes.json sidecar.
+    Loading memory-maps the file, so nothing is parsed or copied
+    """
+
+    name = "NumPy (.npy)"
+    extension = ".npy"
+
+    def export(self, store: ExpressionMatrixStore, measurement: str, path: str):
+        import json
+
+        matrix = store.matrix(measurement)
+        output = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=matrix.shape)
+
+        for start in range(0, store.n_rows, EXPORT_ROW_BLOCK_SIZE):
+            output[start:start + EXPORT_ROW_BLOCK_SIZE] = matrix[start:start + EXPORT_ROW_BLOCK_SIZE]
+
+        output.flush()
+        del output
+
+        with open(f"{os.path.splitext(path)[0]}.genes.json", "w") as file:
+            json.dump({"genes": store.genes, "section_dataset_ids": store.section_dataset_ids}, file)
+
+    def load(self, path: str):
+        return np.load(path, mmap_mode="r")
+
+
+class NpzExporter(Exporter):
+    """
+    Writes the matrix and its row labels to a single .npz archive
+    """
+
+    name = "NumPy archive (.npz)"
+    extension = ".npz"
+
+    def export(self, store: ExpressionMatrixStore, measurement: str, path: str):
+        # np.savez streams the memory-mapped matrix into the archive in buffered chunks
+        np.savez(
+            path,
+            matrix=store.matrix(measurement),
+            genes=np.array(store.genes, dtype=str),
+            section_dataset_ids=np.array(store.section_dataset_ids, dtype=np.int64),
+        )
+
+    def load(self, path: str):
+        return np.load(path)
+
+
+class ParquetExporter(Exporter):
+    """
+    Writes a Parquet file with a gene, section_dataset_id and fixed-size float32 values column per row.
+    Rows are written in row groups, and the values load back as a zero-copy NumPy view of the Arrow buffer
+    """
+
+    name = "Parquet"
+    extension = ".parquet"
+    optional_dependency = "pyarrow"
+
+    def export(self, store: ExpressionMatrixStore, measurement: str, path: str):
+        self._require_dependency()
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        matrix = store.matrix(measurement)
+        schema = pa.schema(
+            [
+                ("gene", pa.string()),
+                ("section_dataset_id", pa.int64()),
+                ("values", pa.list_(pa.float32(), store.n_voxels)),
+            ]
+        )
+
+        with pq.ParquetWriter(path, schema) as writer:
+            for start in range(0, store.n_rows, EXPORT_ROW_BLOCK_SIZE):
+                block = np.ascontiguousarray(matrix[start:start + EXPORT_ROW_BLOCK_SIZE])
+                values = pa.FixedSizeListArray.from_arrays(pa.array(block.ravel()), store.n_voxels)
+                writer.write_table(
+                    pa.Table.from_arrays(
+                        [
+                            pa.array(store.genes[start:start + EXPORT_ROW_BLOCK_SIZE], pa.string()),
+                            pa.array(store.section_dataset_ids[start:start + EXPORT_ROW_BLOCK_SIZE], pa.int64()),
+                            values,
+                        ],
+                        schema=schema,
+                    )
+                )
+
+    def load(self, path: str):
+        self._require_dependency()
+
+        import pyarrow.parquet as pq
+
+        return pq.read_table(path, memory_map=True)
+
+
+class HDF5Exporter(Exporter):
+    """
+    Writes an HDF5 file with a chunked matrix dataset, so blocks of rows or voxels can be read on their own
+    """
+
+    name = "HDF5"
+    extension = ".h5"
+    optional_dependency = "h5py"
+
+    def export(self, store: ExpressionMatrixStore, measurement: str, path: str):
+        self._require_dependency()
+
+        import h5py
+
+        matrix = store.matrix(measurement)
+
+        with h5py.File(path, "w") as file:
+            dataset = file.create_dataset(
+                "matrix",
+                shape=matrix.shape,
+                dtype=np.float32,
+                chunks=(min(max(store.n_rows, 1), 64), min(store.n_voxels, 4096)),
+            )
+            for start in range(0, store.n_rows, EXPORT_ROW_BLOCK_SIZE):
+                dataset[start:start + EXPORT_ROW_BLOCK_SIZE] = matrix[start:start + EXPORT_ROW_BLOCK_SIZE]
+
+            file.create_dataset("genes", data=np.array(store.genes, dtype=h5py.string_dtype()))
+            file.create_dataset("section_dataset_ids", data=np.array(store.section_dataset_ids, dtype=np.int64))
+
+    def load(self, path: str):
+        self._require_dependency()
+
+        import h5py
+
+        return h5py.File(path, "r")
@@ -12,9 +12,21 @@ from pydantic import BaseModel
 from constants import DATA_GENERATED_GENESET_DIR, DATA_TEMP_DIR
 
 from services.base import Service
+from services.data.expression_matrix_store import ExpressionMatrixStore
+from services.exporters import Exporter, CSVExporter, NpyExporter, NpzExporter, ParquetExporter, HDF5Exporter
+from utils.profiler import TRACER
 
 
 class FileSaveService(Service):
+    # export formats of expression matrices, keyed by the name used to select them
+    exporters: dict[str, Exporter] = {
+        "csv": CSVExporter(),
+        "npy": NpyExporter(),
+        "npz": NpzExporter(),
+        "parquet": ParquetExporter(),
+        "hdf5": HDF5Exporter(),
+    }
+
     def __init__(self):
         super().__init__("Data Retrieval Service")
 
@@ -64,6 +76,58 @@ class FileSaveService(Service):
 
         print(f"Genes exported to {new_path}")
 
+    @staticmethod
+    def register_exporter(key: str, exporter: Exporter):
+        """
+        Register an exporter, making its format available to save_expression_matrix
+        """
+        FileSaveService.exporters[key] = exporter
+
+    @staticmethod
+    def get_export_formats() -> dict[str, str]:
+        """
+        Get the keys and names of the export formats whose dependencies are installed
+        """
+        return {key: exporter.name for key, exporter in FileSaveService.exporters.items() if exporter.available()}
+
+    @staticmethod
+    def save_expression_matrix(store: ExpressionMatrixStore, measurement: str, path: str, export_format: str = "csv") -> str:
+        """
+        Save an expression matrix in the given format. The format's extension is added to the path if missing
+        """
+        if export_format not in FileSaveService.exporters:
+            raise ValueError(f'[FileSaveService]: unknown export format "{export_format}"')
+
+        exporter = FileSaveService.exporters[export_format]
+        if not path.endswith(exporter.extension):
+            path = f"{path}{exporter.extension}"
+
+        if os.path.dirname(path):
+            FileSaveService.create_directory_if_not_exists(os.path.dirname(path))
+        with TRACER.span(f"export.{export_format}") as span:
+            exporter.export(store, measurement, path)
+            span.add_bytes(os.path.getsize(path) if os.path.isfile(path) else 0)
+
+        print(f"Grid expression data exported to {path}")
+        return path
+
+    @staticmethod
+    def load_expression_matrix(path: str, export_format: str):
+        """
+        Load an expression matrix saved by save_expression_matrix
+        """
+        if export_format not in FileSaveService.exporters:
+            raise ValueError(f'[FileSaveService]: unknown export format "{export_format}"')
+
+        return FileSaveService.exporters[export_format].load(path)
+
+    @staticmethod
+    def save_expression_matrix_to_csv(store: ExpressionMatrixStore, measurement: str, path: str):
+        """
+        Save an expression matrix to a CSV file, where each column is a gene and each row is a voxel
+        """
+        return FileSaveService.save_expression_matrix(store, measurement, path, "csv")
+
     def docs(self):
         return "This service retrieves data from a data source."
 
@@ -1,70 +1,143 @@
+import os
 import json
-from typing import Optional
+import threading
+from typing import Generic, Optional, Type, TypeVar
 from pydantic import BaseModel
 from constants import BRAINSTEM_APPLICATION_DIR
 
 from models import AMBAProduct, AMBAReferenceSpace
 
+T = TypeVar("T", bound=BaseModel)
+
+
+class MetadataRegistry(Generic[T]):
+    """
+    Loads a JSON metadata file of records once, and indexes them by ID and by name.
+
+    The file is parsed lazily on the first lookup, and parsed again only when its modification time or size
+    changes, so repeated lookups cost a stat call and a dict lookup.
+    """
+
+    def __init__(self, path: str, model: Type[T], sort_key: str = "id"):
+        self.path = path
+        self.model = model
+        self.sort_key = sort_key
+
+        self._lock = threading.Lock()
+        self._stamp: Optional[tuple[int, int]] = None
+        self._records: Optional[list[T]] = None
+        self._by_id: dict[int, T] = {}
+        self._by_name: dict[str, T] = {}
+
+    def _load(self) -> bool:
+        """
+        Parse the file if it has not been parsed since it was last modified. Returns whether records are loaded
+        """
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return False
+
+        with self._lock:
+            if self._records is not None and stamp == self._stamp:
+                return True
+
+            try:
+                with open(self.path, "r") as file:
+                    records = [self.model(**record) for record in json.load(file)]
+            except Exception as e:
+                print(f"An error occurred while loading {os.path.basename(self.path)}: {e}")
+                return self._records is not None
+
+            records.sort(key=lambda record: getattr(record, self.sort_key))
+            self._records = records
+            self._by_id = {record.id: record for record in records}
+            self._by_name = {record.name: record for record in records}
+            self._stamp = stamp
+            return True
+
+    def all(self) -> Optional[list[T]]:
+        """
+        Get every record, sorted by the sort key
+        """
+        if not self._load():
+            return None
+        return list(self._records)
+
+    def get_by_id(self, record_id: int) -> Optional[T]:
+        """
+        Get a record by its ID
+        """
+        if not self._load():
+            return None
+        return self._by_id.get(record_id)
+
+    def get_by_name(self, name: str) -> Optional[T]:
+        """
+        Get a record by its name
+        """
+        if not self._load():
+            return None
+        return self._by_name.get(name)
+
+    def reload(self):
+        """
+        Parse the file again on the next lookup, even if it has not been modified
+        """
+        with self._lock:
+            self._records = None
+
+
+AMBA_PRODUCTS = MetadataRegistry(f"{BRAINSTEM_APPLICATION_DIR}/data/metadata/amba_products.json", AMBAProduct)
+AMBA_REFERENCE_SPACES = MetadataRegistry(
+    f"{BRAINSTEM_APPLICATION_DIR}/data/metadata/amba_reference_spaces.json", AMBAReferenceSpace, sort_key="age_id"
+)
+
 
 def load_amba_reference_spaces():
     """
-    Load the AMBA products from the database
+    Load the AMBA reference spaces from the database
     """
-    # Get the AMBA products from the JSON file
-
-    try:
-        with open(
-            f"{BRAINSTEM_APPLICATION_DIR}/data/metadata/amba_reference_spaces.json", "r"
-        ) as file:
-            data = json.load(file)
-            return [AMBAReferenceSpace(**product) for product in data]
-    except FileNotFoundError:
-        return None
-    except Exception as e:
-        print(f"An error occurred while loading the AMBA products: {e}")
-        return None
-    
+    return AMBA_REFERENCE_SPACES.all()
+
 
 def load_amba_products():
     """
     Load the AMBA products from the database
     """
-    # Get the AMBA products from the JSON file
-
-    try:
-        with open(
-            f"{BRAINSTEM_APPLICATION_DIR}/data/metadata/amba_products.json", "r"
-        ) as file:
-            data = json.load(file)
-            return [AMBAProduct(**product) for product in data]
-    except FileNotFoundError:
-        return None
-    except Exception as e:
-        print(f"An error occurred while loading the AMBA products: {e}")
-        return None
+    return AMBA_PRODUCTS.all()
 
 
 def get_amba_product_by_id(product_id: int):
     """
     Get an AMBA product by its ID
     """
-    products = load_amba_products()
-    if products is not None:
-        for product in products:
-            if product.id == product_id:
-                return product
-    return None
+    return AMBA_PRODUCTS.get_by_id(product_id)
+
+
+def get_amba_product_by_name(product_name: str):
+    """
+    Get an AMBA product by its name
+    """
+    return AMBA_PRODUCTS.get_by_name(product_name)
+
+
+def get_amba_reference_space_by_id(reference_space_id: int):
+    """
+    Get an AMBA reference space by its ID
+    """
+    return AMBA_REFERENCE_SPACES.get_by_id(reference_space_id)
 
 
 def get_list_of_amba_brain_atlas_products():
     """
     Get a list of AMBA product names
     """
-    products = load_amba_products()
+    products = AMBA_PRODUCTS.all()
 
-    # sort the products by ID, and only include products that has "Brain" and "Atlas" in the resource name
+    # the products are sorted by ID
     if products is not None:
-        products.sort(key=lambda x: x.id)
         return [
             (product.id, product.name)
             for product in products
@@ -76,10 +149,9 @@ def get_list_of_amba_reference_spaces():
     """
     Get a list of AMBA reference spaces, sorted by Age ID
     """
-    reference_spaces = load_amba_reference_spaces()
+    reference_spaces = AMBA_REFERENCE_SPACES.all()
 
     if reference_spaces is not None:
-        reference_spaces.sort(key=lambda x: x.age_id)
         return [(reference_space.id, reference_space.name) for reference_space in reference_spaces]
 
-    return None
\ No newline at end of file
+    return None
@@ -1,4 +1,4 @@
-from typing import Dict, Callable
+from typing import Dict, Callable, Union
 
 from utils.printer import Printer, Color
 
@@ -24,11 +24,14 @@ class Menu:
     menu.run()
     ```
 
+    The options can also be given as a function returning them, which is called when the menu is first run.
+    This defers building menus with many options, e.g. one per AMBA product, until they are opened.
+
     """
 
     def __init__(
         self,
-        options: Options,
+        options: Union[Options, Callable[[], Options]],
         start_message: str = "Please select an option from the menu below:",
         include_exit: bool = False,
         include_back: bool = True,
@@ -36,7 +39,8 @@ class Menu:
         max_page_size: int = 10,
     ):
 
-        self.options = options
+        self.options = options if not callable(options) else None
+        self.options_factory = options if callable(options) else None
         self.start_message = start_message
         self.include_exit = include_exit
         self.include_back = include_back
@@ -46,6 +50,9 @@ class Menu:
         self.current_page = 0
 
     def run(self):
+        if self.options is None:
+            self.options = self.options_factory()
+
         while True and not self.stopped:
             Printer.print(f"\n{self.start_message}\n")
 
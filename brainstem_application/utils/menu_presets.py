@@ -1,5 +1,5 @@
-import pandas as pd
-import numpy as np
+import os
+from typing import TYPE_CHECKING, Optional
 
 from utils.menu import Menu
 from utils.amba_product_loader import get_list_of_amba_brain_atlas_products, get_list_of_amba_reference_spaces
@@ -8,14 +8,20 @@ from utils.number_formatter import comma_separated_number
 from utils.printer import Printer
 from utils.input_utils import InputUtility
 
-from models import SectionDataSet
+from constants import DATA_DIR, DATA_GENERATED_EXPRESSION_STORE_DIR, DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR, DATA_GENERATED_PCA_DIR, DATA_GENERATED_TSNE_DIR, SIMILARITY_INDEX_COMPONENTS, PlaneOfSection
 
-from constants import DATA_DIR, PlaneOfSection
-from services.data.data_retrieval_service import DataRetrievalService
-from services.file_save_service import FileSaveService
+# the services pull in numpy, pandas and requests, so they are imported by the menu actions that use them, which
+# keeps them out of the startup of the application
+if TYPE_CHECKING:
+    import sqlite3
 
-# cache the list of AMBA brain atlas product names
-AMBA_BRAIN_ATLAS_PRODUCT_NAMES = get_list_of_amba_brain_atlas_products()
+    from models import SectionDataSet
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+    from services.data.metadata_database_service import MetadataDatabaseService
+
+# the local metadata database, set by main once the SQLite database is opened, and created on first use
+METADATA_DATABASE_CONNECTION: Optional["sqlite3.Connection"] = None
+METADATA_DATABASE: Optional["MetadataDatabaseService"] = None
 
 # Define options for the Data Retrieval Service menu
 
@@ -24,50 +30,183 @@ def retrieve_grid_expression_data_for_section_dataset(section_dataset_id: int, i
     """
     Retrieve grid expression data from a section dataset ID
     """
+    from services.data.data_retrieval_service import DataRetrievalService
+
     return time_function(DataRetrievalService.get_grid_expression_data)(section_dataset_id, include=included_gene_measurements)
 
 
-def retrieve_grid_expression_data(section_dataset_ids: list[SectionDataSet]):
+def retrieve_grid_expression_data(section_dataset_ids: list["SectionDataSet"]):
     """
     Retrieve grid expression data from a section dataset IDs
     """
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+    from services.data.grid_expression_cache import GridExpressionCache
+    from services.data.grid_expression_pipeline import GridExpressionPipeline
+    from services.data.reference_space_geometry import ReferenceSpaceGeometryRegistry
+
+    if not section_dataset_ids:
+        Printer.error("No section datasets to retrieve grid expression data for")
+        return
+
     included_gene_measurements = InputUtility.get_comma_separated_string_input("Which gene measurements would you like to include? (intensity, density)", valid_values=["intensity", "density"])
 
-    expression_measurements = {}
+    should_pull, store = resume_grid_expression_data_prompt(
+        included_gene_measurements, section_dataset_ids[0].reference_space_id, section_dataset_ids[0].plane_of_section_id
+    )
+    if not should_pull:
+        return
 
-    length = len(section_dataset_ids)
-    curr = 0
+    completed_section_dataset_ids = store.completed_section_dataset_ids() if store is not None else set()
+    cache = GridExpressionCache()
 
+    section_datasets = []
     for section_dataset_id in section_dataset_ids:
         if (section_dataset_id.genes is None or len(section_dataset_id.genes) != 1):
             Printer.error(f"No genes found for section dataset ID {section_dataset_id.id}")
             continue
-        
-        gene = section_dataset_id.genes[0]
-        grid_expression_data = retrieve_grid_expression_data_for_section_dataset(section_dataset_id.id, included_gene_measurements)
 
-        for expression_type, data in grid_expression_data.items():
-            if expression_type not in expression_measurements:
-                expression_measurements[expression_type] = {}
+        if section_dataset_id.id in completed_section_dataset_ids:
+            continue
+
+        section_datasets.append(section_dataset_id)
+
+    if len(completed_section_dataset_ids) > 0:
+        Printer.info(f"Skipping {comma_separated_number(len(completed_section_dataset_ids))} section datasets retrieved by the previous pull")
+
+    def print_result(section_dataset: "SectionDataSet", error: Optional[Exception], completed: int, total: int):
+        gene = section_dataset.genes[0]
+        if error is not None:
+            Printer.error(f"Failed to retrieve grid expression data for {gene.acronym} ({completed}/{total}): {error}")
+        else:
+            Printer.info(f"Retrieved grid expression data for {gene.acronym} ({completed}/{total})")
+
+    store = GridExpressionPipeline().pull(
+        section_datasets, included_gene_measurements, DATA_GENERATED_EXPRESSION_STORE_DIR, store=store, cache=cache, on_result=print_result
+    )
+
+    cache_stats = cache.stats()
+    Printer.info(f"Grid expression cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    cache.close()
+
+    if store is None:
+        return
+
+    Printer.info(f"Grid expression data stored in {DATA_GENERATED_EXPRESSION_STORE_DIR}")
+
+    store = ExpressionMatrixStore(DATA_GENERATED_EXPRESSION_STORE_DIR)
+    geometry = ReferenceSpaceGeometryRegistry.get(section_dataset_ids[0].reference_space_id)
+    shape = geometry.shape if geometry is not None and geometry.n_voxels == store.n_voxels else None
+
+    export_grid_expression_data_prompt(mask_grid_expression_data(store, shape))
+
+
+def mask_grid_expression_data(store: "ExpressionMatrixStore", shape: Optional[tuple[int, int, int]] = None) -> "ExpressionMatrixStore":
+    """
+    Drop the voxels without data in any section dataset from a store, and return the masked store. With the
+    shape of the volumes, the mask also maps the kept voxels back to their grid coordinates
+    """
+    from services.data.voxel_mask import VoxelMask
+
+    mask = time_function(VoxelMask.from_store)(store, shape=shape)
+    masked_store = time_function(mask.compact)(store, DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR)
+
+    Printer.info(f"Kept {comma_separated_number(mask.n_valid)} of {comma_separated_number(mask.n_voxels)} voxels with expression data")
+    return masked_store
+
+
+def open_analysis_store() -> Optional["ExpressionMatrixStore"]:
+    """
+    Open the masked expression matrix store for analysis, or the unmasked one if the data has not been masked
+    """
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+
+    for directory in [DATA_GENERATED_MASKED_EXPRESSION_STORE_DIR, DATA_GENERATED_EXPRESSION_STORE_DIR]:
+        if ExpressionMatrixStore.exists(directory):
+            return ExpressionMatrixStore(directory)
+
+    Printer.error("No grid expression data found. Please retrieve grid expression data first.")
+    return None
+
+
+def resume_grid_expression_data_prompt(
+    included_gene_measurements: list[str], reference_space_id: int, plane_of_section_id: int
+) -> tuple[bool, Optional["ExpressionMatrixStore"]]:
+    """
+    Offer to resume the previous grid expression pull, if one of the same measurements, reference space and plane
+    of section was interrupted. A previous pull of another reference space or plane of section is only replaced
+    once confirmed. Returns whether to pull, and the store to append to, or None to start a new pull
+    """
+    from services.data.expression_matrix_store import ExpressionMatrixStore
+
+    if not ExpressionMatrixStore.exists(DATA_GENERATED_EXPRESSION_STORE_DIR):
+        return True, None
+
+    previous_store = ExpressionMatrixStore(DATA_GENERATED_EXPRESSION_STORE_DIR)
+    previous_store.close()
+    if previous_store.n_rows == 0:
+        return True, None
+
+    if (previous_store.reference_space_id, previous_store.plane_of_section_id) != (reference_space_id, plane_of_section_id):
+        Printer.warning(
+            f"A previous pull of {comma_separated_number(previous_store.n_rows)} section datasets of reference space "
+            f"{previous_store.reference_space_id}, plane of section {previous_store.plane_of_section_id} was found. "
+            f"It cannot be resumed with reference space {reference_space_id}, plane of section {plane_of_section_id}"
+        )
+        return InputUtility.get_yes_no_input("Would you like to replace it with a new pull?"), None
+
+    if sorted(previous_store.measurements) != sorted(included_gene_measurements):
+        return True, None
+
+    if not InputUtility.get_yes_no_input(
+        f"A previous pull of {comma_separated_number(previous_store.n_rows)} section datasets was found. Would you like to resume it?"
+    ):
+        return True, None
+
+    return True, ExpressionMatrixStore(DATA_GENERATED_EXPRESSION_STORE_DIR, mode="r+")
+
+
+def export_grid_expression_data(store: "ExpressionMatrixStore", export_format: str):
+    """
+    Export every measurement of an expression matrix store in the given format
+    """
+    from services.file_save_service import FileSaveService
+
+    for expression_type in store.measurements:
+        FileSaveService.save_expression_matrix(
+            store, expression_type, f"{DATA_DIR}/grid_expression_data_{expression_type}", export_format
+        )
 
-            expression_measurements[expression_type][gene.acronym] = data
 
-        curr += 1
-        Printer.info(f"Retrieved grid expression data for {gene.acronym} ({curr}/{length})")
-        
+def export_grid_expression_data_prompt(store: "ExpressionMatrixStore"):
+    """
+    Ask which format the grid expression data should be exported in
+    """
+    from services.file_save_service import FileSaveService
 
-    # save the grid expression data to a CSV file, where each column is a gene and each row is a measurement
-    for expression_type, data in expression_measurements.items():
-        df = pd.DataFrame(data)
-        df.to_csv(f"{DATA_DIR}/grid_expression_data_{expression_type}.csv", index=False)
-      
+    Menu(
+        {
+            format_name: lambda export_format=export_format: export_grid_expression_data(store, export_format)
+            for export_format, format_name in FileSaveService.get_export_formats().items()
+        },
+        start_message="Which format would you like to export the grid expression data in?",
+        stop_on_selection=True,
+    ).run()
 
 
 def retrieve_section_dataset_ids(reference_space_id: int, is_delegate: bool, plane_of_section: int):
     """
     Retrieve section dataset IDs from a gene with a reference space
     """
-    section_dataset_ids = time_function(DataRetrievalService.get_section_dataset_ids_with_reference_space_id)(reference_space_id, delegate=is_delegate, should_contain_genes=True, plane_of_section_id=plane_of_section)
+    from services.data.data_retrieval_service import DataRetrievalService
+
+    # answer from the local metadata database when the reference space has been synced
+    metadata_database = get_metadata_database()
+    if metadata_database is not None and metadata_database.is_reference_space_synced(reference_space_id):
+        source = metadata_database
+    else:
+        source = DataRetrievalService
+
+    section_dataset_ids = time_function(source.get_section_dataset_ids_with_reference_space_id)(reference_space_id, delegate=is_delegate, should_contain_genes=True, plane_of_section_id=plane_of_section, exclude_failed=True)
 
     if section_dataset_ids is not None:
         Printer.info(f"{comma_separated_number(len(section_dataset_ids))} section dataset IDs found in reference space {reference_space_id}")
@@ -101,7 +240,17 @@ def retrieve_geneset_prompt(product_id: int, product_name: str):
     """
     Retrieve a gene set from an AMBA product
     """
-    genes = time_function(DataRetrievalService.get_geneset_from_product)(product_id)
+    from services.data.data_retrieval_service import DataRetrievalService
+    from services.file_save_service import FileSaveService
+
+    # answer from the local metadata database when the product has been synced
+    metadata_database = get_metadata_database()
+    if metadata_database is not None and metadata_database.is_product_synced(product_id):
+        source = metadata_database
+    else:
+        source = DataRetrievalService
+
+    genes = time_function(source.get_geneset_from_product)(product_id)
 
     if genes is not None:
         # remove duplicates in genes
@@ -118,30 +267,299 @@ def retrieve_geneset_prompt(product_id: int, product_name: str):
     ).run()
 
 
-AMBA_PRODUCTS_OPTIONS = {
-    product_name: lambda product_id=product_id, product_name=product_name: retrieve_geneset_prompt(product_id, product_name) 
-    for product_id, product_name in AMBA_BRAIN_ATLAS_PRODUCT_NAMES
-}
+def set_metadata_database_connection(connection: "sqlite3.Connection"):
+    """
+    Set the connection of the local metadata database that the menus query and sync
+    """
+    global METADATA_DATABASE_CONNECTION, METADATA_DATABASE
+    METADATA_DATABASE_CONNECTION = connection
+    METADATA_DATABASE = None
+
+
+def get_metadata_database() -> Optional["MetadataDatabaseService"]:
+    """
+    Get the local metadata database, creating its service on first use
+    """
+    global METADATA_DATABASE
+    if METADATA_DATABASE is None and METADATA_DATABASE_CONNECTION is not None:
+        from services.data.metadata_database_service import MetadataDatabaseService
+
+        METADATA_DATABASE = MetadataDatabaseService(METADATA_DATABASE_CONNECTION)
+
+    return METADATA_DATABASE
+
+
+def sync_metadata(sync_method: str, key: int, name: str, records: str):
+    """
+    Sync a reference space or product into the local metadata database, with the given sync method of the database
+    """
+    metadata_database = get_metadata_database()
+    if metadata_database is None:
+        Printer.error("The metadata database is not available")
+        return
+
+    try:
+        count = time_function(getattr(metadata_database, sync_method))(key)
+        Printer.success(f"Synced {comma_separated_number(count)} {records} of {name}")
+    except Exception as e:
+        Printer.error(f"An error occurred while syncing {name}: {e}")
+
+
+def sync_all_metadata():
+    """
+    Sync every reference space and product into the local metadata database
+    """
+    for reference_space_id, reference_space_name in get_list_of_amba_reference_spaces():
+        sync_metadata("sync_reference_space", reference_space_id, reference_space_name, "section datasets")
+
+    for product_id, product_name in get_list_of_amba_brain_atlas_products():
+        sync_metadata("sync_product", product_id, product_name, "genes")
+
+
+def perform_pca(store: "ExpressionMatrixStore", measurement: str, mode: str):
+    """
+    Perform a PCA on the gene x voxel matrix of a measurement, and save the result
+    """
+    import numpy as np
+    from services.analysis.pca_service import PCAService
+
+    n_components = InputUtility.get_int_input("How many principal components would you like to compute? ")
+    matrix = store.matrix(measurement)
+
+    try:
+        result = time_function(PCAService.fit)(matrix, n_components, mode=mode)
+    except ValueError as e:
+        Printer.error(str(e))
+        return
+
+    directory = f"{DATA_GENERATED_PCA_DIR}/{measurement}"
+    result.save(directory)
+    np.save(f"{directory}/scores.npy", PCAService.transform(result, matrix))
 
-AMBA_REFERENCE_SPACES_OPTIONS = {
-    reference_space_name: lambda reference_space_id=reference_space_id: retrieve_section_dataset_ids_prompt(reference_space_id)
-    for reference_space_id, reference_space_name in get_list_of_amba_reference_spaces()
-}
+    for i, ratio in enumerate(result.explained_variance_ratio):
+        Printer.print(f"PC{i + 1}: {ratio:.2%} of the variance")
+    Printer.info(f"PCA saved to {directory}")
+
+
+def perform_pca_prompt():
+    """
+    Ask which measurement and mode a PCA should be performed with
+    """
+    from services.analysis.pca_service import PCA_MODES
+
+    store = open_analysis_store()
+    if store is None:
+        return
+
+    Menu(
+        {
+            measurement: lambda measurement=measurement: Menu(
+                {mode.capitalize(): lambda mode=mode: perform_pca(store, measurement, mode) for mode in PCA_MODES},
+                start_message="Which PCA mode would you like to use?",
+                stop_on_selection=True,
+            ).run()
+            for measurement in store.measurements
+        },
+        start_message=f"Which measurement of the {comma_separated_number(store.n_rows)} section datasets would you like to perform PCA on?",
+        stop_on_selection=True,
+    ).run()
+
+
+def perform_tsne(store: "ExpressionMatrixStore", measurement: str, embed_voxels: bool):
+    """
+    Embed the genes or the voxels of a measurement with t-SNE, and save the embedding
+    """
+    import numpy as np
+    from services.analysis.embedding_service import EmbeddingService
+    from services.data.voxel_mask import VoxelMask
+
+    if len(EmbeddingService.available_backends()) == 0:
+        Printer.error("t-SNE requires the optional 'openTSNE' or 'scikit-learn' package. Please install one of them.")
+        return
+
+    perplexity = InputUtility.get_float_input("What perplexity would you like to use? (30 is a good default) ")
+    matrix = store.matrix(measurement)
+    # voxels are the columns of the gene x voxel matrix, so they are embedded as the rows of its transpose, which
+    # is copied once into a contiguous array rather than read as strided columns by the PCA and the kNN search
+    data = time_function(EmbeddingService.transpose)(matrix) if embed_voxels else matrix
+
+    try:
+        embedding = time_function(EmbeddingService.tsne)(data, perplexity=perplexity)
+    except ValueError as e:
+        Printer.error(str(e))
+        return
+
+    directory = f"{DATA_GENERATED_TSNE_DIR}/{measurement}"
+    os.makedirs(directory, exist_ok=True)
+    path = f"{directory}/{'voxels' if embed_voxels else 'genes'}.npy"
+    np.save(path, embedding)
+
+    if embed_voxels and VoxelMask.exists(store.directory):
+        # map each embedded voxel back to its index, and its (z, y, x) coordinates, in the full grid volume
+        mask = VoxelMask.load(store.directory)
+        np.save(f"{directory}/voxel_indices.npy", mask.indices)
+        if mask.shape is not None:
+            np.save(f"{directory}/voxel_coordinates.npy", mask.coordinates())
+
+    Printer.info(f"t-SNE embedding saved to {path}")
+
+
+def perform_tsne_prompt():
+    """
+    Ask which measurement, and whether its genes or voxels, t-SNE should embed
+    """
+    store = open_analysis_store()
+    if store is None:
+        return
+
+    Menu(
+        {
+            measurement: lambda measurement=measurement: Menu(
+                {
+                    "Genes": lambda: perform_tsne(store, measurement, embed_voxels=False),
+                    "Voxels": lambda: perform_tsne(store, measurement, embed_voxels=True),
+                },
+                start_message="Would you like to embed the genes or the voxels?",
+                stop_on_selection=True,
+            ).run()
+            for measurement in store.measurements
+        },
+        start_message=f"Which measurement of the {comma_separated_number(store.n_rows)} section datasets would you like to perform t-SNE on?",
+        stop_on_selection=True,
+    ).run()
+
+
+def find_coexpressed_genes(store: "ExpressionMatrixStore", measurement: str, metric: str):
+    """
+    Ask for genes and list the genes most co-expressed with each of them
+    """
+    from services.analysis.gene_similarity_service import GeneSimilarityService
+
+    similarity = time_function(GeneSimilarityService)(store, measurement, metric=metric)
+    if similarity.n_rows > 2 * SIMILARITY_INDEX_COMPONENTS:
+        time_function(similarity.build_index)()
+
+    k = InputUtility.get_int_input("How many co-expressed genes would you like to list? ")
+
+    while True:
+        gene = InputUtility.get_string_input("Which gene would you like to find co-expressed genes of? (leave empty to stop) ").strip()
+        if gene == "":
+            return
+
+        try:
+            matches = time_function(similarity.query_gene)(gene, k)
+        except KeyError as e:
+            Printer.error(str(e))
+            continue
+
+        for rank, (match_gene, section_dataset_id, score) in enumerate(matches, start=1):
+            Printer.print(f"{rank}. {match_gene} (section dataset {section_dataset_id}): {score:.3f}")
+
+
+def find_coexpressed_genes_prompt():
+    """
+    Ask which measurement and similarity metric co-expressed genes should be found with
+    """
+    from services.analysis.gene_similarity_service import SIMILARITY_METRICS
+
+    store = open_analysis_store()
+    if store is None:
+        return
+
+    Menu(
+        {
+            measurement: lambda measurement=measurement: Menu(
+                {metric.capitalize(): lambda metric=metric: find_coexpressed_genes(store, measurement, metric) for metric in SIMILARITY_METRICS},
+                start_message="Which similarity would you like to use?",
+                stop_on_selection=True,
+            ).run()
+            for measurement in store.measurements
+        },
+        start_message=f"Which measurement of the {comma_separated_number(store.n_rows)} section datasets would you like to compare genes with?",
+        stop_on_selection=True,
+    ).run()
+
+
+def print_request_cache_stats():
+    """
+    Print how many RMA queries were answered by the request cache
+    """
+    from services.data.data_retrieval_service import DataRetrievalService
+
+    stats = DataRetrievalService.get_request_cache().stats()
+    Printer.info(
+        f"Request cache: {stats['hits']} hits, {stats['revalidations']} revalidations, {stats['coalesced']} coalesced, "
+        f"{stats['misses']} misses ({stats['entries']}/{stats['max_entries']} responses, "
+        f"{stats['bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f} MiB cached)"
+    )
+
+
+# the submenus list every product and reference space, so their options are built when they are first opened
+
+
+def amba_products_options():
+    return {
+        product_name: lambda product_id=product_id, product_name=product_name: retrieve_geneset_prompt(product_id, product_name)
+        for product_id, product_name in get_list_of_amba_brain_atlas_products()
+    }
+
+
+def amba_reference_spaces_options():
+    return {
+        reference_space_name: lambda reference_space_id=reference_space_id: retrieve_section_dataset_ids_prompt(reference_space_id)
+        for reference_space_id, reference_space_name in get_list_of_amba_reference_spaces()
+    }
+
+
+def sync_reference_spaces_options():
+    return {
+        reference_space_name: lambda reference_space_id=reference_space_id, reference_space_name=reference_space_name: sync_metadata("sync_reference_space", reference_space_id, reference_space_name, "section datasets")
+        for reference_space_id, reference_space_name in get_list_of_amba_reference_spaces()
+    }
+
+
+def sync_products_options():
+    return {
+        product_name: lambda product_id=product_id, product_name=product_name: sync_metadata("sync_product", product_id, product_name, "genes")
+        for product_id, product_name in get_list_of_amba_brain_atlas_products()
+    }
+
+
+SYNC_METADATA_MENU = Menu(
+    {
+        "Sync Reference Space": lambda: Menu(
+            options=sync_reference_spaces_options,
+            start_message="Which AMBA reference space would you like to sync?",
+            stop_on_selection=True,
+            max_page_size=10,
+        ).run(),
+        "Sync Product": lambda: Menu(
+            options=sync_products_options,
+            start_message="Which AMBA product would you like to sync?",
+            stop_on_selection=True,
+            max_page_size=10,
+        ).run(),
+        "Sync Everything": sync_all_metadata,
+    },
+    start_message="What would you like to sync into the local metadata database?",
+)
 
 DATA_RETRIEVAL_MENU = Menu(
     {
         "Get Gene Set from Product": lambda: Menu(
-            options=AMBA_PRODUCTS_OPTIONS,
+            options=amba_products_options,
             start_message="Which AMBA product would you like to retrieve a gene set from?",
             stop_on_selection=True,
             max_page_size=10,
         ).run(),
         "Get Section Dataset IDs from Gene with Reference Space": lambda: Menu(
-            options=AMBA_REFERENCE_SPACES_OPTIONS,
+            options=amba_reference_spaces_options,
             start_message="Which AMBA reference space would you like to retrieve section dataset IDs from?",
             stop_on_selection=True,
             max_page_size=10,
-        ).run()
+        ).run(),
+        "Sync Metadata Database": lambda: SYNC_METADATA_MENU.run(),
+        "View Request Cache Statistics": lambda: print_request_cache_stats(),
     },
     start_message="What would you like to do with the Data Retrieval Service?",
-)
\ No newline at end of file
+)
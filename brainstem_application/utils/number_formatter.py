@@ -22,4 +22,4 @@ def format_seconds(seconds: float) -> str:
         if milliseconds >= 1:
             return f"{milliseconds:.2f}ms"
         else:
-            return f"{milliseconds:.2f}μs"
\ No newline at end of file
+            return f"{milliseconds * 1000:.2f}μs"
\ No newline at end of file
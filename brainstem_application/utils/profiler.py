@@ -1,16 +1,224 @@
+import os
+import json
+import time
+import threading
+from typing import Optional
+
 from utils.number_formatter import format_seconds
 
+
+class SpanStats:
+    """
+    Aggregates the durations of a span, and the bytes it transferred, into totals and a histogram with a
+    bucket per power of two nanoseconds
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.n_bytes = 0
+        self.buckets: dict[int, int] = {}
+
+    def add(self, duration_ns: int, n_bytes: int = 0):
+        self.count += 1
+        self.total_ns += duration_ns
+        self.min_ns = duration_ns if self.min_ns is None else min(self.min_ns, duration_ns)
+        self.max_ns = max(self.max_ns, duration_ns)
+        self.n_bytes += n_bytes
+
+        bucket = duration_ns.bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float) -> int:
+        """
+        Get an upper bound of the q-th percentile duration, in nanoseconds, from the histogram
+        """
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** bucket, self.max_ns)
+        return self.max_ns
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns // self.count if self.count else 0,
+            "min_ns": self.min_ns or 0,
+            "p50_ns": self.percentile(50),
+            "p90_ns": self.percentile(90),
+            "p99_ns": self.percentile(99),
+            "max_ns": self.max_ns,
+            "bytes": self.n_bytes,
+            "histogram": {f"<{2 ** bucket}ns": count for bucket, count in sorted(self.buckets.items())},
+        }
+
+
+class Span:
+    """
+    Times a block of code with perf_counter_ns, and records it in its tracer when the block exits
+    """
+
+    __slots__ = ("tracer", "name", "start_ns", "duration_ns", "n_bytes")
+
+    def __init__(self, tracer: "Tracer", name: str):
+        self.tracer = tracer
+        self.name = name
+        self.start_ns = 0
+        self.duration_ns = 0
+        self.n_bytes = 0
+
+    def add_bytes(self, n_bytes: int):
+        """
+        Count bytes transferred or processed by the span
+        """
+        self.n_bytes += n_bytes
+
+    def __enter__(self) -> "Span":
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration_ns = time.perf_counter_ns() - self.start_ns
+        self.tracer.record(self.name, self.duration_ns, self.n_bytes, start_ns=self.start_ns)
+
+
+class Tracer:
+    """
+    Records named spans of the hot paths, e.g. the wait for an HTTP response, the bytes transferred, zip decoding,
+    model validation and exports, into per-span statistics.
+
+    Example:
+
+    ```python
+    with TRACER.span("grid_data.transfer") as span:
+        content = response.content
+        span.add_bytes(len(content))
+
+    print(TRACER.summary())
+    ```
+
+    With record_events, every span is also kept as an event, up to max_events, so that the spans can be written
+    as a Chrome trace and viewed on a timeline in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self, record_events: bool = False, max_events: int = 1_000_000):
+        self.record_events = record_events
+        self.max_events = max_events
+
+        self._lock = threading.Lock()
+        self._stats: dict[str, SpanStats] = {}
+        self._events: list[tuple] = []
+        self._origin_ns = time.perf_counter_ns()
+
+    def span(self, name: str) -> Span:
+        """
+        Time a block of code as a span of the given name
+        """
+        return Span(self, name)
+
+    def record(self, name: str, duration_ns: int, n_bytes: int = 0, start_ns: Optional[int] = None):
+        """
+        Record a span measured elsewhere, e.g. in a worker process
+        """
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = SpanStats(name)
+            stats.add(duration_ns, n_bytes)
+
+            if self.record_events and len(self._events) < self.max_events:
+                if start_ns is None:
+                    start_ns = time.perf_counter_ns() - duration_ns
+                self._events.append((name, start_ns, duration_ns, n_bytes, threading.get_ident()))
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Get the statistics of every span, by name
+        """
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in sorted(self._stats.items())}
+
+    def summary(self) -> str:
+        """
+        Format the statistics of every span as a table
+        """
+        rows = [("Span", "Count", "Total", "Mean", "p50", "p99", "Max", "Throughput")]
+        for name, stats in self.stats().items():
+            throughput = ""
+            if stats["bytes"] > 0 and stats["total_ns"] > 0:
+                throughput = f"{stats['bytes'] / 1024 ** 2 / (stats['total_ns'] / 1e9):.2f} MB/s"
+
+            rows.append((
+                name,
+                str(stats["count"]),
+                *(format_seconds(stats[key] / 1e9) for key in ["total_ns", "mean_ns", "p50_ns", "p99_ns", "max_ns"]),
+                throughput,
+            ))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+        lines.insert(1, "  ".join("-" * width for width in widths))
+        return "\n".join(lines)
+
+    def write_json(self, path: str):
+        """
+        Write the statistics of every span to a JSON file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(self.stats(), file, indent=2)
+
+    def write_chrome_trace(self, path: str):
+        """
+        Write the recorded span events in the Chrome trace event format
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = [
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start_ns - self._origin_ns) / 1000,
+                    "dur": duration_ns / 1000,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"bytes": n_bytes} if n_bytes else {},
+                }
+                for name, start_ns, duration_ns, n_bytes, tid in self._events
+            ]
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    def reset(self):
+        """
+        Drop every recorded span
+        """
+        with self._lock:
+            self._stats.clear()
+            self._events.clear()
+
+
+# the tracer shared by the services and menus
+TRACER = Tracer()
+
+
 def time_function(func):
     """
-    Time a function
+    Time a function, print how long it took, and record it as a span named after the function
     """
-    import time
 
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        print(f"Took {format_seconds(round(end_time - start_time, 3))}")
+        with TRACER.span(getattr(func, "__qualname__", repr(func))) as span:
+            result = func(*args, **kwargs)
+        print(f"Took {format_seconds(round(span.duration_ns / 1e9, 3))}")
         return result
 
-    return wrapper
\ No newline at end of file
+    return wrapper
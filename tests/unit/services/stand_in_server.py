@@ -0,0 +1,120 @@
+"""A local stand-in for the Allen Brain Atlas API, used by the service tests"""
+
+import io
+import json
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+
+def make_grid_expression_zip(volumes: dict) -> bytes:
+    """Build a grid_data zip file holding a .raw file per measurement"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        for measurement, volume in volumes.items():
+            zip_ref.writestr(f"{measurement}.raw", np.asarray(volume, dtype=np.float32).tobytes())
+    return buffer.getvalue()
+
+
+def make_gene_record(gene_id: int, **fields) -> dict:
+    """Build a Gene record as returned by the RMA API"""
+    return {
+        "acronym": f"Gene{gene_id}",
+        "id": gene_id,
+        "name": f"gene {gene_id}",
+        "organism_id": 2,
+        "original_name": f"gene {gene_id}",
+        "original_symbol": f"Gene{gene_id}",
+        "sphinx_id": gene_id,
+        **fields,
+    }
+
+
+def make_section_dataset_record(section_dataset_id: int, **fields) -> dict:
+    """Build a SectionDataSet record as returned by the RMA API"""
+    return {
+        "delegate": True,
+        "expression": True,
+        "failed": False,
+        "failed_facet": 734881840,
+        "id": section_dataset_id,
+        "plane_of_section_id": 1,
+        "qc_date": None,
+        "reference_space_id": 9,
+        "section_thickness": 25,
+        "specimen_id": 1,
+        "sphinx_id": 1,
+        "weight": 1,
+        **fields,
+    }
+
+
+def paged_rma_route(records: list):
+    """Build a route that pages through records with the start_row and num_rows parameters of an RMA query"""
+
+    def respond(query: dict) -> dict:
+        start_row = int(query.get("start_row", ["0"])[0])
+        num_rows = int(query.get("num_rows", [str(len(records))])[0])
+        page = records[start_row:start_row + num_rows]
+        return {"success": True, "start_row": start_row, "num_rows": len(page), "total_rows": len(records), "msg": page}
+
+    return respond
+
+
+class StandInServer:
+    """
+    Serves canned responses keyed by request path. A response is either a (status, bytes) tuple,
+    a dict served as JSON, a list of responses consumed one request at a time with the last one repeating,
+    or a callable taking the parsed query string and returning a response
+    """
+
+    def __init__(self, routes: dict = None):
+        self.routes = routes or {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                with server._lock:
+                    server.requests.append((parsed.path, parse_qs(parsed.query)))
+                    status, body = server._next_response(parsed.path, parse_qs(parsed.query))
+
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    def _next_response(self, path: str, query: dict):
+        response = self.routes.get(path, (404, b""))
+        if callable(response):
+            response = response(query)
+        if isinstance(response, list):
+            response = response.pop(0) if len(response) > 1 else response[0]
+        if isinstance(response, dict):
+            return 200, json.dumps(response).encode()
+        return response
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._httpd.shutdown()
+        self._httpd.server_close()
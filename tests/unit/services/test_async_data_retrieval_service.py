@@ -0,0 +1,162 @@
+import time
+import asyncio
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.services.data.async_data_retrieval_service import (
+    AsyncDataRetrievalService,
+    AsyncRateLimiter,
+    GridExpressionDownloadError,
+)
+from brainstem_application.models import SectionDataSet
+from tests.unit.services.stand_in_server import (
+    StandInServer,
+    make_gene_record,
+    make_grid_expression_zip,
+    make_section_dataset_record,
+    paged_rma_route,
+)
+
+
+@unittest.skipUnless(AsyncDataRetrievalService.available(), "aiohttp is not installed")
+class TestAsyncDataRetrievalService(unittest.TestCase):
+
+    def run_with_service(self, routes: dict, coroutine_function, **service_options):
+        """Run a coroutine function with a service pointed at a stand-in server, returning its result and the requests"""
+
+        async def run():
+            async with AsyncDataRetrievalService(**service_options) as service:
+                return await coroutine_function(service)
+
+        with StandInServer(routes) as server, mock.patch.object(AsyncDataRetrievalService, "api_url", server.url):
+            return asyncio.run(run()), server.requests
+
+    def test_service_name(self):
+        self.assertEqual(AsyncDataRetrievalService().get_name(), "Async Data Retrieval Service")
+
+    def test_get_grid_expression_data_batch(self):
+        routes = {
+            f"/grid_data/download/{i}": (200, make_grid_expression_zip({"density": np.full(4, i)}))
+            for i in range(1, 6)
+        }
+        routes["/grid_data/download/3"] = [(503, b""), routes["/grid_data/download/3"]]
+        routes["/grid_data/download/6"] = (404, b"")
+
+        section_datasets = [SectionDataSet(**make_section_dataset_record(i)) for i in range(1, 7)]
+        (results, failures), requests = self.run_with_service(
+            routes,
+            lambda service: service.get_grid_expression_data_batch(section_datasets, ["density"], backoff_factor=0),
+            max_concurrent=2,
+            min_interval=0,
+        )
+
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        np.testing.assert_array_equal(results[3]["density"], np.full(4, 3, dtype=np.float32))
+        self.assertIsInstance(failures[6], GridExpressionDownloadError)
+        self.assertEqual(len([path for path, _ in requests if path.endswith("/3")]), 2)
+        self.assertEqual(len([path for path, _ in requests if path.endswith("/6")]), 1)
+
+    def test_timeouts_are_retried(self):
+        async def download(service):
+            session = service.get_session()
+            get = session.get
+            attempts = []
+
+            def time_out_once(*args, **kwargs):
+                attempts.append(args)
+                if len(attempts) == 1:
+                    raise asyncio.TimeoutError()
+                return get(*args, **kwargs)
+
+            with mock.patch.object(session, "get", side_effect=time_out_once):
+                data = await service._download_grid_expression_data(1, ["density"], max_retries=1, backoff_factor=0)
+
+            with mock.patch.object(session, "get", side_effect=asyncio.TimeoutError()):
+                with self.assertRaises(GridExpressionDownloadError):
+                    await service._download_grid_expression_data(1, ["density"], max_retries=1, backoff_factor=0)
+
+            return data, len(attempts)
+
+        (data, attempts), requests = self.run_with_service(
+            {"/grid_data/download/1": (200, make_grid_expression_zip({"density": np.full(4, 1)}))}, download, min_interval=0
+        )
+
+        np.testing.assert_array_equal(data["density"], np.full(4, 1, dtype=np.float32))
+        self.assertEqual(attempts, 2)
+        self.assertEqual(len(requests), 1)
+
+    def test_get_grid_expression_data_error(self):
+        with mock.patch("builtins.print"):
+            data, _ = self.run_with_service(
+                {"/grid_data/download/1": (500, b"")},
+                lambda service: service.get_grid_expression_data(1, ["density"]),
+            )
+
+        self.assertIsNone(data)
+
+    def test_get_geneset_from_product_is_paged(self):
+        routes = {"/api/v2/data/Gene/query.json": paged_rma_route([make_gene_record(i) for i in range(5)])}
+
+        async def get_genes(service):
+            return [gene async for gene in service.iter_geneset_from_product(1, page_size=2)]
+
+        genes, requests = self.run_with_service(routes, get_genes)
+
+        self.assertEqual([gene.id for gene in genes], list(range(5)))
+        self.assertEqual([query["start_row"][0] for _, query in requests], ["0", "2", "4"])
+
+    def test_get_section_dataset_ids_with_reference_space_id(self):
+        records = [
+            make_section_dataset_record(1, genes=[make_gene_record(1)]),
+            make_section_dataset_record(2, genes=[]),
+        ]
+        routes = {"/api/v2/data/SectionDataSet/query.json": paged_rma_route(records)}
+
+        sections, requests = self.run_with_service(
+            routes, lambda service: service.get_section_dataset_ids_with_reference_space_id(9, exclude_failed=True)
+        )
+
+        self.assertEqual([section.id for section in sections], [1])
+        self.assertEqual(
+            requests[0][1]["criteria"][0], "[delegate$eqtrue][plane_of_section_id$eq1][failed$eqfalse],reference_space[id$eq9]"
+        )
+
+    def test_failed_rma_query(self):
+        routes = {"/api/v2/data/Gene/query.json": {"success": False, "msg": "Invalid criteria"}}
+
+        with mock.patch("builtins.print"):
+            genes, _ = self.run_with_service(routes, lambda service: service.get_geneset_from_product(1))
+
+        self.assertIsNone(genes)
+
+
+class TestAsyncRateLimiter(unittest.TestCase):
+
+    def test_limits_concurrency_and_spaces_requests(self):
+        in_flight = 0
+        max_in_flight = 0
+        starts = []
+
+        async def request(limiter: AsyncRateLimiter):
+            nonlocal in_flight, max_in_flight
+            async with limiter:
+                starts.append(time.monotonic())
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+
+        async def run():
+            limiter = AsyncRateLimiter(max_concurrent=2, min_interval=0.005)
+            await asyncio.gather(*(request(limiter) for _ in range(8)))
+
+        asyncio.run(run())
+
+        self.assertEqual(max_in_flight, 2)
+        self.assertGreaterEqual(min(np.diff(sorted(starts))), 0.004)
+
+    def test_invalid_max_concurrent(self):
+        with self.assertRaises(ValueError):
+            AsyncRateLimiter(max_concurrent=0)
@@ -1,10 +1,44 @@
 import os
+import re
 import unittest
+from unittest import mock
 
+import numpy as np
 
 from brainstem_application.services.data.data_retrieval_service import (
     DataRetrievalService,
+    GridExpressionDownloadError,
 )
+from brainstem_application.models import SectionDataSet
+from tests.unit.services.stand_in_server import (
+    StandInServer,
+    make_gene_record,
+    make_grid_expression_zip,
+    make_section_dataset_record,
+    paged_rma_route,
+)
+
+
+def make_section_dataset(section_dataset_id: int) -> SectionDataSet:
+    return SectionDataSet(**make_section_dataset_record(section_dataset_id))
+
+
+def filtering_rma_route(records: list):
+    """
+    Build a route that applies the [attribute$eqvalue] filters of the criteria like the RMA API, then pages
+    through the matching records
+    """
+
+    def respond(query: dict) -> dict:
+        model_criteria = query["criteria"][0].split("reference_space")[0]
+        filters = re.findall(r"\[(\w+)\$eq(\w+)\]", model_criteria)
+        matching = [
+            record for record in records
+            if all(str(record[attribute]).lower() == value for attribute, value in filters)
+        ]
+        return paged_rma_route(matching)(query)
+
+    return respond
 
 
 class TestDataRetrievalService(unittest.TestCase):
@@ -12,3 +46,96 @@ class TestDataRetrievalService(unittest.TestCase):
     def test_service_name(self):
         service = DataRetrievalService()
         self.assertEqual(service.get_name(), "Data Retrieval Service")
+
+    def test_get_grid_expression_data_batch(self):
+        routes = {
+            f"/grid_data/download/{i}": (200, make_grid_expression_zip({"density": np.full(4, i)}))
+            for i in range(1, 6)
+        }
+        # the first request fails with a retryable error, the retry succeeds
+        routes["/grid_data/download/3"] = [(503, b""), routes["/grid_data/download/3"]]
+        # a missing dataset is not retried
+        routes["/grid_data/download/6"] = (404, b"")
+
+        progress = []
+
+        with StandInServer(routes) as server, mock.patch.object(DataRetrievalService, "api_url", server.url):
+            results, failures = DataRetrievalService.get_grid_expression_data_batch(
+                [make_section_dataset(i) for i in range(1, 7)],
+                include=["density"],
+                max_workers=3,
+                backoff_factor=0,
+                on_progress=lambda section_dataset, data, error: progress.append(section_dataset.id),
+            )
+
+            missing_requests = [path for path, _ in server.requests if path.endswith("/6")]
+
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        for section_dataset_id, data in results.items():
+            np.testing.assert_array_equal(data["density"], np.full(4, section_dataset_id, dtype=np.float32))
+
+        self.assertEqual(list(failures), [6])
+        self.assertIsInstance(failures[6], GridExpressionDownloadError)
+        self.assertEqual(len(missing_requests), 1)
+        self.assertEqual(sorted(progress), [1, 2, 3, 4, 5, 6])
+
+    def test_invalid_max_workers(self):
+        with self.assertRaises(ValueError):
+            list(DataRetrievalService.iter_grid_expression_data_batch([], ["density"], max_workers=0))
+
+    def test_get_geneset_from_product_is_paged(self):
+        routes = {"/api/v2/data/Gene/query.json": paged_rma_route([make_gene_record(i) for i in range(5)])}
+
+        with StandInServer(routes) as server, mock.patch.object(DataRetrievalService, "api_url", server.url):
+            genes = list(DataRetrievalService.iter_geneset_from_product(1, page_size=2))
+            pages = [query["start_row"][0] for _, query in server.requests]
+
+        self.assertEqual([gene.id for gene in genes], list(range(5)))
+        self.assertEqual(pages, ["0", "2", "4"])
+
+    def test_repeated_rma_query_is_cached(self):
+        routes = {"/api/v2/data/Gene/query.json": paged_rma_route([make_gene_record(i) for i in range(3)])}
+
+        with StandInServer(routes) as server, mock.patch.object(DataRetrievalService, "api_url", server.url):
+            first = DataRetrievalService.get_geneset_from_product(7)
+            second = DataRetrievalService.get_geneset_from_product(7)
+            requests = len(server.requests)
+
+        self.assertEqual([gene.id for gene in second], [gene.id for gene in first])
+        self.assertEqual(requests, 1)
+
+    def test_failed_rma_query(self):
+        routes = {"/api/v2/data/Gene/query.json": {"success": False, "msg": "Invalid criteria"}}
+
+        with StandInServer(routes) as server, mock.patch.object(DataRetrievalService, "api_url", server.url):
+            with mock.patch("builtins.print"):
+                self.assertIsNone(DataRetrievalService.get_geneset_from_product(1))
+
+    def test_section_dataset_filters_are_applied_by_the_server(self):
+        records = [
+            make_section_dataset_record(1, genes=[make_gene_record(1)]),
+            make_section_dataset_record(2, genes=[make_gene_record(2)], delegate=False),
+            make_section_dataset_record(3, genes=[make_gene_record(3)], plane_of_section_id=2),
+            make_section_dataset_record(4, genes=[make_gene_record(4)], failed=True),
+            make_section_dataset_record(5, genes=[]),
+        ]
+        routes = {"/api/v2/data/SectionDataSet/query.json": filtering_rma_route(records)}
+
+        with StandInServer(routes) as server, mock.patch.object(DataRetrievalService, "api_url", server.url):
+            filtered = DataRetrievalService.get_section_dataset_ids_with_reference_space_id(
+                9, delegate=True, plane_of_section_id=1, exclude_failed=True
+            )
+            unfiltered = DataRetrievalService.get_section_dataset_ids_with_reference_space_id(
+                9, delegate=False, should_contain_genes=False, plane_of_section_id=None
+            )
+            queries = [query for _, query in server.requests]
+
+        self.assertEqual([section.id for section in filtered], [1])
+        self.assertEqual([section.id for section in unfiltered], [1, 2, 3, 4, 5])
+
+        self.assertEqual(
+            queries[0]["criteria"][0],
+            "[delegate$eqtrue][plane_of_section_id$eq1][failed$eqfalse],reference_space[id$eq9]",
+        )
+        self.assertEqual(queries[1]["criteria"][0], "reference_space[id$eq9]")
+        self.assertIn("genes.acronym", queries[0]["only"][0].split(","))
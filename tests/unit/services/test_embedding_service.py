@@ -0,0 +1,115 @@
+import tempfile
+import importlib.util
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.services.analysis.embedding_service import EmbeddingService, KNNGraphCache
+
+
+def make_clusters(n_per_cluster: int = 40, n_features: int = 10) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((3, n_features)) * 20
+    return np.vstack([center + rng.standard_normal((n_per_cluster, n_features)) for center in centers]).astype(np.float32)
+
+
+class TestEmbeddingService(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_clusters()
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = KNNGraphCache(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_service_name(self):
+        self.assertEqual(EmbeddingService().get_name(), "Embedding Service")
+
+    def test_knn_graph_matches_brute_force(self):
+        indices, distances = EmbeddingService.compute_knn_graph(self.data, 5, block_size=7)
+
+        pairwise = np.linalg.norm(self.data[:, None] - self.data[None, :], axis=2)
+        np.fill_diagonal(pairwise, np.inf)
+        expected = np.sort(pairwise, axis=1)[:, :5]
+
+        np.testing.assert_allclose(distances, expected, rtol=1e-3, atol=1e-3)
+        self.assertFalse(np.any(indices == np.arange(len(self.data))[:, None]))
+
+    @unittest.skipUnless(EmbeddingService.approximate_knn_backend() is not None, "no approximate kNN package is installed")
+    def test_approximate_knn_graph_recall(self):
+        exact, _ = EmbeddingService.compute_knn_graph(self.data, 10, method="exact")
+        approximate, distances = EmbeddingService.compute_knn_graph(self.data, 10, method="approximate", seed=0)
+
+        recall = np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approximate, exact)])
+
+        self.assertGreater(recall, 0.9)
+        self.assertEqual((approximate.shape, distances.dtype), ((120, 10), np.float32))
+        self.assertFalse(np.any(approximate == np.arange(len(self.data))[:, None]))
+
+    def test_resolve_knn_method(self):
+        self.assertEqual(EmbeddingService.resolve_knn_method(100), "exact")
+        self.assertEqual(EmbeddingService.resolve_knn_method(100, "approximate"), "approximate")
+        with mock.patch.object(EmbeddingService, "approximate_knn_backend", return_value="pynndescent"):
+            self.assertEqual(EmbeddingService.resolve_knn_method(10**6), "approximate")
+        with mock.patch.object(EmbeddingService, "approximate_knn_backend", return_value=None):
+            self.assertEqual(EmbeddingService.resolve_knn_method(10**6), "exact")
+        with self.assertRaises(ValueError):
+            EmbeddingService.resolve_knn_method(100, "hnsw")
+
+    def test_transpose(self):
+        with mock.patch("brainstem_application.services.analysis.embedding_service.DATA_CACHE_DIR", self.directory.name):
+            transposed = EmbeddingService.transpose(self.data, block_size=7)
+
+        self.assertTrue(transposed.flags.c_contiguous)
+        np.testing.assert_array_equal(transposed, self.data.T)
+
+    def test_knn_graph_cache_answers_smaller_queries(self):
+        indices, _ = self.cache.get(self.data, 10)
+
+        with mock.patch.object(EmbeddingService, "compute_knn_graph") as compute_knn_graph:
+            cached_indices, _ = self.cache.get(self.data, 5)
+
+        compute_knn_graph.assert_not_called()
+        np.testing.assert_array_equal(cached_indices, indices[:, :5])
+
+    def test_conditional_probabilities_match_perplexity(self):
+        _, distances = EmbeddingService.compute_knn_graph(self.data, 30)
+        conditional = EmbeddingService.conditional_probabilities(distances, perplexity=10)
+
+        entropy = -(conditional * np.log(np.maximum(conditional, 1e-300))).sum(axis=1)
+
+        np.testing.assert_allclose(conditional.sum(axis=1), 1.0, rtol=1e-9)
+        np.testing.assert_allclose(entropy, np.log(10), atol=1e-4)
+
+    @unittest.skipUnless(importlib.util.find_spec("scipy") is not None, "scipy is not installed")
+    def test_joint_probabilities_are_symmetric(self):
+        indices, distances = EmbeddingService.compute_knn_graph(self.data, 30)
+        probabilities = EmbeddingService.joint_probabilities(indices, distances, perplexity=10)
+
+        self.assertAlmostEqual(probabilities.sum(), 1.0, places=6)
+        self.assertAlmostEqual(abs(probabilities - probabilities.T).max(), 0.0, places=12)
+
+    @unittest.skipUnless("sklearn" in EmbeddingService.available_backends(), "scikit-learn is not installed")
+    def test_tsne_separates_clusters(self):
+        embedding = EmbeddingService.tsne(
+            self.data, perplexity=10, pca_components=5, backend="sklearn", cache=self.cache, seed=0
+        )
+
+        self.assertEqual(embedding.shape, (120, 2))
+        centers = np.array([embedding[i * 40:(i + 1) * 40].mean(axis=0) for i in range(3)])
+        spread = max(embedding[i * 40:(i + 1) * 40].std(axis=0).max() for i in range(3))
+        self.assertGreater(np.linalg.norm(centers[0] - centers[1]), spread)
+
+    @unittest.skipUnless("sklearn" in EmbeddingService.available_backends(), "scikit-learn is not installed")
+    def test_tsne_without_a_seed_reuses_the_knn_graph(self):
+        with mock.patch.object(EmbeddingService, "compute_knn_graph", wraps=EmbeddingService.compute_knn_graph) as compute_knn_graph:
+            for perplexity in [10, 5]:
+                EmbeddingService.tsne(self.data, perplexity=perplexity, pca_components=5, backend="sklearn", cache=self.cache)
+
+        compute_knn_graph.assert_called_once()
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            EmbeddingService.tsne(self.data, backend="umap")
@@ -0,0 +1,117 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from brainstem_application.services.data.expression_matrix_store import ExpressionMatrixStore
+
+
+class TestExpressionMatrixStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_store(self, rows: int = 3, capacity: int = 2) -> ExpressionMatrixStore:
+        store = ExpressionMatrixStore.create(self.directory.name, ["density", "intensity"], n_voxels=5, capacity=capacity)
+        for i in range(rows):
+            store.append(100 + i, f"Gene{i}", {"density": np.full(5, i), "intensity": np.arange(5) + i})
+        return store
+
+    def test_append_grows_capacity(self):
+        store = self.create_store(rows=3, capacity=2)
+
+        self.assertEqual(store.n_rows, 3)
+        self.assertEqual(store.capacity, 4)
+        np.testing.assert_array_equal(store.row("density", 2), np.full(5, 2, dtype=np.float32))
+
+    def test_reopen(self):
+        self.create_store().close()
+
+        store = ExpressionMatrixStore(self.directory.name)
+
+        self.assertEqual(store.genes, ["Gene0", "Gene1", "Gene2"])
+        self.assertEqual(store.section_dataset_ids, [100, 101, 102])
+        self.assertEqual(store.matrix("intensity").shape, (3, 5))
+        np.testing.assert_array_equal(store.columns("intensity", slice(1, 3)), [[1, 2], [2, 3], [3, 4]])
+        np.testing.assert_array_equal(store.rows("density", [0, 2])[:, 0], [0, 2])
+
+    def test_read_only(self):
+        self.create_store().close()
+
+        store = ExpressionMatrixStore(self.directory.name)
+
+        with self.assertRaises(PermissionError):
+            store.append(1, "Gene", {"density": np.zeros(5), "intensity": np.zeros(5)})
+
+    def test_invalid_volumes(self):
+        store = self.create_store(rows=0)
+
+        with self.assertRaises(ValueError):
+            store.append(1, "Gene", {"density": np.zeros(5)})
+        with self.assertRaises(ValueError):
+            store.append(1, "Gene", {"density": np.zeros(4), "intensity": np.zeros(4)})
+
+    def test_missing_store(self):
+        with self.assertRaises(FileNotFoundError):
+            ExpressionMatrixStore(f"{self.directory.name}/missing")
+
+    def test_pull_is_recorded(self):
+        ExpressionMatrixStore.create(self.directory.name, ["density"], n_voxels=2, reference_space_id=9, plane_of_section_id=2).close()
+
+        store = ExpressionMatrixStore(self.directory.name)
+
+        self.assertEqual((store.reference_space_id, store.plane_of_section_id), (9, 2))
+
+    def test_checkpoint_and_resume(self):
+        store = ExpressionMatrixStore.create(self.directory.name, ["density"], n_voxels=2, checkpoint_interval=2)
+        for i in range(3):
+            store.append(i, f"Gene{i}", {"density": np.full(2, i)})
+
+        # the third row was appended after the last checkpoint, so it is not part of the manifest yet
+        resumed = ExpressionMatrixStore(self.directory.name, mode="r+")
+        self.assertEqual(resumed.completed_section_dataset_ids(), {0, 1})
+
+        resumed.append(2, "Gene2", {"density": np.full(2, 5)})
+        resumed.close()
+
+        store = ExpressionMatrixStore(self.directory.name)
+        self.assertEqual(store.section_dataset_ids, [0, 1, 2])
+        np.testing.assert_array_equal(store.row("density", 2), [5, 5])
+
+    def create_fragment(self, index: int, count: int, rows: dict) -> str:
+        directory = ExpressionMatrixStore.fragment_directory(self.directory.name, index, count)
+        fragment = ExpressionMatrixStore.create(directory, ["density"], n_voxels=3, capacity=1)
+        for section_dataset_id, gene in rows.items():
+            fragment.append(section_dataset_id, gene, {"density": np.full(3, section_dataset_id)})
+        fragment.close()
+        return directory
+
+    def test_merge_fragments(self):
+        fragments = [
+            self.create_fragment(0, 3, {5: "Shh", 1: "Gad1", 7: "Pvalb"}),
+            self.create_fragment(1, 3, {}),
+            self.create_fragment(2, 3, {3: "Gad1", 4: "Calb1", 7: "Pvalb"}),
+        ]
+
+        self.assertEqual(ExpressionMatrixStore.find_fragments(self.directory.name), {3: fragments})
+
+        store = ExpressionMatrixStore.merge(list(reversed(fragments)), f"{self.directory.name}/merged", block_size=2)
+
+        self.assertEqual(store.genes, ["Calb1", "Gad1", "Gad1", "Pvalb", "Shh"])
+        self.assertEqual(store.section_dataset_ids, [4, 1, 3, 7, 5])
+        np.testing.assert_array_equal(store.matrix("density")[:, 0], [4, 1, 3, 7, 5])
+
+    def test_merge_mismatched_fragments(self):
+        fragment = self.create_fragment(0, 2, {1: "Gad1"})
+        other = ExpressionMatrixStore.fragment_directory(self.directory.name, 1, 2)
+        ExpressionMatrixStore.create(other, ["density"], n_voxels=4).close()
+
+        with self.assertRaises(ValueError):
+            ExpressionMatrixStore.merge([fragment, other], f"{self.directory.name}/merged")
+        with self.assertRaises(ValueError):
+            ExpressionMatrixStore.merge([fragment], fragment)
+        with self.assertRaises(ValueError):
+            ExpressionMatrixStore.merge([], f"{self.directory.name}/merged")
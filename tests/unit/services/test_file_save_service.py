@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.services.file_save_service import FileSaveService
+from brainstem_application.services.data.expression_matrix_store import ExpressionMatrixStore
+
+
+class TestFileSaveService(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = ExpressionMatrixStore.create(f"{self.directory.name}/store", ["density"], n_voxels=3)
+        self.store.append(1, "GeneA", {"density": np.array([0.5, -1, 2])})
+        self.store.append(2, "GeneB", {"density": np.array([1, 1, 1])})
+        self.expected = np.array([[0.5, -1, 2], [1, 1, 1]], dtype=np.float32)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def save_and_load(self, export_format: str):
+        with mock.patch("builtins.print"):
+            path = FileSaveService.save_expression_matrix(
+                self.store, "density", f"{self.directory.name}/export", export_format
+            )
+        return FileSaveService.load_expression_matrix(path, export_format)
+
+    def test_csv(self):
+        data = self.save_and_load("csv")
+        self.assertEqual(list(data.columns), ["GeneA", "GeneB"])
+        np.testing.assert_array_equal(data.to_numpy().T, self.expected)
+
+    def test_npy(self):
+        matrix = self.save_and_load("npy")
+        self.assertIsInstance(matrix, np.memmap)
+        self.assertEqual(matrix.dtype, np.float32)
+        np.testing.assert_array_equal(matrix, self.expected)
+        self.assertTrue(os.path.exists(f"{self.directory.name}/export.genes.json"))
+
+    def test_npz(self):
+        archive = self.save_and_load("npz")
+        np.testing.assert_array_equal(archive["matrix"], self.expected)
+        self.assertEqual(list(archive["genes"]), ["GeneA", "GeneB"])
+
+    @unittest.skipUnless(FileSaveService.exporters["parquet"].available(), "pyarrow is not installed")
+    def test_parquet(self):
+        table = self.save_and_load("parquet")
+        values = table.column("values").combine_chunks().values.to_numpy().reshape(-1, 3)
+        np.testing.assert_array_equal(values, self.expected)
+        self.assertEqual(table.column("gene").to_pylist(), ["GeneA", "GeneB"])
+
+    @unittest.skipUnless(FileSaveService.exporters["hdf5"].available(), "h5py is not installed")
+    def test_hdf5(self):
+        with self.save_and_load("hdf5") as file:
+            np.testing.assert_array_equal(file["matrix"][:], self.expected)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            FileSaveService.save_expression_matrix(self.store, "density", "export", "xlsx")
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.services.analysis.gene_similarity_service import GeneSimilarityService
+from brainstem_application.services.data.expression_matrix_store import ExpressionMatrixStore
+
+
+class TestGeneSimilarityService(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        # 60 genes made of 3 expression patterns, plus noise
+        rng = np.random.default_rng(0)
+        patterns = rng.random((3, 200)).astype(np.float32) * 10
+        self.matrix = (patterns[np.arange(60) % 3] + rng.random((60, 200)).astype(np.float32)).astype(np.float32)
+        self.matrix[:, :5] = -1
+
+        self.store = ExpressionMatrixStore.create(f"{self.directory.name}/store", ["energy"], n_voxels=200)
+        for i, row in enumerate(self.matrix):
+            self.store.append(1000 + i, f"Gene{i}", {"energy": row})
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def create_service(self, metric: str = "pearson") -> GeneSimilarityService:
+        return GeneSimilarityService(
+            self.store, "energy", metric=metric, directory=f"{self.directory.name}/similarity", block_size=16
+        )
+
+    def test_service_name(self):
+        self.assertEqual(self.create_service().get_name(), "Gene Similarity Service")
+
+    def test_pearson_matches_numpy(self):
+        matches = self.create_service().query_gene("Gene0", k=5)
+
+        expected = np.corrcoef(np.maximum(self.matrix, 0))[0]
+        expected[0] = -np.inf
+        top = np.argsort(-expected)[:5]
+
+        self.assertEqual([gene for gene, _, _ in matches], [f"Gene{i}" for i in top])
+        np.testing.assert_allclose([score for _, _, score in matches], expected[top], rtol=1e-4)
+        self.assertEqual(matches[0][1], 1000 + top[0])
+
+    def test_cosine(self):
+        matches = self.create_service("cosine").query_row(1, k=3)
+
+        rows = np.maximum(self.matrix, 0)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        np.testing.assert_allclose(matches[0][2], np.sort(rows[1] @ rows.T)[-2], rtol=1e-4)
+
+    def test_index_finds_the_same_genes(self):
+        similarity = self.create_service()
+        exact = similarity.query_gene("Gene4", k=10, approximate=False)
+
+        similarity.build_index(n_components=8, seed=0)
+        approximate = similarity.query_gene("Gene4", k=10)
+
+        self.assertEqual([gene for gene, _, _ in approximate], [gene for gene, _, _ in exact])
+
+    def count_normalizations(self) -> int:
+        """Create a service, counting the normalized files it writes"""
+        with mock.patch.object(np, "memmap", wraps=np.memmap) as memmap:
+            self.create_service()
+        return len([call for call in memmap.call_args_list if call.kwargs.get("mode") == "w+"])
+
+    def test_normalized_rows_are_reused(self):
+        self.assertEqual(self.count_normalizations(), 1)
+        path = self.create_service().normalized.filename
+        modified_ns = os.stat(path).st_mtime_ns
+
+        self.assertEqual(self.count_normalizations(), 0)
+        self.assertEqual(os.stat(path).st_mtime_ns, modified_ns)
+
+        self.store.append(2000, "GeneNew", {"energy": self.matrix[0]})
+        self.assertEqual(self.count_normalizations(), 1)
+        self.assertEqual(self.create_service().n_rows, 61)
+
+    def test_empty_store(self):
+        store = ExpressionMatrixStore.create(f"{self.directory.name}/empty", ["energy"], n_voxels=200)
+        similarity = GeneSimilarityService(store, "energy", directory=f"{self.directory.name}/similarity")
+
+        self.assertEqual(similarity.n_rows, 0)
+        with self.assertRaises(KeyError):
+            similarity.query_gene("Gene0")
+        store.close()
+
+    def test_unknown_gene(self):
+        with self.assertRaises(KeyError):
+            self.create_service().query_gene("Missing")
+
+    def test_invalid_metric(self):
+        with self.assertRaises(ValueError):
+            self.create_service("euclidean")
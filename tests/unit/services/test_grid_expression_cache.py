@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.services.data.grid_expression_cache import GridExpressionCache
+
+
+class TestGridExpressionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = GridExpressionCache(self.directory.name, max_bytes=64)
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get(1, "density"))
+
+        self.cache.put(1, "density", np.arange(4, dtype=np.float32))
+        np.testing.assert_array_equal(self.cache.get(1, "density"), np.arange(4, dtype=np.float32))
+
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_get_many_requires_every_measurement(self):
+        self.cache.put(1, "density", np.zeros(2, dtype=np.float32))
+
+        self.assertIsNone(self.cache.get_many(1, ["density", "intensity"]))
+        self.assertEqual(list(self.cache.get_many(1, ["density"])), ["density"])
+
+    def test_identical_volumes_are_stored_once(self):
+        self.cache.put_many(1, {"density": np.ones(4), "intensity": np.ones(4)})
+
+        self.assertEqual(self.cache.stats()["entries"], 2)
+        self.assertEqual(self.cache.size(), 16)
+
+    def test_least_recently_used_eviction(self):
+        for section_dataset_id in range(4):
+            self.cache.put(section_dataset_id, "density", np.full(4, section_dataset_id, dtype=np.float32))
+
+        # touch the oldest entry so the next one becomes the least recently used
+        self.cache.get(0, "density")
+        self.cache.put(4, "density", np.full(4, 4, dtype=np.float32))
+
+        self.assertLessEqual(self.cache.size(), 64)
+        self.assertIsNotNone(self.cache.get(0, "density"))
+        self.assertIsNone(self.cache.get(1, "density"))
+
+    def corrupt_objects(self):
+        for root, _, files in os.walk(os.path.join(self.directory.name, "objects")):
+            for file in files:
+                with open(os.path.join(root, file), "r+b") as f:
+                    f.write(b"\xff")
+
+    def test_corrupt_volume_is_dropped(self):
+        self.cache.put(1, "density", np.arange(4, dtype=np.float32))
+        self.corrupt_objects()
+
+        self.assertIsNone(self.cache.get(1, "density"))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_corrupt_shared_volume_is_rewritten(self):
+        volume = np.arange(4, dtype=np.float32)
+        self.cache.put_many(1, {"density": volume, "intensity": volume})
+        self.corrupt_objects()
+
+        self.assertIsNone(self.cache.get(1, "density"))
+        self.cache.put(1, "density", volume)
+
+        np.testing.assert_array_equal(self.cache.get(1, "density"), volume)
+        np.testing.assert_array_equal(self.cache.get(1, "intensity"), volume)
+
+    def test_access_times_are_written_in_batches(self):
+        cache = GridExpressionCache(f"{self.directory.name}/batched", access_flush_interval=3)
+        cache.put(1, "density", np.arange(4, dtype=np.float32))
+        updates = []
+        cache._connection.set_trace_callback(lambda statement: updates.append(statement) if statement.startswith("UPDATE") else None)
+
+        cache.get(1, "density")
+        cache.get(1, "density")
+        self.assertEqual(updates, [])
+
+        cache.get_many(1, ["density"])
+        cache.put(2, "density", np.zeros(4, dtype=np.float32))
+        self.assertEqual(len(updates), 1)
+
+        cache.get(1, "density")
+        cache.close()
+        self.assertEqual(len(updates), 2)
+
+    def test_volumes_are_read_outside_the_lock(self):
+        self.cache.put(1, "density", np.arange(4, dtype=np.float32))
+        read = self.cache._read
+
+        def read_unlocked(digest):
+            self.assertFalse(self.cache._lock.locked())
+            return read(digest)
+
+        with mock.patch.object(self.cache, "_read", side_effect=read_unlocked) as patched:
+            self.assertIsNotNone(self.cache.get(1, "density"))
+
+        patched.assert_called_once()
+
+    def test_invalid_max_bytes(self):
+        with self.assertRaises(ValueError):
+            GridExpressionCache(self.directory.name, max_bytes=0)
@@ -0,0 +1,191 @@
+import tempfile
+import zipfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.services.data import grid_expression_pipeline
+from brainstem_application.services.data.grid_expression_pipeline import GridExpressionPipeline
+from brainstem_application.services.data.grid_expression_cache import GridExpressionCache
+from brainstem_application.services.data.expression_matrix_store import ExpressionMatrixStore
+from brainstem_application.models import SectionDataSet
+from tests.unit.services.stand_in_server import StandInServer, make_gene_record, make_grid_expression_zip, make_section_dataset_record
+
+
+def make_volume(i: int) -> np.ndarray:
+    volume = np.arange(6, dtype=np.float32) + i
+    volume[0] = -1
+    return volume
+
+
+class TestGridExpressionPipeline(unittest.TestCase):
+
+    def run_pipeline(self, routes: dict, section_datasets: list, include: list, cache=None, **pipeline_options):
+        """Run a pipeline against a stand-in server, copying the volumes out of shared memory as they arrive"""
+        options = {"max_workers": 2, "processes": 2, "slots_per_process": 1, "backoff_factor": 0, **pipeline_options}
+        pipeline = GridExpressionPipeline(**options)
+        results = {}
+        errors = {}
+
+        with StandInServer(routes) as server, mock.patch.object(
+            grid_expression_pipeline.DataRetrievalService, "api_url", server.url
+        ):
+            for section_dataset, volumes, error in pipeline.iter_grid_expression_data(section_datasets, include, cache):
+                if error is not None:
+                    errors[section_dataset.id] = error
+                else:
+                    results[section_dataset.id] = {measurement: volume.copy() for measurement, volume in volumes.items()}
+
+            return results, errors, server.requests
+
+    def test_decodes_into_shared_memory(self):
+        routes = {
+            f"/grid_data/download/{i}": (200, make_grid_expression_zip({"energy": make_volume(i), "density": make_volume(-i)}))
+            for i in range(1, 7)
+        }
+        routes["/grid_data/download/2"] = [(503, b""), routes["/grid_data/download/2"]]
+        routes["/grid_data/download/7"] = (404, b"")
+
+        section_datasets = [SectionDataSet(**make_section_dataset_record(i)) for i in range(1, 8)]
+        results, errors, requests = self.run_pipeline(routes, section_datasets, ["energy", "density"])
+
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5, 6])
+        for i in range(1, 7):
+            np.testing.assert_array_equal(results[i]["energy"], make_volume(i))
+            np.testing.assert_array_equal(results[i]["density"], make_volume(-i))
+        self.assertEqual(list(errors), [7])
+        self.assertEqual(len([path for path, _ in requests if path.endswith("/2")]), 2)
+
+    def test_log1p_normalization_keeps_missing_voxels(self):
+        routes = {"/grid_data/download/1": (200, make_grid_expression_zip({"energy": make_volume(1)}))}
+
+        results, _, _ = self.run_pipeline(
+            routes, [SectionDataSet(**make_section_dataset_record(1))], ["energy"], normalization="log1p"
+        )
+
+        expected = make_volume(1)
+        expected[1:] = np.log1p(expected[1:])
+        np.testing.assert_allclose(results[1]["energy"], expected, rtol=1e-6)
+
+    def test_cached_volumes_are_not_downloaded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = GridExpressionCache(directory)
+            cache.put_many(1, {"energy": make_volume(1)})
+            routes = {"/grid_data/download/2": (200, make_grid_expression_zip({"energy": make_volume(2)}))}
+
+            section_datasets = [SectionDataSet(**make_section_dataset_record(i)) for i in range(1, 3)]
+            results, _, requests = self.run_pipeline(routes, section_datasets, ["energy"], cache=cache)
+
+            np.testing.assert_array_equal(results[1]["energy"], make_volume(1))
+            np.testing.assert_array_equal(cache.get_many(2, ["energy"])["energy"], make_volume(2))
+            self.assertEqual([path for path, _ in requests], ["/grid_data/download/2"])
+            cache.close()
+
+    def test_mismatched_volume_sizes(self):
+        routes = {
+            "/grid_data/download/1": (200, make_grid_expression_zip({"energy": make_volume(1)})),
+            "/grid_data/download/2": (200, make_grid_expression_zip({"energy": np.ones(3)})),
+        }
+        section_datasets = [SectionDataSet(**make_section_dataset_record(i)) for i in range(1, 3)]
+
+        with mock.patch.object(grid_expression_pipeline.GridExpressionPipeline, "_fetch", autospec=True) as fetch:
+            # serve the zips in order, so the shared memory is sized by the first one
+            fetch.side_effect = lambda pipeline, section_dataset, include, cache: routes[
+                f"/grid_data/download/{section_dataset.id}"
+            ][1]
+            results, errors, _ = self.run_pipeline({}, section_datasets, ["energy"], max_workers=1)
+
+        self.assertEqual(list(results), [1])
+        self.assertIsInstance(errors[2], ValueError)
+
+    def test_pull_resumes_a_store(self):
+        routes = {
+            f"/grid_data/download/{i}": (200, make_grid_expression_zip({"energy": make_volume(i)})) for i in range(1, 4)
+        }
+        section_datasets = [
+            SectionDataSet(**make_section_dataset_record(i, genes=[make_gene_record(i)])) for i in range(1, 4)
+        ]
+        section_datasets.append(SectionDataSet(**make_section_dataset_record(4)))
+        pipeline = GridExpressionPipeline(max_workers=2, processes=1, backoff_factor=0)
+        results = []
+
+        with tempfile.TemporaryDirectory() as directory, StandInServer(routes) as server, mock.patch.object(
+            grid_expression_pipeline.DataRetrievalService, "api_url", server.url
+        ):
+            store = ExpressionMatrixStore.create(directory, ["energy"], n_voxels=6)
+            store.append(1, "Gene1", {"energy": make_volume(1)})
+
+            store = pipeline.pull(
+                section_datasets, ["energy"], directory, store=store,
+                on_result=lambda section_dataset, error, completed, total: results.append((section_dataset.id, error, total)),
+            )
+            store = ExpressionMatrixStore(directory)
+            requested = sorted(path for path, _ in server.requests)
+
+            self.assertEqual(sorted(store.section_dataset_ids), [1, 2, 3])
+            self.assertEqual((store.reference_space_id, store.plane_of_section_id), (None, None))
+            np.testing.assert_array_equal(store.row("energy", store.section_dataset_ids.index(3)), make_volume(3))
+
+        self.assertEqual(requested, ["/grid_data/download/2", "/grid_data/download/3"])
+        self.assertEqual(sorted(results, key=lambda result: result[0]), [(2, None, 2), (3, None, 2)])
+
+    def test_pull_reports_volumes_of_another_grid(self):
+        routes = {
+            f"/grid_data/download/{i}": (200, make_grid_expression_zip({"energy": make_volume(i)})) for i in range(1, 3)
+        }
+        section_datasets = [
+            SectionDataSet(**make_section_dataset_record(i, genes=[make_gene_record(i)])) for i in range(1, 3)
+        ]
+        pipeline = GridExpressionPipeline(max_workers=1, processes=1, backoff_factor=0)
+        errors = {}
+
+        with tempfile.TemporaryDirectory() as directory, StandInServer(routes) as server, mock.patch.object(
+            grid_expression_pipeline.DataRetrievalService, "api_url", server.url
+        ):
+            store = ExpressionMatrixStore.create(directory, ["energy"], n_voxels=4)
+            pipeline.pull(
+                section_datasets, ["energy"], directory, store=store,
+                on_result=lambda section_dataset, error, completed, total: errors.setdefault(section_dataset.id, error),
+            )
+
+            self.assertEqual(ExpressionMatrixStore(directory).n_rows, 0)
+
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertTrue(all(isinstance(error, ValueError) for error in errors.values()))
+
+    def test_shards_partition_the_section_datasets(self):
+        section_datasets = [SectionDataSet(**make_section_dataset_record(i)) for i in range(1, 101)]
+
+        shards = [grid_expression_pipeline.shard_section_datasets(section_datasets, index, 4) for index in range(4)]
+        shard_ids = [section_dataset.id for shard in shards for section_dataset in shard]
+
+        self.assertEqual(sorted(shard_ids), list(range(1, 101)))
+        self.assertTrue(all(len(shard) > 0 for shard in shards))
+        # a section dataset stays in its shard whatever else is pulled
+        self.assertEqual(grid_expression_pipeline.shard_section_datasets(section_datasets[::-1][:10], 2, 4), [
+            section_dataset for section_dataset in shards[2][::-1] if section_dataset.id > 90
+        ])
+        with self.assertRaises(ValueError):
+            grid_expression_pipeline.shard_section_datasets(section_datasets, 4, 4)
+
+    def test_first_zip_without_the_measurement(self):
+        routes = {
+            "/grid_data/download/1": (200, make_grid_expression_zip({"density": make_volume(1)})),
+            "/grid_data/download/2": (200, b"not a zip"),
+            "/grid_data/download/3": (200, make_grid_expression_zip({"energy": make_volume(3)})),
+        }
+        section_datasets = [SectionDataSet(**make_section_dataset_record(i)) for i in range(1, 4)]
+
+        results, errors, _ = self.run_pipeline(routes, section_datasets, ["energy"], max_workers=1)
+
+        self.assertEqual(list(results), [3])
+        np.testing.assert_array_equal(results[3]["energy"], make_volume(3))
+        self.assertIsInstance(errors[1], KeyError)
+        self.assertIsInstance(errors[2], zipfile.BadZipFile)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            GridExpressionPipeline(processes=0)
+        with self.assertRaises(ValueError):
+            GridExpressionPipeline(normalization="zscore")
@@ -0,0 +1,86 @@
+import sqlite3
+import unittest
+from unittest import mock
+
+from brainstem_application.services.data import metadata_database_service
+from brainstem_application.services.data.metadata_database_service import MetadataDatabaseService
+from tests.unit.services.stand_in_server import (
+    StandInServer,
+    make_gene_record,
+    make_section_dataset_record,
+    paged_rma_route,
+)
+
+PLANE_OF_SECTION = {"id": 1, "name": "coronal", "plane_of_section_name_facet": 1}
+
+SECTION_DATASETS = [
+    make_section_dataset_record(1, genes=[make_gene_record(10)], plane_of_section=PLANE_OF_SECTION),
+    make_section_dataset_record(2, genes=[make_gene_record(11)], plane_of_section_id=2),
+    make_section_dataset_record(3, genes=[make_gene_record(12)], delegate=False),
+    make_section_dataset_record(4, genes=[]),
+]
+
+
+class TestMetadataDatabaseService(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.service = MetadataDatabaseService(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def sync(self, method: str, key: int, routes: dict) -> int:
+        with StandInServer(routes) as server, mock.patch.object(
+            metadata_database_service.DataRetrievalService, "api_url", server.url
+        ):
+            return getattr(self.service, method)(key)
+
+    def test_service_name(self):
+        self.assertEqual(self.service.get_name(), "Metadata Database Service")
+
+    def test_sync_reference_space(self):
+        routes = {"/api/v2/data/SectionDataSet/query.json": paged_rma_route(SECTION_DATASETS)}
+
+        self.assertFalse(self.service.is_reference_space_synced(9))
+        self.assertEqual(self.sync("sync_reference_space", 9, routes), 4)
+        self.assertTrue(self.service.is_reference_space_synced(9))
+
+        section_datasets = self.service.get_section_dataset_ids_with_reference_space_id(9)
+        self.assertEqual([section.id for section in section_datasets], [1])
+        self.assertEqual(section_datasets[0].genes[0].acronym, "Gene10")
+        self.assertEqual(section_datasets[0].plane_of_section.name, "coronal")
+
+        unfiltered = self.service.get_section_dataset_ids_with_reference_space_id(
+            9, delegate=False, should_contain_genes=False, plane_of_section_id=None
+        )
+        self.assertEqual([section.id for section in unfiltered], [1, 2, 3, 4])
+
+    def test_resync_replaces_reference_space(self):
+        routes = {"/api/v2/data/SectionDataSet/query.json": paged_rma_route(SECTION_DATASETS)}
+        self.sync("sync_reference_space", 9, routes)
+
+        routes = {"/api/v2/data/SectionDataSet/query.json": paged_rma_route(SECTION_DATASETS[1:2])}
+        self.sync("sync_reference_space", 9, routes)
+
+        section_datasets = self.service.get_section_dataset_ids_with_reference_space_id(9, plane_of_section_id=None)
+        self.assertEqual([section.id for section in section_datasets], [2])
+
+    def test_sync_bypasses_the_request_cache(self):
+        routes = {
+            "/api/v2/data/SectionDataSet/query.json": paged_rma_route(SECTION_DATASETS),
+            "/api/v2/data/Gene/query.json": paged_rma_route([make_gene_record(i) for i in range(3)]),
+        }
+
+        with mock.patch.object(metadata_database_service.DataRetrievalService, "get_request_cache") as get_request_cache:
+            self.sync("sync_reference_space", 9, routes)
+            self.sync("sync_product", 1, routes)
+
+        get_request_cache.assert_not_called()
+
+    def test_sync_product(self):
+        routes = {"/api/v2/data/Gene/query.json": paged_rma_route([make_gene_record(i) for i in range(3)])}
+
+        self.assertEqual(self.sync("sync_product", 1, routes), 3)
+        self.assertEqual([gene.id for gene in self.service.get_geneset_from_product(1)], [0, 1, 2])
+        self.assertEqual(self.service.get_geneset_from_product(2), [])
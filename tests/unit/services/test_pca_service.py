@@ -0,0 +1,57 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from brainstem_application.services.analysis.pca_service import PCAService
+
+
+def make_low_rank_matrix(n_samples: int = 120, n_features: int = 60, rank: int = 3) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    scales = np.array([10.0, 5.0, 2.0])[:rank]
+    matrix = (rng.standard_normal((n_samples, rank)) * scales) @ rng.standard_normal((rank, n_features))
+    matrix += 0.01 * rng.standard_normal((n_samples, n_features)) + 3.0
+    return matrix.astype(np.float32)
+
+
+class TestPCAService(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = make_low_rank_matrix()
+        self.exact = PCAService.fit(self.matrix, 3, mode="exact")
+
+    def assert_matches_exact(self, result):
+        np.testing.assert_allclose(result.explained_variance, self.exact.explained_variance, rtol=1e-3)
+        np.testing.assert_allclose(result.explained_variance_ratio, self.exact.explained_variance_ratio, rtol=1e-3)
+        # components are only defined up to their sign
+        alignment = np.abs(np.sum(result.components * self.exact.components, axis=1))
+        np.testing.assert_allclose(alignment, np.ones(3), atol=1e-3)
+
+    def test_service_name(self):
+        self.assertEqual(PCAService().get_name(), "PCA Service")
+
+    def test_exact(self):
+        self.assertEqual(self.exact.components.dtype, np.float32)
+        self.assertGreater(self.exact.explained_variance_ratio.sum(), 0.99)
+        np.testing.assert_allclose(self.exact.mean, self.matrix.mean(axis=0), rtol=1e-4)
+
+    def test_randomized(self):
+        self.assert_matches_exact(PCAService.fit(self.matrix, 3, mode="randomized", block_size=32, seed=0))
+
+    def test_incremental_from_memmap(self):
+        with tempfile.NamedTemporaryFile() as file:
+            matrix = np.memmap(file.name, dtype=np.float32, mode="w+", shape=self.matrix.shape)
+            matrix[:] = self.matrix
+
+            self.assert_matches_exact(PCAService.fit(matrix, 3, mode="incremental", block_size=25))
+
+    def test_transform(self):
+        scores = PCAService.transform(self.exact, self.matrix, block_size=50)
+        self.assertEqual(scores.shape, (120, 3))
+        np.testing.assert_allclose(scores.var(axis=0, ddof=1), self.exact.explained_variance, rtol=1e-3)
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError):
+            PCAService.fit(self.matrix, 3, mode="kernel")
+        with self.assertRaises(ValueError):
+            PCAService.fit(self.matrix, 0)
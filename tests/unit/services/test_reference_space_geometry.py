@@ -0,0 +1,102 @@
+import io
+import zipfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.constants import PlaneOfSection
+from brainstem_application.services.data import data_retrieval_service
+from brainstem_application.services.data.data_retrieval_service import DataRetrievalService
+from brainstem_application.services.data.reference_space_geometry import (
+    ReferenceSpaceGeometry,
+    ReferenceSpaceGeometryRegistry,
+)
+from brainstem_application.models import SectionDataSet
+from tests.unit.services.stand_in_server import StandInServer, make_section_dataset_record
+
+
+def make_header(size: tuple, spacing: tuple = (200, 200, 200)) -> str:
+    return "\n".join(
+        [
+            "ObjectType = Image",
+            "NDims = 3",
+            f"DimSize = {' '.join(str(n) for n in size)}",
+            f"ElementSpacing = {' '.join(str(s) for s in spacing)}",
+            "ElementType = MET_FLOAT",
+            "ElementDataFile = density.raw",
+        ]
+    )
+
+
+class TestReferenceSpaceGeometry(unittest.TestCase):
+
+    def setUp(self):
+        # x varies fastest: voxel (x, y, z) holds x + 10 * y + 100 * z
+        self.geometry = ReferenceSpaceGeometry(1, "Test", (4, 3, 2), (200, 200, 200))
+        z, y, x = np.meshgrid(np.arange(2), np.arange(3), np.arange(4), indexing="ij")
+        self.volume = (x + 10 * y + 100 * z).astype(np.float32).ravel()
+
+    def test_p56_geometry(self):
+        geometry = ReferenceSpaceGeometryRegistry.get(9)
+
+        self.assertEqual(geometry.name, "P56 Brain")
+        self.assertEqual(geometry.shape, (58, 41, 67))
+        self.assertEqual(geometry.n_voxels, 159326)
+
+    def test_reshape_is_a_contiguous_view(self):
+        volume = self.geometry.reshape(self.volume)
+
+        self.assertEqual(volume.shape, (2, 3, 4))
+        self.assertTrue(volume.flags.c_contiguous)
+        self.assertTrue(np.shares_memory(volume, self.volume))
+        self.assertEqual(volume[1, 2, 3], 123)
+
+    def test_reshape_rejects_copies(self):
+        with self.assertRaises(ValueError):
+            self.geometry.reshape(np.zeros(25, dtype=np.float32))
+        with self.assertRaises(ValueError):
+            self.geometry.reshape(np.zeros(48, dtype=np.float32)[::2])
+
+    def test_planes_are_views(self):
+        coronal = self.geometry.plane(self.volume, PlaneOfSection.CORONAL, 3)
+        sagittal = self.geometry.plane(self.volume, PlaneOfSection.SAGITTAL, 1)
+
+        np.testing.assert_array_equal(coronal, [[3, 13, 23], [103, 113, 123]])
+        np.testing.assert_array_equal(sagittal[:, 0], [100, 110, 120])
+        self.assertTrue(np.shares_memory(coronal, self.volume))
+        self.assertTrue(np.shares_memory(sagittal, self.volume))
+        self.assertEqual(self.geometry.n_planes(PlaneOfSection.CORONAL), 4)
+        self.assertEqual(self.geometry.n_planes(PlaneOfSection.SAGITTAL), 2)
+
+        with self.assertRaises(ValueError):
+            self.geometry.plane(self.volume, 3, 0)
+
+    def test_from_mhd(self):
+        geometry = ReferenceSpaceGeometry.from_mhd(1, "Test", make_header((4, 3, 2), (80, 80, 80)))
+
+        self.assertEqual(geometry.size, (4, 3, 2))
+        self.assertEqual(geometry.spacing, (80.0, 80.0, 80.0))
+
+
+class TestGridExpressionVolumes(unittest.TestCase):
+
+    def tearDown(self):
+        # forget the geometries learned from the stand-in zips
+        data_retrieval_service.ReferenceSpaceGeometryRegistry._geometries = None
+
+    def test_header_in_zip_shapes_volumes(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zip_ref:
+            zip_ref.writestr("density.mhd", make_header((4, 3, 2)))
+            zip_ref.writestr("density.raw", np.arange(24, dtype=np.float32).tobytes())
+
+        section_dataset = SectionDataSet(**make_section_dataset_record(1, reference_space_id=3))
+        routes = {"/grid_data/download/1": (200, buffer.getvalue())}
+
+        with StandInServer(routes) as server, mock.patch.object(DataRetrievalService, "api_url", server.url):
+            volumes = DataRetrievalService.get_grid_expression_volumes(section_dataset, include=["density"])
+
+        self.assertEqual(volumes["density"].shape, (2, 3, 4))
+        self.assertEqual(volumes["density"][1, 0, 0], 12)
+        self.assertEqual(data_retrieval_service.ReferenceSpaceGeometryRegistry.get(3).size, (4, 3, 2))
@@ -0,0 +1,106 @@
+import time
+import threading
+import unittest
+from unittest import mock
+
+from brainstem_application.services.data.request_cache import RequestCache
+
+
+def make_response(status_code: int, content: bytes = b"", headers: dict = None):
+    return mock.Mock(status_code=status_code, content=content, headers=headers or {})
+
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.cache = RequestCache(lambda: self.session, ttl=60, max_entries=2)
+
+    def test_fresh_responses_are_reused(self):
+        self.session.get.return_value = make_response(200, b"genes")
+
+        self.assertEqual(self.cache.get("http://api/genes"), b"genes")
+        self.assertEqual(self.cache.get("http://api/genes"), b"genes")
+
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_stale_responses_are_revalidated(self):
+        self.cache.ttl = 0
+        self.session.get.side_effect = [
+            make_response(200, b"genes", {"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}),
+            make_response(304),
+            make_response(200, b"new genes", {"ETag": '"v2"'}),
+        ]
+
+        self.assertEqual(self.cache.get("http://api/genes"), b"genes")
+        self.assertEqual(self.cache.get("http://api/genes"), b"genes")
+        self.assertEqual(self.cache.get("http://api/genes"), b"new genes")
+
+        headers = self.session.get.call_args_list[1].kwargs["headers"]
+        self.assertEqual(headers["If-None-Match"], '"v1"')
+        self.assertEqual(headers["If-Modified-Since"], "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.assertEqual(self.session.get.call_args_list[2].kwargs["headers"]["If-None-Match"], '"v1"')
+        self.assertEqual(self.cache.stats()["revalidations"], 1)
+
+    def test_errors_are_not_cached(self):
+        self.session.get.side_effect = [make_response(500, b"error"), make_response(200, b"genes")]
+
+        self.assertEqual(self.cache.get("http://api/genes"), b"error")
+        self.assertEqual(self.cache.get("http://api/genes"), b"genes")
+
+    def test_least_recently_used_responses_are_evicted(self):
+        self.session.get.side_effect = lambda url, headers: make_response(200, url.encode())
+
+        for url in ["http://api/a", "http://api/b", "http://api/a", "http://api/c", "http://api/a"]:
+            self.cache.get(url)
+
+        self.assertEqual([call.args[0] for call in self.session.get.call_args_list], ["http://api/a", "http://api/b", "http://api/c"])
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+    def test_identical_requests_are_coalesced(self):
+        release = threading.Event()
+
+        def slow_get(url, headers):
+            release.wait(5)
+            return make_response(200, b"genes")
+
+        self.session.get.side_effect = slow_get
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get("http://api/genes"))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        # wait until every follower is waiting on the leader's request
+        deadline = time.monotonic() + 5
+        while self.cache.stats()["coalesced"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [b"genes"] * 4)
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(self.cache.stats()["coalesced"], 3)
+
+    def test_failed_requests_are_not_cached(self):
+        self.session.get.side_effect = ConnectionError("down")
+
+        with self.assertRaises(ConnectionError):
+            self.cache.get("http://api/genes")
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_cached_responses_are_bounded_by_size(self):
+        self.cache = RequestCache(lambda: self.session, ttl=60, max_entries=8, max_bytes=10)
+        self.session.get.side_effect = lambda url, headers: make_response(200, {"http://api/large": b"x" * 11}.get(url, b"x" * 4))
+
+        for url in ["http://api/a", "http://api/b", "http://api/c", "http://api/large", "http://api/c", "http://api/large"]:
+            self.cache.get(url)
+
+        self.assertEqual(
+            [call.args[0] for call in self.session.get.call_args_list],
+            ["http://api/a", "http://api/b", "http://api/c", "http://api/large", "http://api/large"],
+        )
+        self.assertEqual(self.cache.stats()["entries"], 2)
+        self.assertEqual(self.cache.stats()["bytes"], 8)
@@ -0,0 +1,101 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from brainstem_application.services.data.expression_matrix_store import ExpressionMatrixStore
+from brainstem_application.services.data.voxel_mask import RegionAggregator, VoxelMask
+
+
+class TestVoxelMask(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        # voxel 0 never has data, voxel 3 only in the first row
+        self.density = np.array(
+            [
+                [-1, 1, 2, 3, 4, 5],
+                [-1, 2, 3, -1, 5, 6],
+                [-1, 3, 4, -1, 6, 7],
+            ],
+            dtype=np.float32,
+        )
+        self.store = ExpressionMatrixStore.create(f"{self.directory.name}/store", ["density"], n_voxels=6)
+        for i, row in enumerate(self.density):
+            self.store.append(100 + i, f"Gene{i}", {"density": row})
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_from_store(self):
+        self.assertEqual(VoxelMask.from_store(self.store, block_size=2).indices.tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(VoxelMask.from_store(self.store, min_valid_rows=2).indices.tolist(), [1, 2, 4, 5])
+
+    def test_apply_and_expand(self):
+        mask = VoxelMask.from_store(self.store, min_valid_rows=2)
+
+        masked = mask.apply(self.density)
+        np.testing.assert_array_equal(masked[0], [1, 2, 4, 5])
+        np.testing.assert_array_equal(mask.expand(masked)[0], [-1, 1, 2, -1, 4, 5])
+
+    def test_apply_fill_value(self):
+        masked = VoxelMask.from_store(self.store).apply(self.density, fill_value=0)
+        np.testing.assert_array_equal(masked[:, 2], [3, 0, 0])
+
+    def test_coordinates(self):
+        mask = VoxelMask(np.array([True, False, False, False, False, True]), shape=(2, 3))
+        np.testing.assert_array_equal(mask.coordinates(), [[0, 0], [1, 2]])
+
+        with self.assertRaises(ValueError):
+            VoxelMask(np.ones(6, dtype=bool)).coordinates()
+
+    def test_intersect_with_annotation(self):
+        annotation = VoxelMask.from_annotation(np.array([0, 0, 5, 5, 7, 7]))
+        mask = VoxelMask.from_store(self.store).intersect(annotation)
+        self.assertEqual(mask.indices.tolist(), [2, 3, 4, 5])
+
+    def test_compact(self):
+        mask = VoxelMask.from_store(self.store, min_valid_rows=2, shape=(2, 3))
+        masked_store = mask.compact(self.store, f"{self.directory.name}/masked", block_size=2)
+
+        self.assertEqual(masked_store.n_voxels, 4)
+        self.assertEqual(masked_store.genes, ["Gene0", "Gene1", "Gene2"])
+        np.testing.assert_array_equal(masked_store.matrix("density"), mask.apply(self.density))
+
+        loaded = VoxelMask.load(f"{self.directory.name}/masked")
+        self.assertEqual(loaded.shape, (2, 3))
+        np.testing.assert_array_equal(loaded.indices, mask.indices)
+
+
+class TestRegionAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = np.array([0, 12, 12, 5, 5, 5])
+        self.matrix = np.array(
+            [
+                [9, 1, 3, 2, -1, 4],
+                [9, -1, -1, 1, 1, 1],
+            ],
+            dtype=np.float32,
+        )
+
+    def test_mean(self):
+        aggregator = RegionAggregator(self.labels)
+        result = aggregator.aggregate(self.matrix, "mean", block_size=1)
+
+        self.assertEqual(aggregator.structure_ids.tolist(), [5, 12])
+        np.testing.assert_array_equal(result, [[3, 2], [1, np.nan]])
+
+    def test_max(self):
+        result = RegionAggregator(self.labels).aggregate(self.matrix, "max")
+        np.testing.assert_array_equal(result, [[4, 3], [1, np.nan]])
+
+    def test_volume(self):
+        result = RegionAggregator(self.labels).aggregate(self.matrix[0])
+        np.testing.assert_array_equal(result, [3, 2])
+
+    def test_invalid_reduction(self):
+        with self.assertRaises(ValueError):
+            RegionAggregator(self.labels).aggregate(self.matrix, "median")
@@ -0,0 +1,81 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from brainstem_application.utils.amba_product_loader import (
+    MetadataRegistry,
+    get_amba_product_by_id,
+    get_list_of_amba_brain_atlas_products,
+    get_list_of_amba_reference_spaces,
+    load_amba_products,
+)
+from brainstem_application.models import AMBAProduct
+
+
+def make_product(product_id: int, name: str) -> dict:
+    return {"abbreviation": name[:3], "id": product_id, "name": name, "product_name_facet": product_id, "species_name_facet": 1}
+
+
+class TestMetadataRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = f"{self.directory.name}/products.json"
+        self.write([make_product(2, "Mouse Brain"), make_product(1, "Developing Mouse Brain")])
+        self.registry = MetadataRegistry(self.path, AMBAProduct)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, products: list, mtime_ns: int = None):
+        with open(self.path, "w") as file:
+            json.dump(products, file)
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_lookups(self):
+        self.assertEqual([product.id for product in self.registry.all()], [1, 2])
+        self.assertEqual(self.registry.get_by_id(2).name, "Mouse Brain")
+        self.assertEqual(self.registry.get_by_name("Developing Mouse Brain").id, 1)
+        self.assertIsNone(self.registry.get_by_id(3))
+
+    def test_file_is_parsed_once(self):
+        with mock.patch("builtins.open", wraps=open) as opened:
+            for _ in range(10):
+                self.registry.get_by_id(1)
+
+        self.assertEqual(opened.call_count, 1)
+
+    def test_modified_file_is_reloaded(self):
+        self.assertIsNone(self.registry.get_by_id(3))
+
+        self.write([make_product(3, "Mouse Spinal Cord")], mtime_ns=os.stat(self.path).st_mtime_ns + 10**9)
+
+        self.assertEqual(self.registry.get_by_id(3).name, "Mouse Spinal Cord")
+        self.assertIsNone(self.registry.get_by_id(1))
+
+    def test_missing_file(self):
+        registry = MetadataRegistry(f"{self.directory.name}/missing.json", AMBAProduct)
+
+        self.assertIsNone(registry.all())
+        self.assertIsNone(registry.get_by_id(1))
+
+    def test_all_returns_a_copy(self):
+        self.registry.all().clear()
+
+        self.assertEqual(len(self.registry.all()), 2)
+
+
+class TestAMBAProductLoader(unittest.TestCase):
+
+    def test_products(self):
+        products = load_amba_products()
+
+        self.assertGreater(len(products), 0)
+        self.assertEqual(get_amba_product_by_id(products[0].id), products[0])
+        self.assertEqual([product_id for product_id, _ in get_list_of_amba_brain_atlas_products()], sorted(product.id for product in products))
+
+    def test_reference_spaces(self):
+        self.assertGreater(len(get_list_of_amba_reference_spaces()), 0)
@@ -0,0 +1,109 @@
+import argparse
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application import cli
+from brainstem_application.services.data import grid_expression_pipeline
+from brainstem_application.services.data.expression_matrix_store import ExpressionMatrixStore
+from tests.unit.services.stand_in_server import (
+    StandInServer,
+    make_gene_record,
+    make_grid_expression_zip,
+    make_section_dataset_record,
+    paged_rma_route,
+)
+
+
+def make_volume(i: int) -> np.ndarray:
+    return np.arange(4, dtype=np.float32) * i
+
+
+def make_record(i: int) -> dict:
+    return make_section_dataset_record(i, genes=[make_gene_record(i)])
+
+
+class TestCLI(unittest.TestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(cli.parse_shard("0/4"), (0, 4))
+        self.assertEqual(cli.parse_shard("3/4"), (3, 4))
+        for value in ["4/4", "-1/4", "0/0", "1", "a/b"]:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                cli.parse_shard(value)
+
+    def test_parse_measures(self):
+        self.assertEqual(cli.parse_measures("energy, density,energy"), ["energy", "density"])
+        with self.assertRaises(argparse.ArgumentTypeError):
+            cli.parse_measures("energy,expression")
+
+    def test_sharded_fetch_grid_and_merge(self):
+        records = [make_record(i) for i in range(1, 9)]
+        routes = {
+            "/api/v2/data/SectionDataSet/query.json": paged_rma_route(records),
+            **{f"/grid_data/download/{i}": (200, make_grid_expression_zip({"energy": make_volume(i)})) for i in range(1, 8)},
+        }
+        shards = {
+            index: [record["id"] for record in records if grid_expression_pipeline.shard_of(record["id"], 2) == index]
+            for index in range(2)
+        }
+
+        with tempfile.TemporaryDirectory() as directory, StandInServer(routes) as server, mock.patch.object(
+            grid_expression_pipeline.DataRetrievalService, "api_url", server.url
+        ), mock.patch("builtins.print"):
+            fetch_grid = [
+                "fetch-grid", "--reference-space", "9", "--measures", "energy", "--workers", "2", "--processes", "1",
+                "--no-cache", "--database", f"{directory}/metadata.db", "--out", f"{directory}/store",
+            ]
+
+            # a shard cannot be merged before the other one is pulled
+            self.assertEqual(cli.main([*fetch_grid, "--shard", "0/2"]), 0 if 8 not in shards[0] else 1)
+            self.assertEqual(cli.main(["merge-stores", "--store", f"{directory}/store"]), 1)
+
+            # section dataset 8 has no grid expression data to download
+            self.assertEqual(cli.main([*fetch_grid, "--shard", "1/2"]), 0 if 8 not in shards[1] else 1)
+            fragment = ExpressionMatrixStore(f"{directory}/store/shard-1-of-2")
+            self.assertEqual(sorted(fragment.section_dataset_ids), [i for i in shards[1] if i != 8])
+
+            self.assertEqual(cli.main(["merge-stores", "--store", f"{directory}/store"]), 0)
+            store = ExpressionMatrixStore(f"{directory}/store")
+
+            self.assertEqual(store.genes, sorted(f"Gene{i}" for i in range(1, 8)))
+            np.testing.assert_array_equal(store.row("energy", store.section_dataset_ids.index(3)), make_volume(3))
+
+    def test_fetch_grid_does_not_replace_a_store(self):
+        routes = {
+            "/api/v2/data/SectionDataSet/query.json": paged_rma_route([make_record(1)]),
+            "/grid_data/download/1": (200, make_grid_expression_zip({"energy": make_volume(1)})),
+        }
+
+        with tempfile.TemporaryDirectory() as directory, StandInServer(routes) as server, mock.patch.object(
+            grid_expression_pipeline.DataRetrievalService, "api_url", server.url
+        ), mock.patch("builtins.print"):
+            store = ExpressionMatrixStore.create(f"{directory}/store", ["energy"], n_voxels=4, reference_space_id=9, plane_of_section_id=1)
+            store.append(2, "Gene2", {"energy": make_volume(2)})
+            store.close()
+            fetch_grid = [
+                "fetch-grid", "--reference-space", "9", "--measures", "energy", "--processes", "1",
+                "--no-cache", "--database", f"{directory}/metadata.db", "--out", f"{directory}/store",
+            ]
+
+            self.assertEqual(cli.main(fetch_grid), 1)
+            self.assertEqual(ExpressionMatrixStore(f"{directory}/store").section_dataset_ids, [2])
+            self.assertEqual(len(server.requests), 0)
+
+            self.assertEqual(cli.main([*fetch_grid, "--overwrite"]), 0)
+            self.assertEqual(ExpressionMatrixStore(f"{directory}/store").section_dataset_ids, [1])
+
+    def test_invalid_arguments_exit(self):
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit) as context:
+            cli.main(["fetch-grid", "--reference-space", "9", "--shard", "2/2"])
+
+        self.assertEqual(context.exception.code, 2)
+
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit) as context:
+            cli.main(["fetch-grid", "--reference-space", "9", "--resume", "--overwrite"])
+
+        self.assertEqual(context.exception.code, 2)
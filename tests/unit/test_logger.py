@@ -1,4 +1,6 @@
 import os
+import time
+import tempfile
 import unittest
 
 from brainstem_application.lib.logger import Logger
@@ -145,3 +147,68 @@ class TestLogger(unittest.TestCase):
             os.rmdir(last_dir)
 
         return super().tearDown()
+
+
+class TestQueuedLogger(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_file = f"{self.directory.name}/queued.log"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_lines(self, path: str = None) -> list:
+        with open(path or self.log_file) as f:
+            return f.read().splitlines()
+
+    def test_messages_are_written_on_flush(self):
+        logger = Logger(log_file=self.log_file, log_level="INFO", queued=True, flush_interval=60)
+
+        logger.info("first")
+        logger.debug("disabled")
+        logger.error("second")
+        logger.flush()
+
+        lines = self.read_lines()
+        self.assertEqual([line.split(" ", 1)[1] for line in lines], ["[INFO] first", "[ERROR] second"])
+        logger.close()
+
+    def test_messages_are_written_after_the_flush_interval(self):
+        logger = Logger(log_file=self.log_file, queued=True, flush_interval=0.05)
+
+        logger.info("message")
+        deadline = time.monotonic() + 5
+        while len(self.read_lines()) == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(len(self.read_lines()), 1)
+        logger.close()
+
+    def test_close_writes_pending_messages(self):
+        logger = Logger(log_file=self.log_file, queued=True, flush_interval=60)
+
+        for i in range(1000):
+            logger.info(f"message {i}")
+        logger.close()
+
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 1000)
+        self.assertTrue(lines[-1].endswith("message 999"))
+
+    def test_log_file_is_rotated(self):
+        logger = Logger(log_file=self.log_file, queued=True, flush_size=1, max_bytes=200, backup_count=2)
+
+        for i in range(30):
+            logger.info(f"message {i}")
+        logger.close()
+
+        self.assertFalse(os.path.exists(f"{self.log_file}.3"))
+        self.assertTrue(os.path.exists(f"{self.log_file}.2"))
+        self.assertLessEqual(os.path.getsize(f"{self.log_file}.1"), 200 + 64)
+        self.assertTrue(self.read_lines()[-1].endswith("message 29"))
+
+    def test_invalid_queued_parameters(self):
+        with self.assertRaises(ValueError):
+            Logger(log_file=self.log_file, queued=True, flush_interval=0)
+        with self.assertRaises(ValueError):
+            Logger(log_file=self.log_file, log_level="INVALID")
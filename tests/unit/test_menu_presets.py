@@ -0,0 +1,50 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from brainstem_application.utils import menu_presets
+from brainstem_application.services.data.expression_matrix_store import ExpressionMatrixStore
+
+
+class TestResumeGridExpressionDataPrompt(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        store = ExpressionMatrixStore.create(self.directory.name, ["density"], n_voxels=2, reference_space_id=9, plane_of_section_id=1)
+        store.append(1, "Gad1", {"density": np.zeros(2)})
+        store.close()
+
+        patches = [
+            mock.patch.object(menu_presets, "DATA_GENERATED_EXPRESSION_STORE_DIR", self.directory.name),
+            mock.patch("builtins.print"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def prompt(self, answer: bool, reference_space_id: int, plane_of_section_id: int):
+        with mock.patch.object(menu_presets.InputUtility, "get_yes_no_input", return_value=answer) as ask:
+            return menu_presets.resume_grid_expression_data_prompt(["density"], reference_space_id, plane_of_section_id), ask
+
+    def test_resume_the_same_pull(self):
+        (should_pull, store), _ = self.prompt(True, 9, 1)
+
+        self.assertTrue(should_pull)
+        self.assertEqual(store.mode, "r+")
+        self.assertEqual(store.completed_section_dataset_ids(), {1})
+        store.close()
+
+    def test_pull_of_another_plane_is_not_resumed(self):
+        (should_pull, store), ask = self.prompt(True, 9, 2)
+
+        self.assertEqual((should_pull, store), (True, None))
+        self.assertIn("replace", ask.call_args.args[0])
+
+        (should_pull, store), _ = self.prompt(False, 10, 1)
+
+        self.assertEqual((should_pull, store), (False, None))
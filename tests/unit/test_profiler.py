@@ -0,0 +1,89 @@
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from brainstem_application.utils.profiler import SpanStats, Tracer
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = Tracer(record_events=True)
+
+    def test_spans_are_aggregated(self):
+        for _ in range(3):
+            with self.tracer.span("grid_data.transfer") as span:
+                span.add_bytes(1024)
+        self.tracer.record("grid_data.decode", 2_000_000, 4096)
+
+        stats = self.tracer.stats()
+
+        self.assertEqual(sorted(stats), ["grid_data.decode", "grid_data.transfer"])
+        self.assertEqual(stats["grid_data.transfer"]["count"], 3)
+        self.assertEqual(stats["grid_data.transfer"]["bytes"], 3072)
+        self.assertEqual(stats["grid_data.decode"]["total_ns"], 2_000_000)
+        self.assertEqual(sum(stats["grid_data.transfer"]["histogram"].values()), 3)
+
+    def test_spans_are_recorded_on_errors(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.span("rma.validate"):
+                raise ValueError("invalid")
+
+        self.assertEqual(self.tracer.stats()["rma.validate"]["count"], 1)
+
+    def test_summary(self):
+        self.tracer.record("grid_data.transfer", 1_000_000_000, 2 * 1024 ** 2)
+
+        summary = self.tracer.summary().splitlines()
+
+        self.assertTrue(summary[0].startswith("Span"))
+        self.assertIn("grid_data.transfer", summary[2])
+        self.assertIn("2.00 MB/s", summary[2])
+
+    def test_write_json_and_chrome_trace(self):
+        with self.tracer.span("export.csv"):
+            pass
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.tracer.write_json(f"{directory}/metrics.json")
+            self.tracer.write_chrome_trace(f"{directory}/trace.json")
+
+            with open(f"{directory}/metrics.json") as file:
+                self.assertEqual(json.load(file)["export.csv"]["count"], 1)
+            with open(f"{directory}/trace.json") as file:
+                events = json.load(file)["traceEvents"]
+
+        self.assertEqual([(event["name"], event["ph"]) for event in events], [("export.csv", "X")])
+        self.assertGreaterEqual(events[0]["ts"], 0)
+
+    def test_events_are_only_kept_when_recording(self):
+        tracer = Tracer()
+        tracer.record("rma.request", 1000)
+
+        with tempfile.TemporaryDirectory() as directory:
+            tracer.write_chrome_trace(f"{directory}/trace.json")
+            with open(f"{directory}/trace.json") as file:
+                self.assertEqual(json.load(file)["traceEvents"], [])
+
+    def test_time_function_records_a_span(self):
+        from brainstem_application.utils import profiler
+
+        profiler.TRACER.reset()
+        with mock.patch("builtins.print"):
+            self.assertEqual(profiler.time_function(sorted)([2, 1]), [1, 2])
+
+        self.assertEqual(profiler.TRACER.stats()["sorted"]["count"], 1)
+        profiler.TRACER.reset()
+
+
+class TestSpanStats(unittest.TestCase):
+
+    def test_percentiles_are_bounded_by_the_histogram(self):
+        stats = SpanStats("span")
+        for duration_ns in [100] * 98 + [10_000, 1_000_000]:
+            stats.add(duration_ns)
+
+        self.assertEqual(stats.percentile(50), 128)
+        self.assertEqual(stats.percentile(99), 16384)
+        self.assertEqual(stats.percentile(100), 1_000_000)
@@ -0,0 +1,60 @@
+import os
+import sys
+import subprocess
+import unittest
+
+from brainstem_application.constants import BRAINSTEM_APPLICATION_DIR
+
+# Modules that must only be imported by the menu actions that use them
+DEFERRED_MODULES = ["numpy", "pandas", "requests", "sklearn", "aiohttp"]
+
+# Upper bound on the cumulative import time of main, in milliseconds. It is generous, so that it only catches
+# a heavy module being imported at startup again, not a slow machine
+STARTUP_IMPORT_BUDGET_MS = 500
+
+
+def run_in_application_directory(arguments: list[str]) -> subprocess.CompletedProcess:
+    """Run the interpreter in the application directory, as main.py is run"""
+    return subprocess.run(
+        [sys.executable, *arguments],
+        cwd=BRAINSTEM_APPLICATION_DIR,
+        env={**os.environ, "PYTHONPATH": BRAINSTEM_APPLICATION_DIR},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_main_with_importtime() -> dict[str, int]:
+    """Import main in a fresh interpreter with -X importtime, returning the cumulative import time of each module in microseconds"""
+    result = run_in_application_directory(["-X", "importtime", "-c", "import main"])
+
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        import_times[module.strip()] = int(cumulative)
+
+    return import_times
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_heavy_modules_are_deferred(self):
+        import_times = import_main_with_importtime()
+
+        self.assertEqual([module for module in DEFERRED_MODULES if module in import_times], [])
+
+    def test_startup_import_time(self):
+        import_times = import_main_with_importtime()
+
+        self.assertLess(import_times["main"] / 1000, STARTUP_IMPORT_BUDGET_MS)
+
+    def test_importing_main_starts_no_logger(self):
+        # what a spawned decoding process of the grid expression pipeline does with the script that started it
+        result = run_in_application_directory(
+            ["-c", "import runpy, threading; namespace = runpy.run_path('main.py', run_name='__mp_main__'); print(namespace['logger'], threading.active_count())"]
+        )
+
+        self.assertEqual(result.stdout.split(), ["None", "1"])